@@ -0,0 +1,912 @@
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import torch
+import numpy as np
+import config
+import customlayers
+
+
+#Rows of the current run: {"benchmark", "params", "metrics"}; metrics ending in _ms are lower-is-better, _per_s higher-is-better
+RESULTS = []
+
+
+def record(benchmark, params, **metrics):
+    """ Adds one machine-readable result row for --json and --compare """
+    RESULTS.append({"benchmark": benchmark, "params": params, "metrics": metrics})
+
+
+def time_call(fn, repeat):
+    """ Best wall-clock time of repeat calls to fn, in seconds """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_eidetic_layer(size, num_quantiles, samples=2000, indexed=False):
+    """ EideticLinearLayer, or EideticIndexedLinearLayer when indexed, with thresholds taken from random activations """
+    if indexed:
+        layer = customlayers.EideticIndexedLinearLayer(size, size, 1.0, samples, num_quantiles, 2)
+    else:
+        layer = customlayers.EideticLinearLayer(size, size, 1.0, samples, 1)
+    activations = torch.randn(samples, size).numpy()
+    layer.set_quantiles(np.quantile(activations, np.arange(1, num_quantiles) / num_quantiles, axis=0).T)
+    return layer
+
+
+def bench_bucketing(args):
+    """ Per-element binarySearchQuantiles loop against the batched bucketize """
+    print("{:>8} {:>10} {:>14} {:>14} {:>10}".format("batch", "quantiles", "loop (ms)", "batched (ms)", "speedup"))
+    for num_quantiles in args.quantiles:
+        layer = make_eidetic_layer(args.size, num_quantiles)
+        for batch_size in args.batch_sizes:
+            activations = torch.randn(batch_size, args.size)
+
+            def loop():
+                indices = torch.zeros([batch_size, args.size])
+                for j in range(0, batch_size):
+                    for i in range(0, args.size):
+                        indices[j][i] = layer.binarySearchQuantiles(activations[j][i].item(), i)
+                return indices
+
+            def batched():
+                return customlayers.bucketize(activations, layer.quantiles, layer.quantiles_increasing)
+
+            loop_time = time_call(loop, 1)
+            batched_time = time_call(batched, args.repeat)
+            record("bucketing", dict(batch=batch_size, quantiles=num_quantiles, size=args.size), loop_ms=loop_time * 1000, batched_ms=batched_time * 1000)
+            print("{:>8} {:>10} {:>14.3f} {:>14.3f} {:>9.1f}x".format(
+                batch_size, num_quantiles, loop_time * 1000, batched_time * 1000, loop_time / batched_time))
+
+
+def bench_indexed(args):
+    """ Per-sample, per-feature ParameterList loop against the batched indexed_product """
+    print("{:>8} {:>10} {:>14} {:>14} {:>10}".format("batch", "quantiles", "loop (ms)", "batched (ms)", "speedup"))
+    for num_quantiles in args.quantiles:
+        layer = customlayers.IndexedLinearLayer(args.size, args.size, num_quantiles)
+        vectors = [layer.param_index[i, j] for i in range(num_quantiles) for j in range(args.size)]
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, args.size)
+            indices = torch.randint(0, num_quantiles, (batch_size, args.size))
+
+            def loop():
+                output = torch.empty(batch_size, args.size)
+                for batch in range(0, batch_size):
+                    outx = torch.empty(args.size, args.size)
+                    for i in range(0, args.size):
+                        outx[i] = vectors[int(indices[batch][i]) * args.size + i] * x[batch][i]
+                    output[batch] = torch.sum(outx, 0)
+                return output
+
+            def batched():
+                return customlayers.indexed_product(x, indices, layer.param_index)
+
+            with torch.no_grad():
+                loop_time = time_call(loop, 1)
+                batched_time = time_call(batched, args.repeat)
+            record("indexed", dict(batch=batch_size, quantiles=num_quantiles, size=args.size), loop_ms=loop_time * 1000, batched_ms=batched_time * 1000)
+            print("{:>8} {:>10} {:>14.3f} {:>14.3f} {:>9.1f}x".format(
+                batch_size, num_quantiles, loop_time * 1000, batched_time * 1000, loop_time / batched_time))
+
+
+def bench_indexed_backward(args):
+    """ Generic autograd gather/einsum against IndexedProduct, dense and sparse, with the optimizer step """
+    print("{:>8} {:>10} {:>14} {:>14} {:>14}".format("batch", "quantiles", "autograd (ms)", "dense (ms)", "sparse (ms)"))
+    for num_quantiles in args.quantiles:
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, args.size)
+            indices = torch.randint(0, num_quantiles, (batch_size, args.size))
+            features = torch.arange(args.size)
+            timings = []
+            for mode in ["autograd", "dense", "sparse"]:
+                bank = torch.nn.Parameter(torch.randn(num_quantiles, args.size, args.size))
+                optimizer = customlayers.SparseAdadelta([bank])
+
+                def step():
+                    optimizer.zero_grad()
+                    if mode == "autograd":
+                        output = torch.einsum('bi,bio->bo', x, bank[indices, features])
+                    else:
+                        output = customlayers.indexed_product(x, indices, bank, mode == "sparse")
+                    output.sum().backward()
+                    optimizer.step()
+
+                timings.append(time_call(step, args.repeat))
+            record("indexed_backward", dict(batch=batch_size, quantiles=num_quantiles, size=args.size),
+                   autograd_ms=timings[0] * 1000, dense_ms=timings[1] * 1000, sparse_ms=timings[2] * 1000)
+            print("{:>8} {:>10} {:>14.3f} {:>14.3f} {:>14.3f}".format(
+                batch_size, num_quantiles, *[t * 1000 for t in timings]))
+
+
+def bench_delta_bank(args):
+    """ Bank memory (parameters and Adadelta state) and training step time of the full bank against the low-rank and scale/shift deltas """
+    print("{:>6} {:>10} {:>8} {:>10} {:>12} {:>12}".format("size", "quantiles", "batch", "bank", "memory (MB)", "step (ms)"))
+    for size in args.sizes:
+        for num_quantiles in args.quantiles:
+            for batch_size in args.batch_sizes:
+                x = torch.randn(batch_size, size)
+                indices = torch.randint(0, num_quantiles, (batch_size, size))
+                for bank in customlayers.BANK_KINDS:
+                    layer = customlayers.IndexedLinearLayer(size, size, num_quantiles, bank=bank, bank_rank=args.bank_rank)
+                    layer.set_use_indices(True)
+                    #As in eidetic training only the bank learns, the shared weights stay frozen
+                    layer.weights.requires_grad = False
+                    optimizer = torch.optim.Adadelta(layer.bank_parameters())
+
+                    def step():
+                        optimizer.zero_grad()
+                        layer(x, indices).sum().backward()
+                        optimizer.step()
+
+                    elapsed = time_call(step, args.repeat)
+                    memory = sum(p.nbytes for p in layer.bank_parameters()) + sum(t.nbytes for state in optimizer.state.values() for t in state.values() if torch.is_tensor(t))
+                    record("delta_bank", dict(size=size, quantiles=num_quantiles, batch=batch_size, bank=bank, rank=args.bank_rank),
+                           memory_mb=memory / 1e6, step_ms=elapsed * 1000)
+                    print("{:>6} {:>10} {:>8} {:>10} {:>12.3f} {:>12.3f}".format(size, num_quantiles, batch_size, bank, memory / 1e6, elapsed * 1000))
+
+
+def bench_conv(args):
+    """ EideticConv2d forward, plain, storing, bucketing and indexed with the full and scale banks, against nn.Conv2d on main.Net's conv2 shape """
+    in_channels, out_channels, size = 32, 64, 26
+    print("{:>8} {:>10} {:>10} {:>14} {:>14} {:>10}".format("batch", "quantiles", "mode", "latency (ms)", "samples/s", "vs conv"))
+    for num_quantiles in args.quantiles:
+        for batch_size in args.conv_batch_sizes:
+            x = torch.randn(batch_size, in_channels, size, size)
+            conv = torch.nn.Conv2d(in_channels, out_channels, 3)
+            layers = {}
+            for bank in ["full", "scale"]:
+                layers[bank] = customlayers.EideticConv2d(in_channels, out_channels, 3, 1.0, 10000, num_quantiles, 2, bank=bank)
+                with torch.no_grad():
+                    layers[bank](x, None, True, False, False)
+                    layers[bank].calculate_n_quantiles(num_quantiles, False)
+            #Input bucket ids as a previous EideticConv2d would give them; bucketing is timed on its own, not in the indexed modes
+            indices = torch.randint(0, num_quantiles, x.shape)
+
+            def run(store, get_indices, use_indices, bank="full"):
+                def call():
+                    layers[bank].set_use_indices(use_indices)
+                    return layers[bank](x, indices, store, get_indices, False)
+                return call
+
+            modes = {"conv": lambda: conv(x), "plain": run(False, False, False), "store": run(True, False, False),
+                     "bucketing": run(False, True, False), "indexed": run(False, False, True), "scale": run(False, False, True, "scale")}
+            with torch.no_grad():
+                timings = {mode: time_call(call, args.repeat) for mode, call in modes.items()}
+            for mode, latency in timings.items():
+                record("conv", dict(batch=batch_size, quantiles=num_quantiles, mode=mode), latency_ms=latency * 1000, samples_per_s=batch_size / latency)
+                print("{:>8} {:>10} {:>10} {:>14.3f} {:>14.0f} {:>9.1f}x".format(
+                    batch_size, num_quantiles, mode, latency * 1000, batch_size / latency, latency / timings["conv"]))
+
+
+def bench_store(args):
+    """ Per-row numpy copy of outputValues against ActivationStore.add """
+    print("{:>8} {:>14} {:>14} {:>10}".format("batch", "loop (ms)", "store (ms)", "speedup"))
+    for batch_size in args.batch_sizes:
+        activations = torch.randn(batch_size, args.size)
+        capacity = batch_size * (args.repeat + 1)
+
+        outputValues = np.zeros([capacity, args.size])
+        state = {"index": 0}
+
+        def loop():
+            for activation_vector in activations.detach().cpu().numpy():
+                outputValues[state["index"]] = activation_vector
+                state["index"] = state["index"] + 1
+
+        store = customlayers.ActivationStore(capacity, args.size)
+        loop_time = time_call(loop, args.repeat)
+        store_time = time_call(lambda: store.add(activations), args.repeat)
+        record("store", dict(batch=batch_size, size=args.size), loop_ms=loop_time * 1000, store_ms=store_time * 1000)
+        print("{:>8} {:>14.3f} {:>14.3f} {:>9.1f}x".format(
+            batch_size, loop_time * 1000, store_time * 1000, loop_time / store_time))
+
+
+def bench_sketch(args):
+    """ Streaming QuantileSketch accuracy, memory and update time against exact quantiles """
+    samples, num_quantiles = args.samples, args.quantiles[-1]
+    activations = torch.randn(samples, args.size) * torch.linspace(0.5, 3.0, args.size)
+    exact = activations.sort(dim=0).values
+    fractions = torch.arange(1, num_quantiles, dtype=torch.float64) / num_quantiles
+    print("{:>8} {:>10} {:>14} {:>12} {:>12}".format("k", "items", "update (ms)", "rank error", "bound"))
+    for k in args.sketch_sizes:
+        sketch = customlayers.QuantileSketch(args.size, k)
+        batch_size = args.batch_sizes[-1]
+        start = time.perf_counter()
+        for batch in range(0, samples, batch_size):
+            sketch.update(activations[batch:batch + batch_size])
+        update_time = (time.perf_counter() - start) / math.ceil(samples / batch_size)
+
+        thresholds = sketch.quantiles(num_quantiles)
+        ranks = (exact.unsqueeze(2) <= thresholds.unsqueeze(0)).sum(0).double() / samples
+        items = sum(level.shape[1] for level in sketch.levels)
+        record("sketch", dict(k=k, samples=samples, quantiles=num_quantiles, size=args.size),
+               update_ms=update_time * 1000, items=items, rank_error=(ranks - fractions).abs().max().item())
+        print("{:>8} {:>10} {:>14.3f} {:>12.4f} {:>12.4f}".format(
+            k, items, update_time * 1000, (ranks - fractions).abs().max().item(), sketch.error_bound()))
+
+
+def bench_quantiles(args):
+    """ Per-column argsort and reindex of outputValues against the single-pass exact_quantiles """
+    num_quantiles = args.quantiles[-1]
+    outputValues = np.random.randn(args.samples, args.size).astype(np.float32)
+
+    def loop():
+        values = outputValues
+        val = int(args.samples / num_quantiles)
+        quantiles = []
+        for j in range(0, args.size):
+            values = values[values[:, j].argsort(kind='mergesort')]
+            quantiles.append([values[val * (i + 1)][j] for i in range(0, num_quantiles - 1)])
+        return np.array(quantiles)
+
+    loop_time = time_call(loop, 1)
+    print("{:>8} {:>8} {:>10} {:>14} {:>14} {:>10}".format(
+        "samples", "size", "quantiles", "loop (ms)", "interpolation", "ms"))
+    for interpolation in ["index", "disc", "linear"]:
+        batched_time = time_call(lambda: customlayers.exact_quantiles(outputValues, num_quantiles, interpolation), args.repeat)
+        record("quantiles", dict(samples=args.samples, size=args.size, quantiles=num_quantiles, interpolation=interpolation),
+               loop_ms=loop_time * 1000, batched_ms=batched_time * 1000)
+        print("{:>8} {:>8} {:>10} {:>14.1f} {:>14} {:>10.1f}".format(
+            args.samples, args.size, num_quantiles, loop_time * 1000, interpolation, batched_time * 1000))
+
+
+def bench_db_insert(args):
+    """ Per-sample INSERT statements against buffered COPY ingestion, on the database configured in .env """
+    import db
+    import psycopg2
+    try:
+        database = db.Database(flush_size=args.samples)
+    except psycopg2.OperationalError as error:
+        print("skipped, no database: " + str(error).strip())
+        return
+
+    samples = min(args.samples, 20000)
+    records = np.random.randn(samples, args.size).astype(np.float32)
+
+    def loop():
+        cursor = database.connection.cursor()
+        for record in records:
+            values = ",".join("(" + str(i + 1) + ", " + str(val) + ")" for i, val in enumerate(record))
+            cursor.execute("INSERT INTO percentile_activations_0(node_id, activation) values " + values + ";")
+
+    print("{:>10} {:>14} {:>14}".format("method", "samples", "rows/s"))
+    database.recreate_tables(2, 0)
+    loop_time = time_call(loop, 1)
+    record("db_insert", dict(method="insert", samples=samples, size=args.size), rows_per_s=samples * args.size / loop_time)
+    print("{:>10} {:>14} {:>14.0f}".format("insert", samples, samples * args.size / loop_time))
+    for copy_format in ["text", "binary"]:
+        database.copy_format = copy_format
+        database.recreate_tables(2, 0)
+        copy_time = time_call(lambda: (database.insert_records(records, 0), database.flush()), 1)
+        record("db_insert", dict(method=copy_format, samples=samples, size=args.size), rows_per_s=samples * args.size / copy_time)
+        print("{:>10} {:>14} {:>14.0f}".format(copy_format, samples, samples * args.size / copy_time))
+    database.close()
+
+
+def bench_memmap(args):
+    """ Appending to a MemmapActivationStore and a blocked exact quantile pass over the file """
+    import tempfile
+    import os
+    batch_size, num_quantiles = args.batch_sizes[-1], args.quantiles[-1]
+    with tempfile.TemporaryDirectory() as directory:
+        store = customlayers.MemmapActivationStore(os.path.join(directory, "activations_0.npy"), args.size)
+        activations = torch.randn(batch_size, args.size)
+        start = time.perf_counter()
+        for _ in range(0, args.samples, batch_size):
+            store.add(activations)
+        append_time = time.perf_counter() - start
+        quantile_time = time_call(lambda: customlayers.exact_quantiles(store.numpy(), num_quantiles, block_bytes=args.block_bytes), 1)
+        store.close()
+    record("memmap", dict(samples=store.count, size=args.size, quantiles=num_quantiles), append_rows_per_s=store.count / append_time, quantiles_ms=quantile_time * 1000)
+    print("{:>10} {:>8} {:>14} {:>16}".format("samples", "size", "append rows/s", "quantiles (ms)"))
+    print("{:>10} {:>8} {:>14.0f} {:>16.1f}".format(store.count, args.size, store.count / append_time, quantile_time * 1000))
+
+
+def bench_db_layouts(args):
+    """ Row count, on-disk size, COPY and distribution time of the long and wide activation tables """
+    import db
+    import psycopg2
+    samples, num_quantiles = min(args.samples, 50000), args.quantiles[-1]
+    records = np.random.randn(samples, args.size).astype(np.float32)
+    print("{:>8} {:>10} {:>12} {:>12} {:>18} {:>14}".format("layout", "rows", "size (kB)", "copy (ms)", "distribution (ms)", "10% (ms)"))
+    for layout in ["long", "wide"]:
+        try:
+            database = db.Database(flush_size=samples, layout=layout)
+        except psycopg2.OperationalError as error:
+            print("skipped, no database: " + str(error).strip())
+            return
+
+        database.recreate_tables(num_quantiles, 0)
+        copy_time = time_call(lambda: database.insert_records(records, 0), 1)
+        cursor = database.connection.cursor()
+        cursor.execute("select count(*), pg_total_relation_size('percentile_activations_0') from percentile_activations_0")
+        rows, size = cursor.fetchone()
+        distribution_time = time_call(lambda: database.create_quantile_distribution(num_quantiles, 0), 3)
+        sampled_time = time_call(lambda: database.create_quantile_distribution(num_quantiles, 0, sample_percent=10), 3)
+        record("db_layouts", dict(layout=layout, samples=samples, size=args.size, quantiles=num_quantiles), rows=rows, size_kb=size / 1024,
+               copy_ms=copy_time * 1000, distribution_ms=distribution_time * 1000, sampled_distribution_ms=sampled_time * 1000)
+        print("{:>8} {:>10} {:>12.0f} {:>12.1f} {:>18.1f} {:>14.1f}".format(
+            layout, rows, size / 1024, copy_time * 1000, distribution_time * 1000, sampled_time * 1000))
+        database.close()
+
+
+def bench_index_cache(args):
+    """ Bucketing every epoch against the IndexCache, for a working set that fits and one twice its capacity """
+    print("{:>8} {:>10} {:>10} {:>14} {:>14} {:>10} {:>10}".format("batch", "quantiles", "capacity", "bucketize (ms)", "cached (ms)", "hit rate", "kB"))
+    samples = min(args.samples, 20000)
+    for num_quantiles in args.quantiles:
+        layer = make_eidetic_layer(args.size, num_quantiles)
+        activations = torch.randn(samples, args.size)
+        sample_ids = torch.arange(samples)
+        for capacity in [samples, samples // 2]:
+            for batch_size in args.batch_sizes[-1:]:
+                cache = customlayers.IndexCache(capacity, args.size)
+
+                def epoch(bucket):
+                    for start in range(0, samples, batch_size):
+                        bucket(activations[start:start + batch_size], sample_ids[start:start + batch_size])
+
+                def uncached(rows, ids):
+                    return customlayers.bucketize(rows, layer.quantiles, layer.quantiles_increasing)
+
+                def cached(rows, ids):
+                    return customlayers.cached_bucketize(cache, layer.index_key(), rows, layer.quantiles, layer.quantiles_increasing, ids)
+
+                epoch(cached)
+                cache.hits = cache.misses = 0
+                uncached_time = time_call(lambda: epoch(uncached), 3)
+                cached_time = time_call(lambda: epoch(cached), 3)
+                memory = sum(buffer.numel() * buffer.element_size() for buffer in cache.buffers())
+                record("index_cache", dict(batch=batch_size, quantiles=num_quantiles, capacity=capacity, samples=samples, size=args.size),
+                       bucketize_ms=uncached_time * 1000, cached_ms=cached_time * 1000, hit_rate=cache.hits / (cache.hits + cache.misses), memory_kb=memory / 1024)
+                print("{:>8} {:>10} {:>10} {:>14.3f} {:>14.3f} {:>10.2f} {:>10.0f}".format(
+                    batch_size, num_quantiles, capacity, uncached_time * 1000, cached_time * 1000, cache.hits / (cache.hits + cache.misses), memory / 1024))
+
+
+def bench_store_dtype(args):
+    """ Bytes per sample and threshold error of each ActivationStore dtype against float32, with the stated bounds """
+    samples, num_quantiles = min(args.samples, 50000), args.quantiles[-1]
+    batch_size = args.batch_sizes[-1]
+    #Per-neuron shifted and scaled activations, streamed in batches so the integer ranges widen
+    shift, spread = torch.rand(args.size) * 10 - 5, torch.rand(args.size) * 10
+    distributions = {"normal": torch.randn(samples, args.size) * spread + shift, "lognormal": torch.randn(samples, args.size).exp() * spread + shift}
+    print("{:>10} {:>10} {:>14} {:>10} {:>12} {:>12} {:>16}".format("data", "dtype", "bytes/sample", "add (ms)", "max error", "bound", "same bucket (%)"))
+    for name, activations in distributions.items():
+        exact = np.ascontiguousarray(customlayers.exact_quantiles(activations.numpy(), num_quantiles))
+        exact_buckets = customlayers.bucketize(activations, torch.from_numpy(exact).float())
+        for dtype in customlayers.STORE_DTYPES:
+            store = customlayers.ActivationStore(samples, args.size, dtype=dtype)
+            start = time.perf_counter()
+            for offset in range(0, samples, batch_size):
+                store.add(activations[offset:offset + batch_size])
+            add_time = time.perf_counter() - start
+            thresholds = np.ascontiguousarray(customlayers.exact_quantiles(store.numpy(), num_quantiles))
+            error = np.abs(thresholds - exact)
+            if dtype == "float16":
+                bound = np.abs(exact) * 2.0 ** -11
+            elif dtype == "bfloat16":
+                bound = np.abs(exact) * 2.0 ** -8
+            elif store.quantized:
+                bound = 1.5 * store.scale.numpy()[:, None] + np.zeros_like(exact)
+            else:
+                bound = np.zeros_like(exact)
+            same = customlayers.bucketize(activations, torch.from_numpy(thresholds).float()).eq(exact_buckets).float().mean()
+            record("store_dtype", dict(data=name, dtype=dtype, samples=samples, size=args.size, quantiles=num_quantiles),
+                   add_ms=add_time * 1000, bytes_per_sample=store.values.element_size() * args.size, max_error=float(error.max()), same_bucket=float(same))
+            print("{:>10} {:>10} {:>14} {:>10.1f} {:>12.3g} {:>12.3g} {:>16.3f}".format(
+                name, dtype, store.values.element_size() * args.size, add_time * 1000, error.max(), bound.max(), same * 100))
+
+
+def bench_layers(args):
+    """ Forward and forward+backward time of the three layer types across widths, batch sizes, NUM_QUANTILES and use_indices """
+    print("{:>16} {:>6} {:>8} {:>10} {:>8} {:>14} {:>14}".format("layer", "size", "batch", "quantiles", "indices", "forward (ms)", "backward (ms)"))
+    for size in args.sizes:
+        for num_quantiles in args.quantiles:
+            eidetic = make_eidetic_layer(size, num_quantiles)
+            eidetic_indexed = make_eidetic_layer(size, num_quantiles, indexed=True)
+            indexed = customlayers.IndexedLinearLayer(size, size, num_quantiles)
+            for batch_size in args.batch_sizes:
+                x = torch.randn(batch_size, size)
+                indices = torch.randint(0, num_quantiles, (batch_size, size))
+                #use_indices is get_indices for EideticLinearLayer, which has no bank
+                for use_indices in [False, True]:
+                    eidetic_indexed.set_use_indices(use_indices)
+                    indexed.set_use_indices(use_indices)
+                    calls = {
+                        "eidetic": lambda: eidetic(x, False, use_indices, False)[0],
+                        "eidetic_indexed": lambda: eidetic_indexed(x, indices, False, use_indices, False)[0],
+                        "indexed": lambda: indexed(x, indices),
+                    }
+                    for name, call in calls.items():
+                        with torch.no_grad():
+                            forward_time = time_call(call, args.repeat)
+                        backward_time = time_call(lambda: call().sum().backward(), args.repeat)
+                        record("layers", dict(layer=name, size=size, batch=batch_size, quantiles=num_quantiles, use_indices=use_indices),
+                               forward_ms=forward_time * 1000, backward_ms=backward_time * 1000)
+                        print("{:>16} {:>6} {:>8} {:>10} {:>8} {:>14.3f} {:>14.3f}".format(
+                            name, size, batch_size, num_quantiles, str(use_indices), forward_time * 1000, backward_time * 1000))
+
+
+def bench_refresh(args):
+    """ calculate_n_quantiles from a full in-memory store and build_index, across widths and NUM_QUANTILES """
+    samples = min(args.samples, 50000)
+    print("{:>6} {:>10} {:>10} {:>18} {:>18}".format("size", "samples", "quantiles", "quantiles (ms)", "build_index (ms)"))
+    for size in args.sizes:
+        activations = torch.randn(samples, size)
+        for num_quantiles in args.quantiles:
+            layer = customlayers.EideticIndexedLinearLayer(size, size, 1.0, samples - 1, num_quantiles, 2)
+            layer.activations.add(activations)
+            quantile_time = time_call(lambda: layer.calculate_n_quantiles(num_quantiles, False), 3)
+            build_time = time_call(lambda: layer.build_index(num_quantiles), args.repeat)
+            record("refresh", dict(size=size, samples=samples, quantiles=num_quantiles), quantiles_ms=quantile_time * 1000, build_index_ms=build_time * 1000)
+            print("{:>6} {:>10} {:>10} {:>18.1f} {:>18.3f}".format(size, samples, num_quantiles, quantile_time * 1000, build_time * 1000))
+
+
+def fake_datasets():
+    """ Stands in for main.load_datasets: FakeData of MNIST/EMNIST letters shape, so the schedule runs offline """
+    from torchvision import datasets, transforms
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))])
+    return (datasets.FakeData(60000, (1, 28, 28), 10, transform), datasets.FakeData(10000, (1, 28, 28), 10, transform),
+            datasets.FakeData(124800, (1, 28, 28), 27, transform, random_offset=60000))
+
+
+def example_config():
+    """ config.get() with whatever .env and the environment leave unset taken from example.env """
+    from dotenv import load_dotenv
+    load_dotenv()
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "example.env"))
+    return config.reload()
+
+
+def bench_import(args):
+    """ Cold start of a fresh interpreter: importing customlayers and main and building a Net, with USE_DB=True and an unreachable database """
+    import tempfile
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import customlayers\n"
+            "layers = time.perf_counter()\n"
+            "import main\n"
+            "imported = time.perf_counter()\n"
+            "main.Net()\n"
+            "built = time.perf_counter()\n"
+            "print(layers - start, imported - layers, built - imported, 'psycopg2' in sys.modules)\n")
+    environ = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), USE_DB="True", HOST="192.0.2.1", PORT="5432")
+    best = None
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(max(args.repeat // 5, 3)):
+            output = subprocess.run([sys.executable, "-c", code], cwd=directory, env=environ, capture_output=True, text=True, check=True, timeout=120).stdout.split()
+            timings = [float(value) for value in output[:3]]
+            best = timings if best is None or sum(timings) < sum(best) else best
+        connected, files = output[3] == "True", sorted(os.listdir(directory))
+
+    record("import", {}, customlayers_ms=best[0] * 1000, main_ms=best[1] * 1000, net_ms=best[2] * 1000)
+    print("{:>18} {:>12} {:>10} {:>16} {:>14}".format("customlayers (ms)", "main (ms)", "Net (ms)", "psycopg2 loaded", "files written"))
+    print("{:>18.1f} {:>12.1f} {:>10.1f} {:>16} {:>14}".format(best[0] * 1000, best[1] * 1000, best[2] * 1000, str(connected), ", ".join(files) or "none"))
+
+
+def bench_main(args):
+    """ Samples/s of the whole main() schedule (--main-args) on FakeData, counting every sample through the eidetic head """
+    import contextlib
+    import io
+    import main as eidetic_main
+    #Hyperparameters missing from .env fall back to the example configuration
+    settings = example_config()
+
+    counted = {"samples": 0}
+
+    def count(module, inputs):
+        if isinstance(module, customlayers.EideticLinearLayer):
+            counted["samples"] = counted["samples"] + len(inputs[0])
+
+    load_datasets, argv = eidetic_main.load_datasets, sys.argv
+    eidetic_main.load_datasets, sys.argv = fake_datasets, ["main.py"] + args.main_args.split()
+    handle = torch.nn.modules.module.register_module_forward_pre_hook(count)
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            eidetic_main.main()
+        elapsed = time.perf_counter() - start
+    finally:
+        handle.remove()
+        eidetic_main.load_datasets, sys.argv = load_datasets, argv
+
+    record("main", dict(args=args.main_args, num_quantiles=settings.num_quantiles, use_db=settings.use_db),
+           total_ms=elapsed * 1000, samples=counted["samples"], samples_per_s=counted["samples"] / elapsed)
+    print("{:>30} {:>10} {:>12} {:>12}".format("args", "samples", "seconds", "samples/s"))
+    print("{:>30} {:>10} {:>12.2f} {:>12.0f}".format(args.main_args, counted["samples"], elapsed, counted["samples"] / elapsed))
+
+
+def distributed_worker(rank, world_size, argv, init_method, results):
+    """ One rank of the distributed benchmark: main.run on FakeData, reporting samples through the eidetic head, seconds and a hash of the state dict """
+    import contextlib
+    import hashlib
+    import io
+    import main as eidetic_main
+    eidetic_main.load_datasets = fake_datasets
+    counted = {"samples": 0}
+
+    def count(module, inputs):
+        if isinstance(module, customlayers.EideticLinearLayer):
+            counted["samples"] = counted["samples"] + len(inputs[0])
+
+    handle = torch.nn.modules.module.register_module_forward_pre_hook(count)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = eidetic_main.run(rank, world_size, eidetic_main.parse_args(argv), init_method)
+    elapsed = time.perf_counter() - start
+    handle.remove()
+    #Every parameter and buffer, so the delta banks of --bank lowrank/scale are compared too
+    digest = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode() + tensor.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+    digest = digest.hexdigest()
+    results.put((rank, counted["samples"], elapsed, digest))
+
+
+def bench_distributed(args):
+    """ Samples/s of the main() schedule (--main-args) on FakeData in 1..N data-parallel processes, checking every rank ends with the same state dict: thresholds, banks and weights """
+    import main as eidetic_main
+    #The spawned ranks inherit the environment
+    example_config()
+
+    context = torch.multiprocessing.get_context("spawn")
+    base = None
+    print("{:>10} {:>10} {:>10} {:>12} {:>9} {:>10}".format("processes", "samples", "seconds", "samples/s", "speedup", "identical"))
+    for processes in args.processes:
+        results = context.SimpleQueue()
+        torch.multiprocessing.spawn(distributed_worker, args=(processes, args.main_args.split(), "tcp://127.0.0.1:" + str(eidetic_main.free_port()), results), nprocs=processes)
+        ranks = [results.get() for _ in range(processes)]
+        samples, elapsed = sum(rank[1] for rank in ranks), max(rank[2] for rank in ranks)
+        identical = len(set(rank[3] for rank in ranks)) == 1
+        base = base or samples / elapsed
+        record("distributed", dict(args=args.main_args, processes=processes), total_ms=elapsed * 1000, samples=samples, samples_per_s=samples / elapsed, identical=identical)
+        print("{:>10} {:>10} {:>10.2f} {:>12.0f} {:>8.2f}x {:>10}".format(processes, samples, elapsed, samples / elapsed, samples / elapsed / base, str(identical)))
+
+
+def bench_metrics(args):
+    """ Eidetic layer forward with the metrics recorder disabled (the no-op default) and enabled """
+    import metrics
+    print("{:>8} {:>10} {:>14} {:>14} {:>10}".format("batch", "quantiles", "disabled (ms)", "enabled (ms)", "overhead"))
+    for num_quantiles in args.quantiles:
+        layer = make_eidetic_layer(args.size, num_quantiles)
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, args.size)
+            timings = []
+            for enabled in [False, True]:
+                recorder, metrics.recorder = metrics.recorder, metrics.Metrics(enabled)
+                with torch.no_grad():
+                    timings.append(time_call(lambda: layer(x, True, True, False), args.repeat))
+                metrics.recorder = recorder
+            record("metrics", dict(batch=batch_size, quantiles=num_quantiles, size=args.size), disabled_ms=timings[0] * 1000, enabled_ms=timings[1] * 1000)
+            print("{:>8} {:>10} {:>14.3f} {:>14.3f} {:>9.1f}%".format(
+                batch_size, num_quantiles, timings[0] * 1000, timings[1] * 1000, (timings[1] / timings[0] - 1) * 100))
+
+
+def make_indexed_net(num_quantiles):
+    """ main.Net with task B thresholds from random images and a perturbed weight bank, evaluated with indices """
+    import main as eidetic_main
+    example_config()
+
+    net = eidetic_main.Net(num_quantiles=num_quantiles).eval()
+    with torch.no_grad():
+        net(torch.randn(2000, 1, 28, 28), [False, True], [False, False], [False, False])
+        net.calculate_n_quantiles(num_quantiles, False, "2")
+        net.index_layers(num_quantiles, "2")
+        net.use_indices(True, "2")
+        net.indexed.param_index.add_(torch.randn_like(net.indexed.param_index) * 0.1)
+    return net
+
+
+def bench_frozen(args):
+    """ Net.forward against the frozen inference module, eager, TorchScript and torch.compile, at each batch size """
+    num_quantiles = args.quantiles[-1]
+    net = make_indexed_net(num_quantiles)
+    frozen = net.freeze([False, True])
+    models = {"net": lambda x: net(x, [False, False], [False, True], [False, False]), "frozen": frozen, "script": torch.jit.script(frozen)}
+    try:
+        compiled = torch.compile(frozen)
+        with torch.no_grad():
+            compiled(torch.randn(2, 1, 28, 28))
+        models["compile"] = compiled
+    except Exception as error:
+        print("torch.compile unavailable: " + type(error).__name__)
+
+    #The conv backbone dominates whole-model time, so the eidetic head is also timed on its own from fc2 features
+    scripted = models["script"]
+    heads = {"net": lambda x: net.head(x, [False, False], [False, True], [False, False]), "frozen": frozen.head, "script": scripted.head}
+
+    print("{:>8} {:>6} {:>10} {:>14} {:>14} {:>12}".format("batch", "part", "model", "latency (ms)", "samples/s", "max diff"))
+    for batch_size in args.batch_sizes:
+        images = torch.randn(batch_size, 1, 28, 28)
+        with torch.no_grad():
+            features = net.backbone(images)
+            for part, calls, x in [("model", models, images), ("head", heads, features)]:
+                reference = calls["net"](x)
+                for name, model in calls.items():
+                    difference = (model(x) - reference).abs().max().item()
+                    latency = time_call(lambda: model(x), args.repeat)
+                    record("frozen", dict(batch=batch_size, part=part, model=name, quantiles=num_quantiles), latency_ms=latency * 1000, samples_per_s=batch_size / latency, max_diff=difference)
+                    print("{:>8} {:>6} {:>10} {:>14.3f} {:>14.0f} {:>12.2g}".format(batch_size, part, name, latency * 1000, batch_size / latency, difference))
+
+
+def bench_quantized(args):
+    """ Float frozen bank layer against its int8 copies, per row and per bucket scales: bank memory, latency and error """
+    print("{:>6} {:>10} {:>8} {:>8} {:>10} {:>14} {:>10} {:>10}".format("size", "quantiles", "batch", "scales", "bank (MB)", "latency (ms)", "speedup", "rel err"))
+    for size in args.sizes:
+        for num_quantiles in args.quantiles:
+            layer = customlayers.IndexedLinearLayer(size, size, num_quantiles)
+            layer.set_use_indices(True)
+            with torch.no_grad():
+                layer.param_index.add_(torch.randn_like(layer.param_index) * 0.1)
+            frozen = {scales: customlayers.FrozenLinearLayer(layer, False, True, scales) for scales in [None] + list(customlayers.QUANTIZE_GRANULARITIES)}
+            for batch_size in args.batch_sizes:
+                x = torch.randn(batch_size, size)
+                indices = torch.randint(0, num_quantiles, (batch_size, size))
+                reference = frozen[None](x, indices)[0]
+                reference_time = time_call(lambda: frozen[None](x, indices), args.repeat)
+                for scales, model in frozen.items():
+                    error = ((model(x, indices)[0] - reference).abs().max() / reference.abs().max()).item()
+                    latency = time_call(lambda: model(x, indices), args.repeat)
+                    bank = (model.bank.nbytes + model.bank_scales.nbytes) / 1e6
+                    name = scales or "float"
+                    record("quantized", dict(size=size, quantiles=num_quantiles, batch=batch_size, scales=name), bank_mb=bank, latency_ms=latency * 1000, rel_err=error)
+                    print("{:>6} {:>10} {:>8} {:>8} {:>10.3f} {:>14.3f} {:>9.1f}x {:>10.2g}".format(
+                        size, num_quantiles, batch_size, name, bank, latency * 1000, reference_time / latency, error))
+
+
+def bench_tasks(args):
+    """ TaskBanks memory and task switch cost with a budget of --resident-tasks banks, for a growing number of tasks """
+    import tempfile
+    size, num_quantiles = args.sizes[-1], args.quantiles[-1]
+    x = torch.randn(args.batch_sizes[-1], size)
+
+    print("{:>8} {:>10} {:>14} {:>14} {:>16} {:>16}".format("tasks", "bank (MB)", "resident (MB)", "on disk (MB)", "resident (ms)", "paged in (ms)"))
+    for count in args.task_counts:
+        eidetic = make_eidetic_layer(size, num_quantiles, indexed=True)
+        indexed = customlayers.IndexedLinearLayer(size, size, num_quantiles)
+        with tempfile.TemporaryDirectory() as directory:
+            tasks = customlayers.TaskBanks(eidetic, indexed, directory, args.resident_tasks * indexed.param_index.nbytes * 1.01)
+            quantiles = eidetic.quantiles
+            for task in range(count):
+                tasks.add(task)
+                eidetic.set_quantiles(quantiles + 0.01 * task)
+                indexed.build_index(num_quantiles)
+                indexed.set_use_indices(True)
+                eidetic.use_indices = False
+
+            def forward(task):
+                tasks.activate(task)
+                with torch.no_grad():
+                    h, idxs = eidetic(x, None, False, True, False)
+                    indexed(h, idxs)
+
+            #Cycling through the resident tasks never touches the disk, through all of them always does once they exceed the budget
+            resident = list(tasks.resident)
+            resident_time = time_call(lambda: [forward(task) for task in resident], args.repeat) / len(resident)
+            paged_time = time_call(lambda: [forward(task) for task in range(count)], args.repeat) / count
+            disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1e6
+            bank = indexed.param_index.nbytes / 1e6
+            record("tasks", dict(tasks=count, size=size, quantiles=num_quantiles, resident_tasks=args.resident_tasks),
+                   resident_mb=tasks.resident_bytes() / 1e6, switch_resident_ms=resident_time * 1000, switch_paged_ms=paged_time * 1000)
+            print("{:>8} {:>10.2f} {:>14.2f} {:>14.2f} {:>16.3f} {:>16.3f}".format(count, bank, tasks.resident_bytes() / 1e6, disk, resident_time * 1000, paged_time * 1000))
+
+
+def bench_checkpoint(args):
+    """ Restart cost: redoing the activation pass, thresholds and index against loading a checkpoint, eagerly and memory-mapped """
+    import tempfile
+    import main as eidetic_main
+    samples = example_config().task_b_subset_cardinality
+    images = torch.randn(samples, 1, 28, 28)
+    flags = [False, False], [False, True], [False, False]
+
+    print("{:>10} {:>10} {:>14} {:>14} {:>14} {:>16}".format("quantiles", "size (MB)", "rebuild (ms)", "load (ms)", "mmap (ms)", "first batch (ms)"))
+    for num_quantiles in args.quantiles:
+        def rebuild():
+            net = eidetic_main.Net(num_quantiles=num_quantiles).eval()
+            with torch.no_grad():
+                net(images, [False, True], [False, False], [False, False])
+            net.calculate_n_quantiles(num_quantiles, False, "2")
+            net.index_layers(num_quantiles, "2")
+            net.use_indices(True, "2")
+            return net
+
+        start = time.perf_counter()
+        net = rebuild()
+        rebuild_time = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "checkpoint.pt")
+            eidetic_main.save_checkpoint(net, path, True)
+            size = os.path.getsize(path) / 1e6
+            load_time = time_call(lambda: eidetic_main.load_checkpoint(path, mmap=False), args.repeat)
+            mmap_time = time_call(lambda: eidetic_main.load_checkpoint(path), args.repeat)
+
+            #Load and answer one batch, the time until a restarted process can serve
+            def first_batch():
+                with torch.no_grad():
+                    eidetic_main.load_checkpoint(path)(images[:64], *flags)
+            first_time = time_call(first_batch, args.repeat)
+
+        record("checkpoint", dict(quantiles=num_quantiles, samples=samples), rebuild_ms=rebuild_time * 1000, load_ms=load_time * 1000,
+               mmap_ms=mmap_time * 1000, first_batch_ms=first_time * 1000, size_mb=size)
+        print("{:>10} {:>10.2f} {:>14.1f} {:>14.1f} {:>14.1f} {:>16.1f}".format(
+            num_quantiles, size, rebuild_time * 1000, load_time * 1000, mmap_time * 1000, first_time * 1000))
+
+
+def bench_serve(args):
+    """ serve.MicroBatcher latency and throughput under concurrent callers, for each maximum batch size """
+    import asyncio
+    import serve
+    model = make_indexed_net(args.quantiles[-1]).freeze([False, True])
+    images = list(np.random.default_rng(0).random((256, 28, 28), dtype=np.float32))
+
+    async def run(max_batch_size, concurrency, requests):
+        batcher = serve.MicroBatcher(model, "cpu", max_batch_size, args.max_wait_ms)
+        batcher.start()
+        counter = iter(range(requests))
+
+        async def client():
+            for i in counter:
+                await batcher.submit(images[i % len(images)])
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        await batcher.stop()
+        return dict(batcher.stats.snapshot(), requests_per_s=requests / elapsed)
+
+    print("{:>10} {:>12} {:>12} {:>10} {:>10} {:>14}".format("max batch", "concurrency", "mean batch", "p50 (ms)", "p99 (ms)", "requests/s"))
+    for max_batch_size in args.batch_sizes:
+        for concurrency in args.concurrency:
+            stats = asyncio.run(run(max_batch_size, concurrency, args.repeat * 100))
+            record("serve", dict(max_batch=max_batch_size, concurrency=concurrency, max_wait_ms=args.max_wait_ms),
+                   p50_ms=stats["p50_ms"], p99_ms=stats["p99_ms"], requests_per_s=stats["requests_per_s"], mean_batch=stats["mean_batch"])
+            print("{:>10} {:>12} {:>12.1f} {:>10.2f} {:>10.2f} {:>14.0f}".format(
+                max_batch_size, concurrency, stats["mean_batch"], stats["p50_ms"], stats["p99_ms"], stats["requests_per_s"]))
+
+
+def start_local_database(path):
+    """ Starts a throwaway Postgres under path with pgserver (pip install pgserver) and points db.Database at it """
+    import pgserver
+    server = pgserver.get_server(path)
+    os.environ.update(DATABASE="postgres", USER="postgres", PASSWORD="", HOST=os.path.abspath(path))
+    os.environ.pop("PORT", None)
+    config.reload()
+    return server
+
+
+def environment():
+    """ Versions and machine details stored next to the results """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "torch": torch.__version__, "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "threads": torch.get_num_threads(), "commit": commit,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(base_path, new_path, threshold):
+    """ Prints the change of every metric present in both result files and returns the number of regressions """
+    with open(base_path) as f:
+        base = {(row["benchmark"], " ".join(k + "=" + str(v) for k, v in sorted(row["params"].items()))): row["metrics"] for row in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {(row["benchmark"], " ".join(k + "=" + str(v) for k, v in sorted(row["params"].items()))): row["metrics"] for row in json.load(f)["results"]}
+
+    regressions = 0
+    print("{:<18} {:<64} {:<22} {:>12} {:>12} {:>9}".format("benchmark", "params", "metric", "base", "new", "change"))
+    for key in sorted(base.keys() & new.keys()):
+        for metric in sorted(base[key].keys() & new[key].keys()):
+            lower_is_better = metric.endswith("_ms")
+            if not lower_is_better and not metric.endswith("_per_s"):
+                continue
+            before, after = base[key][metric], new[key][metric]
+            change = after / before - 1 if before else 0.0
+            worse = change > threshold if lower_is_better else change < -threshold
+            regressions = regressions + int(worse)
+            print("{:<18} {:<64} {:<22} {:>12.4g} {:>12.4g} {:>8.1f}% {}".format(
+                key[0], key[1], metric, before, after, change * 100, "REGRESSION" if worse else ""))
+    print("\n{} matched rows, {} only in base, {} only in new, {} regressions above {:.0f}%".format(
+        len(base.keys() & new.keys()), len(base.keys() - new.keys()), len(new.keys() - base.keys()), regressions, threshold * 100))
+    return regressions
+
+
+BENCHMARKS = {
+    "bucketing": bench_bucketing,
+    "indexed": bench_indexed,
+    "indexed_backward": bench_indexed_backward,
+    "delta_bank": bench_delta_bank,
+    "conv": bench_conv,
+    "store": bench_store,
+    "sketch": bench_sketch,
+    "quantiles": bench_quantiles,
+    "db_insert": bench_db_insert,
+    "memmap": bench_memmap,
+    "db_layouts": bench_db_layouts,
+    "index_cache": bench_index_cache,
+    "store_dtype": bench_store_dtype,
+    "layers": bench_layers,
+    "refresh": bench_refresh,
+    "import": bench_import,
+    "main": bench_main,
+    "metrics": bench_metrics,
+    "frozen": bench_frozen,
+    "quantized": bench_quantized,
+    "tasks": bench_tasks,
+    "checkpoint": bench_checkpoint,
+    "serve": bench_serve,
+    "distributed": bench_distributed,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Eidetic layer benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--size', type=int, default=36,
+                        help='layer width (default: 36)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 64, 1024],
+                        help='batch sizes to sweep')
+    parser.add_argument('--conv-batch-sizes', type=int, nargs='+', default=[1, 16, 64],
+                        help='batch sizes of the conv benchmark (default: 1 16 64)')
+    parser.add_argument('--quantiles', type=int, nargs='+', default=[2, 3, 8, 32],
+                        help='NUM_QUANTILES values to sweep')
+    parser.add_argument('--samples', type=int, default=100000,
+                        help='activation vectors streamed by the quantile benchmarks')
+    parser.add_argument('--sketch-sizes', type=int, nargs='+', default=[64, 200, 800],
+                        help='QuantileSketch k values to sweep')
+    parser.add_argument('--block-bytes', type=int, default=1 << 28,
+                        help='column block size of out-of-core quantile passes')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed repetitions per measurement (default: 20)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[36, 256],
+                        help='layer widths swept by the layers, refresh and delta_bank benchmarks')
+    parser.add_argument('--main-args', default='--batch-size 64',
+                        help='arguments of the main() run timed by the main benchmark (default: "--batch-size 64")')
+    parser.add_argument('--bank-rank', type=int, default=4,
+                        help='rank of the low-rank bank in the delta_bank benchmark (default: 4)')
+    parser.add_argument('--task-counts', type=int, nargs='+', default=[4, 16, 64],
+                        help='numbers of registered tasks in the tasks benchmark')
+    parser.add_argument('--resident-tasks', type=int, default=4,
+                        help='banks kept in memory by the tasks benchmark (default: 4)')
+    parser.add_argument('--processes', type=int, nargs='+', default=sorted({1, 2, os.cpu_count() or 1}),
+                        help='process counts of the distributed benchmark')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64],
+                        help='concurrent callers of the serve benchmark')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0,
+                        help='micro-batch wait of the serve benchmark (default: 2)')
+    parser.add_argument('--local-db', metavar='DIR',
+                        help='run the database benchmarks against a throwaway pgserver Postgres in DIR')
+    parser.add_argument('--json', metavar='PATH',
+                        help='write the results and environment as JSON to PATH')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two --json result files instead of running, exits 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression by --compare (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+
+    server = start_local_database(args.local_db) if args.local_db else None
+    torch.manual_seed(0)
+    for name in args.benchmarks:
+        print("\n" + name)
+        BENCHMARKS[name](args)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"environment": environment(), "args": vars(args), "results": RESULTS}, f, indent=1)
+    if server is not None:
+        server.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import dataclasses
+import os
+import typing
+
+
+@dataclasses.dataclass(frozen=True)
+class Config():
+    """ Settings read from the environment and .env, see example.env; resolved once per process by get """
+    use_db: bool = False
+    database: str = "eidetic"
+    user: str = "postgres"
+    password: str = ""
+    host: str = "localhost"
+    port: typing.Optional[int] = None
+    db_flush_size: int = 10000
+    db_layout: str = "long"
+    db_dtype: str = "float64"
+    db_sample_percent: typing.Optional[float] = None
+    db_row_cap: typing.Optional[int] = None
+    activation_dir: typing.Optional[str] = None
+    task_a_subset_cardinality: int = 5000
+    task_b_subset_cardinality: int = 1500
+    num_quantiles: int = 8
+    device: str = "cpu"
+
+    @classmethod
+    def from_env(cls, environ=None):
+        """ Config from environ (default os.environ), each field from its upper-case name; unset or empty values keep the default """
+        environ = os.environ if environ is None else environ
+        values = {}
+        for field in dataclasses.fields(cls):
+            value = environ.get(field.name.upper())
+            if value is None or value == "":
+                continue
+            kind = typing.get_args(field.type)[0] if typing.get_origin(field.type) is typing.Union else field.type
+            if kind is bool:
+                value = value.strip().lower() in ("true", "1", "yes")
+            else:
+                try:
+                    value = kind(value)
+                except ValueError:
+                    raise ValueError(field.name.upper() + "=" + repr(value) + " is not a valid " + kind.__name__) from None
+            values[field.name] = value
+        return cls(**values)
+
+
+_config = None
+
+
+def get():
+    """ The process's Config, read from the environment and .env on first use """
+    global _config
+    if _config is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _config = Config.from_env()
+    return _config
+
+
+def reload():
+    """ Reads the environment again, for code that changes it after the first get """
+    global _config
+    _config = None
+    return get()
@@ -1,76 +1,834 @@
 import torch
+import collections
 import math
 import torch.nn as nn
-import random
+import torch.nn.functional as F
+import torch.distributed as dist
 import numpy as np
-import sys
 import db
-import logging
-np.set_printoptions(threshold=sys.maxsize)
+import metrics
 import os
 
-from dotenv import load_dotenv
-load_dotenv()
+def distributed():
+    """ True inside a torch.distributed process group of more than one rank """
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
 
-logging.basicConfig(filename='network.log', filemode='a', level=logging.DEBUG)
-logging.info("Started")
+def quantiles_increasing(quantiles):
+    """ True when every neuron's thresholds are strictly increasing, i.e. safe for searchsorted """
+    return bool((quantiles[:, 1:] > quantiles[:, :-1]).all())
 
-#Testing branch protection...
-class EideticLinearLayer(nn.Module):
-    """ Custom Linear layer but mimics a standard linear layer """
-    def __init__(self, size_in, size_out, n_quantile_rate, quantile_cardinality, table_number):
+def bucketize(activations, quantiles, increasing=True):
+    """ Vectorized binarySearchQuantiles over a (batch, size_out) block of activations
+
+    quantiles is the (size_out, num_quantiles-1) threshold tensor. Bucket ids match the
+    recursive binary search element for element: strictly increasing thresholds go through
+    one batched searchsorted, repeated thresholds replay the bisection in lock-step so that
+    ties land in the same bucket as before. With exactly two thresholds the binary search
+    starts on its upper edge and never looks below it, so that case is replayed as well.
+    """
+    activations = activations.to(quantiles.dtype)
+    n = quantiles.shape[1]
+    if increasing and n != 2:
+        return torch.searchsorted(quantiles, activations.t().contiguous()).t()
+
+    #Every step halves [l, r), so bit_length + 1 steps are enough for every element to land
+    return bisect_buckets(activations, quantiles, n.bit_length() + 1)
+
+def bisect_buckets(activations, quantiles, steps):
+    # type: (Tensor, Tensor, int) -> Tensor
+    """ Lock-step replay of the recursive binary search, scriptable for the frozen layers """
+    n = quantiles.shape[1]
+    shape = activations.shape
+    thresholds = quantiles.unsqueeze(0).expand(shape[0], -1, -1)
+    l = torch.zeros(shape, dtype=torch.long, device=activations.device)
+    r = torch.full(shape, n, dtype=torch.long, device=activations.device)
+    buckets = torch.zeros(shape, dtype=torch.long, device=activations.device)
+    done = torch.zeros(shape, dtype=torch.bool, device=activations.device)
+
+    for _ in range(steps):
+        mid = torch.div(l + r, 2, rounding_mode="floor")
+        at_mid = thresholds.gather(2, mid.clamp(max=n - 1).unsqueeze(2)).squeeze(2)
+        at_next = thresholds.gather(2, (mid + 1).clamp(max=n - 1).unsqueeze(2)).squeeze(2)
+        above_mid = activations >= at_mid
+        found = (mid == 0) | (mid >= n - 1) | (above_mid & (activations < at_next))
+        buckets = torch.where(found & ~done, mid + (activations > at_mid).long(), buckets)
+        done = done | found
+        l = torch.where(~done & above_mid, mid, l)
+        r = torch.where(~done & ~above_mid, mid, r)
+
+    return buckets
+
+def bucketize_channels(channels, quantiles, increasing=True):
+    """ bucketize for a channel-major (size_out, n) block of activations, with (size_out, n) bucket ids
+
+    Up to 8 strictly increasing thresholds are counted, one comparison pass each, which on CPU is
+    faster than searchsorted; two thresholds always end the binary search on the upper one.
+    """
+    n = quantiles.shape[1]
+    if n == 2:
+        return (channels > quantiles[:, 1:]).long() + 1
+    if increasing and n <= 8:
+        counts = torch.zeros(channels.shape, dtype=torch.uint8, device=channels.device)
+        for k in range(n):
+            counts += channels > quantiles[:, k:k + 1]
+        return counts.long()
+    if increasing:
+        return torch.searchsorted(quantiles, channels)
+    return bucketize(channels.t(), quantiles, increasing).t()
+
+class IndexedProduct(torch.autograd.Function):
+    """ Indexed matmul whose backward only touches the bank rows that were hit
+
+    Saves the inputs and bucket ids rather than one graph node per feature. The bank gradient
+    is accumulated with a single index_add_, or returned as a sparse (num_quantiles, size_in)
+    COO tensor when sparse is set, for use with SparseAdadelta.
+    """
+    @staticmethod
+    def forward(ctx, x, indices, bank, sparse):
+        features = torch.arange(bank.shape[1], device=bank.device)
+        ctx.save_for_backward(x, indices, bank)
+        ctx.sparse = sparse
+        return torch.einsum('bi,bio->bo', x, bank[indices, features])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, indices, bank = ctx.saved_tensors
+        num_quantiles, size_in, size_out = bank.shape
+        features = torch.arange(size_in, device=bank.device)
+        grad_x = grad_bank = None
+
+        if ctx.needs_input_grad[0]:
+            grad_x = torch.einsum('bo,bio->bi', grad_output, bank[indices, features])
+
+        if ctx.needs_input_grad[2]:
+            #Row (indices[b][i], i) of the bank receives x[b][i] * grad_output[b]
+            values = (x.unsqueeze(2) * grad_output.unsqueeze(1)).reshape(-1, size_out)
+            if ctx.sparse:
+                coordinates = torch.stack([indices.reshape(-1), features.expand_as(indices).reshape(-1)])
+                grad_bank = torch.sparse_coo_tensor(coordinates, values, bank.shape, check_invariants=False).coalesce()
+            else:
+                grad_bank = bank.new_zeros(bank.shape)
+                grad_bank.view(-1, size_out).index_add_(0, (indices * size_in + features).reshape(-1), values)
+
+        return grad_x, None, grad_bank, None
+
+def indexed_product(x, indices, bank, sparse=False):
+    """ Batched indexed matmul: every input feature picks its weight row from the bank by bucket id
+
+    x is (batch, size_in), indices the (batch, size_in) bucket ids from the previous layer and
+    bank the (num_quantiles, size_in, size_out) weight bank.
+    """
+    return IndexedProduct.apply(x, indices.long(), bank, sparse)
+
+def indexed_conv2d(x, indices, bank, stride=1, padding=0):
+    """ Convolution where every input element picks its kernel slice from the bank by bucket id
+
+    x is (batch, in_channels, height, width), indices its bucket ids and bank the (num_quantiles,
+    out_channels, in_channels, kh, kw) kernel bank. Element (c, y, x) of bucket q is scattered to
+    channel q * in_channels + c of an otherwise zero input, which one conv2d then multiplies with
+    the buckets' kernels laid side by side, so the cost is that of a conv with num_quantiles times
+    the input channels.
+    """
+    num_quantiles, out_channels, in_channels, kh, kw = bank.shape
+    batch, _, height, width = x.shape
+    scattered = x.new_zeros(batch, num_quantiles, in_channels, height, width).scatter_(1, indices.long().unsqueeze(1), x.unsqueeze(1))
+    kernels = bank.transpose(0, 1).reshape(out_channels, num_quantiles * in_channels, kh, kw)
+    return F.conv2d(scattered.reshape(batch, num_quantiles * in_channels, height, width), kernels, None, stride, padding)
+
+class SparseAdadelta(torch.optim.Optimizer):
+    """ Adadelta that also accepts the sparse bank gradients of IndexedProduct
+
+    Dense gradients follow torch.optim.Adadelta. For sparse gradients only the touched rows of the
+    parameter and of its running averages are updated, so untouched buckets are left as they are.
+    """
+    def __init__(self, params, lr=1.0, rho=0.9, eps=1e-6):
+        super().__init__(params, dict(lr=lr, rho=rho, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            lr, rho, eps = group["lr"], group["rho"], group["eps"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state["square_avg"] = torch.zeros_like(p)
+                    state["acc_delta"] = torch.zeros_like(p)
+
+                if p.grad.is_sparse:
+                    grad = p.grad.coalesce()
+                    rows = tuple(grad.indices())
+                    values = grad.values()
+                    square_avg = state["square_avg"][rows].mul_(rho).addcmul_(values, values, value=1 - rho)
+                    acc_delta = state["acc_delta"][rows]
+                    delta = acc_delta.add(eps).sqrt_().div_(square_avg.add(eps).sqrt_()).mul_(values)
+                    acc_delta.mul_(rho).addcmul_(delta, delta, value=1 - rho)
+                    state["square_avg"][rows] = square_avg
+                    state["acc_delta"][rows] = acc_delta
+                    p.index_put_(rows, delta.mul_(-lr), accumulate=True)
+                else:
+                    grad = p.grad
+                    square_avg, acc_delta = state["square_avg"], state["acc_delta"]
+                    square_avg.mul_(rho).addcmul_(grad, grad, value=1 - rho)
+                    delta = acc_delta.add(eps).sqrt_().div_(square_avg.add(eps).sqrt_()).mul_(grad)
+                    acc_delta.mul_(rho).addcmul_(delta, delta, value=1 - rho)
+                    p.add_(delta, alpha=-lr)
+
+        return loss
+
+#Weight bank representations of the indexed layers, see DeltaBank
+BANK_KINDS = ("full", "lowrank", "scale")
+
+class DeltaBank(nn.Module):
+    """ Per-bucket weights stored as the layer's shared weights plus a compact delta
+
+    lowrank gives bucket q the weights W.t() + a[q] @ b[q] with a (num_quantiles, size_in, rank)
+    and b (num_quantiles, rank, size_out); scale gives it scale[q][:, None] * W.t() + shift[q]
+    with scale (num_quantiles, size_in) and shift (num_quantiles, size_out). Both start as exact
+    copies of the weights and take O(num_quantiles * (size_in + size_out)) memory instead of
+    O(num_quantiles * size_in * size_out). forward sums the inputs per bucket with one
+    scatter_add_ and never builds the (batch, size_in, size_out) rows of the full bank.
+    """
+    def __init__(self, kind, num_quantiles, size_in, size_out, rank=4):
         super().__init__()
-        self.size_in, self.size_out, self.table_number = size_in, size_out, table_number
-        weights = torch.Tensor(size_out, size_in)
-        self.weights = nn.Parameter(weights)  # nn.Parameter is a Tensor that's a module parameter.
-        bias = torch.Tensor(size_out)
-        self.bias = nn.Parameter(bias)
-        self.outputValues = np.zeros([quantile_cardinality + 1, size_out])
-        self.index = 0
+        if kind not in BANK_KINDS[1:]:
+            raise ValueError("Unknown delta bank " + repr(kind) + ", expected one of " + ", ".join(BANK_KINDS[1:]))
+        self.kind, self.num_quantiles, self.size_in, self.size_out, self.rank = kind, num_quantiles, size_in, size_out, rank
+        if kind == "lowrank":
+            #b at zero makes the product vanish, a random so both factors get gradients
+            self.a = nn.Parameter(torch.randn(num_quantiles, size_in, rank) / math.sqrt(size_in))
+            self.b = nn.Parameter(torch.zeros(num_quantiles, rank, size_out))
+        else:
+            self.scale = nn.Parameter(torch.ones(num_quantiles, size_in))
+            self.shift = nn.Parameter(torch.zeros(num_quantiles, size_out))
+
+    def initial(self):
+        """ Fresh delta tensors, in parameter order, that leave every bucket equal to the weights
+
+        a is kept as it is, so the result does not depend on the random state of the process.
+        """
+        if self.kind == "lowrank":
+            return [self.a.detach().clone(), torch.zeros_like(self.b)]
+        return [torch.ones_like(self.scale), torch.zeros_like(self.shift)]
+
+    def reset(self, num_quantiles=None):
+        """ Makes the first num_quantiles buckets (default all) copies of the weights again """
+        with torch.no_grad():
+            for param, value in zip(self.parameters(), self.initial()):
+                param[:num_quantiles].copy_(value[:num_quantiles])
+
+    def materialize(self, weights):
+        """ The equivalent full (num_quantiles, size_in, size_out) bank, or (num_quantiles, out_channels, in_channels, kh, kw) for conv kernels """
+        if weights.dim() == 4:
+            return self.scale[:, None, :, None, None] * weights.unsqueeze(0) + self.shift[:, :, None, None, None]
+        base = weights.t().unsqueeze(0)
+        if self.kind == "lowrank":
+            return base + torch.bmm(self.a, self.b)
+        return self.scale.unsqueeze(2) * base + self.shift.unsqueeze(1)
+
+    def conv2d(self, x, indices, kernels, stride=1, padding=0):
+        """ indexed_conv2d of a scale bank over the (out_channels, in_channels, kh, kw) kernels, at the cost of about one conv
+
+        The scales multiply the inputs, and the shifts, which add the same value to every kernel
+        element, become one conv of the per-bucket sums of the input channels.
+        """
+        indices = indices.long()
+        channels = torch.arange(self.size_in, device=x.device).view(1, -1, 1, 1)
+        scaled = F.conv2d(x * self.scale[indices, channels], kernels, None, stride, padding)
+        totals = x.new_zeros(x.shape[0], self.num_quantiles, *x.shape[2:]).scatter_add_(1, indices, x)
+        shifts = self.shift.t()[:, :, None, None].expand(-1, -1, *kernels.shape[2:])
+        return scaled + F.conv2d(totals, shifts, None, stride, padding)
+
+    def forward(self, x, indices, weights):
+        indices = indices.long()
+        features = torch.arange(self.size_in, device=x.device)
+        if self.kind == "lowrank":
+            #u[b][q] sums x[b][i] * a[q][i] over the features i in bucket q
+            projected = x.unsqueeze(2) * self.a[indices, features]
+            u = x.new_zeros(len(x), self.num_quantiles, self.rank).scatter_add_(1, indices.unsqueeze(2).expand_as(projected), projected)
+            return torch.mm(x, weights.t()) + torch.einsum('bqr,qro->bo', u, self.b)
+        totals = x.new_zeros(len(x), self.num_quantiles).scatter_add_(1, indices, x)
+        return torch.mm(x * self.scale[indices, features], weights.t()) + torch.mm(totals, self.shift)
+
+def load_param_index(state_dict, prefix, size_in):
+    """ Folds legacy ParameterList keys (param_index.N) into the single stacked bank tensor """
+    legacy_prefix = prefix + "param_index."
+    legacy_keys = sorted((key for key in state_dict if key.startswith(legacy_prefix)), key=lambda key: int(key[len(legacy_prefix):]))
+    if len(legacy_keys) == 0:
+        return
+
+    #Legacy vector i*size_in + j held the weights of input j for quantile i
+    rows = torch.stack([state_dict.pop(key) for key in legacy_keys])
+    state_dict[prefix + "param_index"] = rows.reshape(-1, size_in, rows.shape[-1])
+
+def load_quantiles(layer, state_dict, prefix):
+    """ Hands saved thresholds to set_quantiles first, an unset buffer cannot receive them and the count may differ """
+    key = prefix + "quantiles"
+    if key in state_dict:
+        layer.set_quantiles(state_dict[key])
+
+def exact_quantiles(values, num_quantiles, interpolation="index", block_bytes=1 << 28):
+    """ Per-column thresholds of a (samples, size) array, selected for all columns at once
+
+    interpolation picks the row used for the threshold between quantile i and i+1:
+    "index" takes row (samples // num_quantiles) * (i+1) like the original per-column sort,
+    "disc" matches percentile_disc((i+1) / num_quantiles) on the Postgres path and
+    "linear" interpolates between neighbouring rows like numpy.quantile.
+    Columns are processed in blocks of about block_bytes, so values may be a memmap larger than RAM.
+    Returns a (size, num_quantiles-1) array.
+    """
+    samples = len(values)
+    if samples == 0:
+        raise ValueError("No activations stored, run a pass with store_activations first")
+
+    steps = np.arange(1, num_quantiles)
+    if interpolation == "index":
+        lower = upper = np.minimum((samples // num_quantiles) * steps, samples - 1)
+    elif interpolation == "disc":
+        lower = upper = np.maximum(-(-steps * samples // num_quantiles) - 1, 0)
+    elif interpolation == "linear":
+        exact = steps * (samples - 1) / num_quantiles
+        lower = np.floor(exact).astype(int)
+        upper = np.minimum(lower + 1, samples - 1)
+    else:
+        raise ValueError("Unknown quantile interpolation: " + str(interpolation))
+
+    kth = np.unique(np.concatenate([lower, upper]))
+    width = max(block_bytes // (samples * values.dtype.itemsize), 1)
+    blocks = []
+    for start in range(0, values.shape[1], width):
+        #One transposed copy so every neuron's samples are contiguous, then partition it in place
+        columns = np.ascontiguousarray(values[:, start:start + width].T)
+        partition_at(columns, kth, 0, samples)
+        quantiles = columns[:, lower]
+        if interpolation == "linear":
+            quantiles = quantiles + (exact - lower) * (columns[:, upper] - quantiles)
+        blocks.append(quantiles)
+
+    return np.concatenate(blocks)
+
+def partition_at(columns, kth, lo, hi):
+    """ In-place partition of columns[:, lo:hi] so every sorted position in kth holds its order statistic
+
+    Splits on the middle position first and recurses into both halves, so every level of the
+    recursion touches each element once: O(n log k) instead of numpy's O(n k) for many kth.
+    """
+    if len(kth) == 0:
+        return
+    middle = len(kth) // 2
+    columns[:, lo:hi].partition(kth[middle] - lo, axis=1)
+    partition_at(columns, kth[:middle], lo, kth[middle])
+    partition_at(columns, kth[middle + 1:], kth[middle] + 1, hi)
+
+STORE_DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16, "int8": torch.int8, "int16": torch.int16}
+
+class ActivationStore(nn.Module):
+    """ Fixed-capacity activation store that stays on the layer's device
+
+    Whole batches are copied in at once and n_quantile_rate is applied as one random mask. Once
+    the store is full, "ring" overwrites the oldest rows and "reservoir" keeps a uniform sample of
+    everything seen so far (Algorithm R), so collection can run over full datasets and epochs.
+
+    dtype is one of STORE_DTYPES. float16/bfloat16 halve the memory, int8/int16 store per-neuron
+    codes over a [offset, offset + scale * levels] range that is fitted to the first batch and
+    widened by a quarter on each side whenever a batch falls outside it, re-encoding the stored
+    rows. Rounding is monotone, so thresholds are the exact ones rounded: within a relative
+    2^-11 (float16) or 2^-8 (bfloat16), and within 1.5 * scale for the integer codes.
+    """
+    def __init__(self, capacity, size, sample_rate=1.0, mode="reservoir", dtype="float32"):
+        super().__init__()
+        if mode not in ("ring", "reservoir"):
+            raise ValueError("Unknown activation store mode: " + str(mode))
+        if dtype not in STORE_DTYPES:
+            raise ValueError("Unknown activation store dtype: " + str(dtype))
+        self.capacity, self.size, self.sample_rate, self.mode = capacity, size, sample_rate, mode
+        self.register_buffer("values", torch.zeros(capacity, size, dtype=STORE_DTYPES[dtype]), persistent=False)
+        self.quantized = not self.values.dtype.is_floating_point
+        if self.quantized:
+            info = torch.iinfo(self.values.dtype)
+            self.code_min, self.levels = info.min, info.max - info.min
+            self.register_buffer("offset", torch.zeros(size), persistent=False)
+            self.register_buffer("scale", torch.zeros(size), persistent=False)
+        self.count = 0
+        self.seen = 0
+
+    def encode(self, activations):
+        if not self.quantized:
+            return activations.to(self.values.dtype)
+        codes = torch.round((activations.float() - self.offset) / self.scale).clamp_(0, self.levels)
+        return (codes + self.code_min).to(self.values.dtype)
+
+    def decode(self, rows):
+        if not self.quantized:
+            return rows.float()
+        return (rows.float() - self.code_min) * self.scale + self.offset
+
+    def __fit_range(self, activations):
+        #Widen the code range to cover the batch and re-encode what is stored under the new range
+        low, high = activations.float().min(0).values, activations.float().max(0).values
+        if self.seen > 0:
+            top = self.offset + self.scale * self.levels
+            if bool(((low >= self.offset) & (high <= top)).all()):
+                return
+            low, high = torch.minimum(low, self.offset), torch.maximum(high, top)
+            margin = (high - low) / 4
+            low, high = low - margin, high + margin
+
+        stored = self.decode(self.values[:self.count])
+        self.offset = low
+        self.scale = ((high - low) / self.levels).clamp(min=1e-12)
+        self.values[:self.count] = self.encode(stored)
+
+    def add(self, activations):
+        """ Samples a (batch, size) block with sample_rate, stores it and returns the sampled rows """
+        activations = activations.detach().float()
+        if self.sample_rate < 1.0:
+            activations = activations[torch.rand(len(activations), device=activations.device) < self.sample_rate]
+        if len(activations) == 0:
+            return activations
+        if self.quantized:
+            self.__fit_range(activations)
+        sampled, activations = activations, self.encode(activations)
+
+        #Fill whatever free space is left, then hand the overflow to the ring or reservoir
+        free = self.capacity - self.count
+        head = activations[:free]
+        self.values[self.count:self.count + len(head)] = head
+        self.count = self.count + len(head)
+        self.seen = self.seen + len(head)
+
+        overflow = activations[free:]
+        if len(overflow) > 0:
+            if self.mode == "ring":
+                self.__add_ring(overflow)
+            else:
+                self.__add_reservoir(overflow)
+            self.seen = self.seen + len(overflow)
+
+        return sampled
+
+    def __add_ring(self, overflow):
+        #Only the newest capacity rows can survive, positions continue from the oldest row
+        skipped = max(len(overflow) - self.capacity, 0)
+        steps = torch.arange(skipped, len(overflow), device=self.values.device)
+        self.values[(self.seen + steps) % self.capacity] = overflow[skipped:]
+
+    def __add_reservoir(self, overflow):
+        #Row number t replaces slot randint(0, t] when that slot exists
+        steps = self.seen + torch.arange(len(overflow), device=self.values.device)
+        slots = (torch.rand(len(overflow), device=self.values.device) * (steps + 1)).long()
+        keep = slots < self.capacity
+        slots, rows = slots[keep], overflow[keep]
+
+        #Later rows win when a batch draws the same slot twice, as they would one at a time
+        order = torch.argsort(slots * len(overflow) + torch.arange(len(slots), device=slots.device))
+        slots, rows = slots[order], rows[order]
+        last = torch.ones_like(slots, dtype=torch.bool)
+        last[:-1] = slots[1:] != slots[:-1]
+        self.values[slots[last]] = rows[last]
+
+    def filled(self):
+        """ The rows that hold activations, without the zero padding, in the storage dtype """
+        return self.values[:self.count]
+
+    def numpy(self):
+        """ The stored activations decoded to float32 """
+        return self.decode(self.filled()).cpu().numpy()
+
+    def checkpoint(self):
+        """ The stored rows and sampling state as plain tensors and ints, for checkpoints """
+        state = {"values": self.filled().cpu().clone(), "count": self.count, "seen": self.seen}
+        if self.quantized:
+            state.update(offset=self.offset.cpu().clone(), scale=self.scale.cpu().clone())
+        return state
+
+    def restore(self, state):
+        """ Puts back the rows of checkpoint(), keeping the first capacity rows of a larger store """
+        values = state["values"][:self.capacity]
+        if values.dtype != self.values.dtype or values.shape[1:] != self.values.shape[1:]:
+            raise ValueError("Stored activations of shape " + str(tuple(values.shape)) + " and " + str(values.dtype) + " do not fit this " + str(self.values.dtype) + " store")
+        self.reset()
+        if self.quantized:
+            self.offset, self.scale = state["offset"].to(self.offset), state["scale"].to(self.scale)
+        self.values[:len(values)] = values.to(self.values.device)
+        self.count, self.seen = len(values), state["seen"]
+
+    def reset(self):
+        self.values.zero_()
+        self.count = 0
+        self.seen = 0
+
+class MemmapActivationStore():
+    """ Append-only .npy activation file that grows in chunks and can hold far more than RAM
+
+    The file at path keeps a fixed-size header whose shape is the number of stored rows, so it can
+    be opened with np.load(path, mmap_mode="r") and its rows are reopened by later runs; reset
+    drops them. numpy returns a zero-copy memmap view of the stored rows for calculate_n_quantiles.
+    close trims the free space of the last chunk off the file.
+    """
+    HEADER_SIZE = 128
+
+    def __init__(self, path, size, sample_rate=1.0, chunk_rows=1 << 16, dtype=np.float32):
+        self.path, self.size, self.sample_rate, self.chunk_rows = path, size, sample_rate, chunk_rows
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                np.lib.format.read_magic(f)
+                shape, _, stored_dtype = np.lib.format.read_array_header_1_0(f)
+                if f.tell() != self.HEADER_SIZE or shape[1:] != (size,) or stored_dtype != self.dtype:
+                    raise ValueError("Activation file " + path + " does not hold " + str(size) + " wide " + str(self.dtype) + " rows")
+            self.count = shape[0]
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            open(path, "wb").close()
+
+        self.file = open(path, "r+b")
+        self.__write_header()
+        self.__map(max(self.count, chunk_rows))
+
+    def __write_header(self):
+        header = "{'descr': " + repr(np.lib.format.dtype_to_descr(self.dtype)) + ", 'fortran_order': False, 'shape': (" + str(self.count) + ", " + str(self.size) + "), }"
+        header = header.ljust(self.HEADER_SIZE - 11) + "\n"
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + np.uint16(len(header)).tobytes() + header.encode("latin1"))
+        self.file.flush()
+
+    def __map(self, capacity):
+        #Grow the file to capacity rows and remap it, rows past count are free space
+        self.capacity = capacity
+        self.file.truncate(self.HEADER_SIZE + capacity * self.size * self.dtype.itemsize)
+        self.values = np.memmap(self.path, dtype=self.dtype, mode="r+", offset=self.HEADER_SIZE, shape=(capacity, self.size))
+
+    def add(self, activations):
+        """ Samples a (batch, size) block with sample_rate, appends it and returns the sampled rows """
+        activations = activations.detach()
+        if self.sample_rate < 1.0:
+            activations = activations[torch.rand(len(activations), device=activations.device) < self.sample_rate]
+
+        rows = len(activations)
+        if self.count + rows > self.capacity:
+            self.values.flush()
+            self.__map(self.capacity + self.chunk_rows * math.ceil((self.count + rows - self.capacity) / self.chunk_rows))
+        self.values[self.count:self.count + rows] = activations.cpu().numpy()
+        self.count = self.count + rows
+        self.__write_header()
+        return activations
+
+    def filled(self):
+        return self.values[:self.count]
+
+    def numpy(self):
+        return self.filled()
+
+    def reset(self):
+        self.count = 0
+        self.__write_header()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.values.flush()
+        #Unmap before trimming, pages past the new end must not stay mapped
+        self.values = None
+        self.file.truncate(self.HEADER_SIZE + self.count * self.size * self.dtype.itemsize)
+        self.file.close()
+
+class QuantileSketch():
+    """ Mergeable per-neuron KLL quantile sketch with bounded memory
+
+    Level h holds items of weight 2^h. When a level overflows its capacity (k at the top, shrinking
+    by c per level below) it is sorted and every other item, from a random offset per neuron, is
+    promoted. Every neuron sees the same number of values, so all neurons share one compaction
+    schedule and each level is a single (size, items) tensor. Memory stays around k / (1 - c) items
+    per neuron however many samples are streamed.
+
+    Error bound: a compaction at level h moves any rank by at most 2^h, so the absolute rank error
+    is at most rank_error (the sum of 2^h over all compactions, see error_bound for the normalized
+    value). That worst case is about n * log2(n / k) / k; the random offsets make errors cancel and
+    observed normalized rank error is about 2 / k (see the sketch benchmark).
+    """
+    def __init__(self, size, k=200, c=2.0 / 3.0):
+        self.size, self.k, self.c = size, k, c
+        self.levels = []
+        self.count = 0
+        self.rank_error = 0
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * self.c ** depth)), 2)
+
+    def update(self, activations):
+        """ Adds a (batch, size) block of activations """
+        activations = activations.detach().t()
+        if len(self.levels) == 0:
+            self.levels.append(activations.new_empty(self.size, 0))
+        self.levels[0] = torch.cat([self.levels[0], activations], 1)
+        self.count = self.count + activations.shape[1]
+        self.__compress()
+
+    def merge(self, other):
+        """ Folds another sketch of the same width into this one """
+        if other.size != self.size:
+            raise ValueError("Cannot merge sketches of width " + str(other.size) + " into width " + str(self.size))
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(items.new_empty(self.size, 0))
+            self.levels[level] = torch.cat([self.levels[level], items.to(self.levels[level])], 1)
+        self.count = self.count + other.count
+        self.rank_error = self.rank_error + other.rank_error
+        self.__compress()
+
+    def __compress(self):
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].shape[1] > self.capacity(level):
+                self.__compact(level)
+                level = 0
+            else:
+                level = level + 1
+
+    def __compact(self, level):
+        items = self.levels[level].sort(dim=1).values
+        odd = items.shape[1] % 2
+        offsets = torch.randint(0, 2, (self.size, 1), device=items.device)
+        steps = 2 * torch.arange(items.shape[1] // 2, device=items.device)
+        survivors = items[:, odd:].gather(1, offsets + steps)
+
+        if level + 1 == len(self.levels):
+            self.levels.append(items.new_empty(self.size, 0))
+        self.levels[level + 1] = torch.cat([self.levels[level + 1], survivors], 1)
+        self.levels[level] = items[:, :odd]
+        self.rank_error = self.rank_error + 2 ** level
+
+    def checkpoint(self):
+        """ The levels and counters as plain tensors and ints, for checkpoints """
+        return {"levels": [items.cpu() for items in self.levels], "count": self.count, "rank_error": self.rank_error}
+
+    def restore(self, state):
+        if any(items.shape[0] != self.size for items in state["levels"]):
+            raise ValueError("Cannot restore a sketch of another width into width " + str(self.size))
+        device = self.levels[0].device if self.levels else "cpu"
+        self.levels = [items.to(device) for items in state["levels"]]
+        self.count, self.rank_error = state["count"], state["rank_error"]
+
+    def error_bound(self):
+        """ Worst-case rank error as a fraction of the samples seen """
+        return self.rank_error / max(self.count, 1)
+
+    def quantiles(self, num_quantiles):
+        """ (size, num_quantiles-1) percentile_disc thresholds at i / num_quantiles """
+        values = torch.cat(self.levels, 1)
+        weights = torch.cat([torch.full((items.shape[1],), 2.0 ** level, dtype=torch.float64, device=values.device)
+                             for level, items in enumerate(self.levels)])
+        values, order = values.sort(dim=1)
+        cumulative = weights[order].cumsum(1)
+
+        #percentile_disc: the first value whose cumulative weight reaches the target rank
+        targets = torch.arange(1, num_quantiles, dtype=torch.float64, device=values.device) / num_quantiles * self.count
+        positions = torch.searchsorted(cumulative, targets.expand(self.size, -1).contiguous())
+        return values.gather(1, positions.clamp(max=values.shape[1] - 1))
+
+def merged_quantiles(sketch, store, num_quantiles, use_db, table_number, interpolation="index"):
+    """ Thresholds over the activations of every rank, computed on rank 0 and broadcast so all ranks match
+
+    Sketches are merged and stored activations concatenated on rank 0; with use_db every rank
+    flushes into the shared table before rank 0 queries it.
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    gathered = [None] * world_size if rank == 0 else None
+    if use_db:
+        db.database.flush(table_number)
+        dist.barrier()
+    else:
+        dist.gather_object(sketch if sketch is not None else store.numpy(), gathered, dst=0)
+
+    quantiles = [None]
+    if rank == 0 and use_db:
+        quantiles[0] = db.database.create_quantile_distribution(num_quantiles, table_number)
+    elif rank == 0 and sketch is not None:
+        merged = QuantileSketch(sketch.size, sketch.k, sketch.c)
+        for other in gathered:
+            merged.merge(other)
+        quantiles[0] = merged.quantiles(num_quantiles).cpu()
+    elif rank == 0:
+        quantiles[0] = exact_quantiles(np.concatenate(gathered), num_quantiles, interpolation)
+    dist.broadcast_object_list(quantiles, src=0)
+    return quantiles[0]
+
+class IndexCache(nn.Module):
+    """ Bounded LRU cache of per-sample bucket ids, keyed by integer sample id
+
+    Rows live in a fixed (capacity, size) table of uint8 ids (int16/int32 past 256/32768 buckets),
+    found through the slot owners sorted by sample id, so lookups (a searchsorted) and inserts are
+    whole-batch tensor ops and memory stays bounded by capacity whatever the sample ids. When the
+    table is full the least recently used slots are overwritten. The cache is only correct while
+    the layer's input for a given sample id is fixed, i.e. everything upstream is frozen and
+    deterministic; the owning layer clears it whenever its thresholds or weights change.
+    """
+    def __init__(self, capacity, size):
+        super().__init__()
+        self.capacity, self.size = capacity, size
+        self.register_buffer("buckets", torch.zeros(capacity, size, dtype=torch.uint8), persistent=False)
+        self.register_buffer("owner", torch.full((capacity,), -1, dtype=torch.long), persistent=False)
+        self.register_buffer("last_used", torch.zeros(capacity, dtype=torch.long), persistent=False)
+        #owner sorted ascending, and the slot of each sorted entry
+        self.register_buffer("sorted_owner", torch.full((capacity,), -1, dtype=torch.long), persistent=False)
+        self.register_buffer("sorted_slot", torch.arange(capacity), persistent=False)
+        self.step = 0
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.owner.fill_(-1)
+        self.sorted_owner.fill_(-1)
+        torch.arange(self.capacity, out=self.sorted_slot)
+        self.last_used.zero_()
+        self.step = 0
+        self.key = None
+
+    def __slots(self, sample_ids):
+        positions = torch.searchsorted(self.sorted_owner, sample_ids).clamp(max=self.capacity - 1)
+        hit = self.sorted_owner[positions] == sample_ids
+        return self.sorted_slot[positions], hit
+
+    def lookup(self, sample_ids, key):
+        """ Returns the hit mask and the cached bucket ids of the hits, clearing the cache if key changed """
+        if key != self.key:
+            self.clear()
+            self.key = key
+        sample_ids = sample_ids.to(self.owner.device)
+        slots, hit = self.__slots(sample_ids)
+        self.step = self.step + 1
+        self.last_used[slots[hit]] = self.step
+        found = self.buckets[slots[hit]].long()
+        self.hits = self.hits + len(found)
+        self.misses = self.misses + len(sample_ids) - len(found)
+        return hit, found
+
+    def insert(self, sample_ids, buckets, num_buckets):
+        """ Stores the (batch, size) bucket ids of samples, evicting least recently used rows
+
+        Every sample id gets one slot: repeats within the batch are stored once, and ids already
+        cached overwrite their own slot.
+        """
+        dtype = torch.uint8 if num_buckets <= 256 else torch.int16 if num_buckets <= 32768 else torch.int32
+        if self.buckets.dtype != dtype:
+            self.buckets = self.buckets.new_zeros(self.capacity, self.size, dtype=dtype)
+            self.clear()
+        sample_ids, inverse = torch.unique(sample_ids.to(self.owner.device), return_inverse=True)
+        #A repeated sample has the same bucket ids every time, any of its rows will do
+        buckets = buckets.new_empty(len(sample_ids), buckets.shape[1]).index_copy_(0, inverse.to(buckets.device), buckets)
+        sample_ids, buckets = sample_ids[-self.capacity:], buckets[-self.capacity:]
+
+        slots, hit = self.__slots(sample_ids)
+        usage = self.last_used.clone()
+        usage[slots[hit]] = torch.iinfo(usage.dtype).max
+        slots[~hit] = torch.topk(usage, int((~hit).sum()), largest=False).indices
+        self.owner[slots] = sample_ids
+        self.buckets[slots] = buckets.to(self.buckets.device, dtype)
+        self.last_used[slots] = self.step
+        torch.sort(self.owner, out=(self.sorted_owner, self.sorted_slot))
+
+def cached_bucketize(cache, key, activations, quantiles, increasing, sample_ids):
+    """ bucketize that serves samples seen under the same key from cache and only bucketizes the rest """
+    hit, found = cache.lookup(sample_ids, key)
+    if bool(hit.all()):
+        return found.to(activations.device)
+
+    miss = ~hit.to(activations.device)
+    computed = bucketize(activations[miss], quantiles, increasing)
+    cache.insert(sample_ids[miss.to(sample_ids.device)], computed, quantiles.shape[1] + 1)
+    if len(found) == 0:
+        return computed
+    indices = torch.empty(len(activations), activations.shape[1], dtype=torch.long, device=activations.device)
+    indices[miss] = computed
+    indices[~miss] = found.to(activations.device)
+    return indices
+
+class EideticMixin():
+    """ Activation collection and per-unit thresholds shared by the eidetic layers
+
+    init_store, called from the layer's __init__ with the width of its activation rows, keeps the
+    rows in a QuantileSketch with sketch_size, a MemmapActivationStore under store_path or else an
+    in-memory ActivationStore; calculate_n_quantiles turns them into the quantiles buffer.
+    """
+    def init_store(self, size, n_quantile_rate, quantile_cardinality, table_number, store_mode="reservoir", sketch_size=None, store_path=None, store_dtype="float32", index_cache_size=None):
+        self.table_number = table_number
+        #Streaming mode keeps a fixed-size sketch per unit instead of the stored activations
+        self.sketch = None
+        self.activations = None
+        if sketch_size is not None:
+            self.sketch = QuantileSketch(size, sketch_size)
+        elif store_path is not None:
+            if store_dtype != "float32":
+                raise ValueError("The memory-mapped store of ACTIVATION_DIR keeps float32 rows, got store_dtype=" + repr(store_dtype))
+            self.activations = MemmapActivationStore(os.path.join(store_path, "activations_" + str(table_number) + ".npy"), size, n_quantile_rate)
+        else:
+            self.activations = ActivationStore(quantile_cardinality + 1, size, n_quantile_rate, store_mode, store_dtype)
         self.n_quantile_rate = n_quantile_rate
-        self.quantiles = []
+        self.register_buffer("quantiles", None)
+        self.quantiles_increasing = True
         self.quantile_cardinality = quantile_cardinality
-        
-        # initialize weights and biases
-        nn.init.kaiming_uniform_(self.weights, a=math.sqrt(5)) # weight init
-        fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weights)
-        bound = 1 / math.sqrt(fan_in)
-        nn.init.uniform_(self.bias, -bound, bound)  # bias init
-
-    def calculate_n_quantiles(self, num_quantiles, use_db):
-        
+        #Opt-in per-sample bucket id cache, only valid while the layer's inputs are frozen
+        self.index_cache = IndexCache(index_cache_size, size) if index_cache_size else None
 
-        if use_db == False:
-            #Every val indicies in our list represent a quantile separaiton point
-            val = int(self.quantile_cardinality / num_quantiles)
+    def store_rows(self, rows, use_db):
+        """ Adds a (rows, units) block of activations to the sketch or store, and to the database with use_db """
+        if self.sketch is not None:
+            self.sketch.update(rows)
+            if metrics.recorder.enabled:
+                metrics.recorder.count("activations_stored_" + str(self.table_number), len(rows))
+            return
+        sampled = self.activations.add(rows)
+        if metrics.recorder.enabled:
+            metrics.recorder.count("activations_stored_" + str(self.table_number), len(sampled))
 
-            #For every column is our stored list of activations
-            for j in range(0, self.size_out):
-                inner_quantile = []
+        if use_db == True:
+            db.database.insert_records(sampled.cpu().numpy(), self.table_number)
 
-                #Sort our list by the jth column
-                self.outputValues = self.outputValues[self.outputValues[:,j].argsort(kind='mergesort')]
+    def calculate_n_quantiles(self, num_quantiles, use_db, interpolation="index"):
 
-                #Append to our inner quantile which represents the quantiles for column j
-                for i in range(0, num_quantiles-1):
-                    inner_quantile.append(self.outputValues[val*(i+1)][j])
-                
-                
-                self.quantiles.append(inner_quantile)
+        if distributed():
+            quantiles = merged_quantiles(self.sketch, self.activations, num_quantiles, use_db, self.table_number, interpolation)
+        elif self.sketch is not None:
+            quantiles = self.sketch.quantiles(num_quantiles)
+        elif use_db == False:
+            quantiles = exact_quantiles(self.activations.numpy(), num_quantiles, interpolation)
         else:
-            distribution = db.database.create_quantile_distribution(num_quantiles, self.table_number)
+            quantiles = db.database.create_quantile_distribution(num_quantiles, self.table_number)
 
-            for j in range(0, self.size_out):
-                inner_quantile = []
-                
-                #Append to our inner quantile which represents the quantiles for column j
-                for i in range(0, num_quantiles-1):
-                    inner_quantile.append(distribution[j][i+1])
-               
-                self.quantiles.append(inner_quantile)
+        self.set_quantiles(quantiles)
+
+    def reset_activations(self):
+        """ Drops the collected activations so the next thresholds come from new data only """
+        if self.sketch is not None:
+            self.sketch = QuantileSketch(self.sketch.size, self.sketch.k, self.sketch.c)
+        elif self.activations is not None:
+            self.activations.reset()
+
+    def set_quantiles(self, quantiles):
+        """ Stores per-unit thresholds as one (units, num_quantiles-1) tensor on the layer's device """
+        if not torch.is_tensor(quantiles):
+            quantiles = np.asarray(quantiles)
+        #A layer built on the meta device, see main.load_checkpoint, keeps loaded thresholds where they are
+        device = quantiles.device if self.weights.is_meta and torch.is_tensor(quantiles) else self.weights.device
+        self.quantiles = torch.as_tensor(quantiles, dtype=self.weights.dtype, device=device).contiguous()
+        self.quantiles_increasing = quantiles_increasing(self.quantiles)
+        if self.index_cache is not None:
+            self.index_cache.clear()
 
-    
     def binarySearchQuantiles(self, activation, index):
+        """ Scalar reference for a single activation, see bucketize for the batched version """
 
         return self.__bsqHelper(activation, index, 0, len(self.quantiles[index]))
      
@@ -94,39 +852,102 @@ class EideticLinearLayer(nn.Module):
         else:
             r = mid
             return self.__bsqHelper(activation, index, l, r)
+
+class BankMixin():
+    """ The per-quantile weight bank shared by the indexed layers
+
+    The bank is the full param_index Parameter, num_quantiles copies of bank_slice (the layer's
+    weights in the layout the bank indexes), or for the other BANK_KINDS a DeltaBank on top of
+    the weights.
+    """
+    def init_bank(self, bank, num_quantiles, size_in, size_out, bank_rank=4):
+        if bank == "full":
+            self.param_index = nn.Parameter(self.bank_slice().unsqueeze(0).repeat(num_quantiles, *[1] * self.weights.dim()))
+            self.delta = None
+        else:
+            self.register_parameter("param_index", None)
+            self.delta = DeltaBank(bank, num_quantiles, size_in, size_out, bank_rank)
+
+    def build_index(self, num_quantiles):
+
+        #Copy weights across indices from the trained weight vector
+        if self.delta is not None:
+            self.delta.reset(num_quantiles)
+            return
+        with torch.no_grad():
+            self.param_index[:num_quantiles].copy_(self.bank_slice().unsqueeze(0).expand_as(self.param_index[:num_quantiles]))
+
+    def bank_parameters(self):
+        """ The tensors that hold the bank: param_index, or the delta's parameters """
+        return [self.param_index] if self.delta is None else list(self.delta.parameters())
+
+    def initial_bank(self):
+        """ New bank tensors, matching bank_parameters, with every quantile a copy of the weights """
+        if self.delta is not None:
+            return self.delta.initial()
+        return [self.bank_slice().unsqueeze(0).expand_as(self.param_index).contiguous()]
+
+    def bank_weights(self):
+        """ The full bank in param_index's layout, built from the delta when there is one """
+        return self.param_index if self.delta is None else self.delta.materialize(self.weights)
+
+    def set_use_indices(self, val):
+        self.use_indices = val
+
+#Testing branch protection...
+class EideticLinearLayer(EideticMixin, nn.Module):
+    """ Custom Linear layer but mimics a standard linear layer """
+    def __init__(self, size_in, size_out, n_quantile_rate, quantile_cardinality, table_number, store_mode="reservoir", sketch_size=None, store_path=None, index_cache_size=None, store_dtype="float32"):
+        super().__init__()
+        self.size_in, self.size_out = size_in, size_out
+        weights = torch.empty(size_out, size_in)
+        self.weights = nn.Parameter(weights)  # nn.Parameter is a Tensor that's a module parameter.
+        bias = torch.empty(size_out)
+        self.bias = nn.Parameter(bias)
+        self.init_store(size_out, n_quantile_rate, quantile_cardinality, table_number, store_mode, sketch_size, store_path, store_dtype, index_cache_size)
         
-    def forward(self, x, store_activations, get_indices, use_db):
+        # initialize weights and biases
+        nn.init.kaiming_uniform_(self.weights, a=math.sqrt(5)) # weight init
+        fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weights)
+        bound = 1 / math.sqrt(fan_in)
+        nn.init.uniform_(self.bias, -bound, bound)  # bias init
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_quantiles(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+    
+    def index_key(self):
+        """ Changes whenever the thresholds or weights that decide the bucket ids change """
+        return (id(self.quantiles), self.weights.data_ptr(), self.weights._version)
+
+    def forward(self, x, store_activations, get_indices, use_db, sample_ids=None):
         w_times_x= torch.mm(x, self.weights.t())
         
         if store_activations == True:
-            all_activations = w_times_x.detach().cpu().numpy()
-            
-            for activation_vector in all_activations:
-                
-                if use_db == True:
-                    
-                    if self.n_quantile_rate >= random.uniform(0, 1):
-                        db.database.insert_record(activation_vector, self.table_number)
+            self.store_rows(w_times_x, use_db)
 
-                self.outputValues[self.index] = activation_vector
-                self.index = self.index + 1
+        if get_indices == True and self.index_cache is not None and sample_ids is not None:
+            indices = cached_bucketize(self.index_cache, self.index_key(), w_times_x.detach(), self.quantiles, self.quantiles_increasing, sample_ids)
+        elif get_indices == True:
+            indices = bucketize(w_times_x.detach(), self.quantiles, self.quantiles_increasing)
+        else:
+            indices = torch.zeros([len(w_times_x), self.size_out], dtype=torch.long, device=w_times_x.device)
 
-        indices = torch.zeros([len(w_times_x), self.size_out])
-        
-        if get_indices == True:
-            for j in range(0, len(w_times_x)):
-                for i in range(0, self.size_out):
-                    indices[j][i] = self.binarySearchQuantiles(w_times_x[j][i].item(), i)
+        if get_indices == True and metrics.recorder.enabled:
+            metrics.recorder.count("bucket_lookups_" + str(self.table_number), indices.numel())
+            metrics.recorder.occupancy("bucket_occupancy_" + str(self.table_number), indices, self.quantiles.shape[1] + 1)
 
 
         return [torch.add(w_times_x, self.bias), indices]  
 
-class IndexedLinearLayer(nn.Module):
+class IndexedLinearLayer(BankMixin, nn.Module):
     """ Custom Linear layer but mimics a standard linear layer """
-    def __init__(self, size_in, size_out, num_quantiles):
+    def __init__(self, size_in, size_out, num_quantiles, sparse=False, bank="full", bank_rank=4):
         super().__init__()
-        self.size_in, self.size_out = size_in, size_out
-        weights = torch.Tensor(size_out, size_in)
+        if sparse and bank != "full":
+            raise ValueError("Sparse bank gradients need the full bank, got bank=" + repr(bank))
+        self.size_in, self.size_out, self.sparse = size_in, size_out, sparse
+        weights = torch.empty(size_out, size_in)
         self.weights = nn.Parameter(weights)  # nn.Parameter is a Tensor that's a module parameter.
         
         self.use_indices = False
@@ -138,58 +959,26 @@ class IndexedLinearLayer(nn.Module):
         self.use_previous_indices = False
         self.previous_indices = None
 
-        bias = torch.Tensor(size_out)
+        bias = torch.empty(size_out)
         self.bias = nn.Parameter(bias)
         nn.init.uniform_(self.bias, -bound, bound)  # bias init
 
-        self.param_index = nn.ParameterList()
-        self.device_to_use = os.getenv("DEVICE")
+        #Weight bank of shape (num_quantiles, size_in, size_out), every quantile starts as a copy of weights,
+        #or the weights plus a per-quantile DeltaBank registered after bias
+        self.init_bank(bank, num_quantiles, size_in, size_out, bank_rank)
 
-        # #Copy weights across indices from the trained weight vector
-        for i in range(0, num_quantiles):
-            for j in range(0, self.size_in):
-                weights = torch.Tensor(self.size_out)
-                for k in range(0, self.size_out):
-                    weights[k] = self.weights[k][j]
-            
-                self.param_index.append(nn.Parameter(weights))
+    def bank_slice(self):
+        """ One quantile's copy of the weights, (size_in, size_out) """
+        return self.weights.detach().t()
 
-    
-    def build_index(self, num_quantiles):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_param_index(state_dict, prefix, self.size_in)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-        #Copy weights across indices from the trained weight vector
-        for i in range(0, num_quantiles):
-            for j in range(0, self.size_in):
-                for k in range(0, self.size_out):
-                    with torch.no_grad():
-                        self.param_index[i*self.size_in + j][k] = self.weights[k][j]
-        
-        
-        
-    
-    def set_use_indices(self, val):
-        self.use_indices = val
-
-
-    #TODO: Figure out how to rewrite forward/backward pass without requiring swapping of weights
     def forward(self, x, indices):
         
         if self.use_indices == True:
-
-            final_output = torch.empty(len(x), self.size_out).to(self.device_to_use)
-            for batch in range(0, len(x)):
-                indices = indices[batch]
-                
-                outx = torch.empty(len(x[batch]), self.size_out).to(self.device_to_use)
-                
-                for i,p in enumerate(x[batch]):
-                    index = int(indices[i]) * self.size_in + i
-                    outx[i] = self.param_index[index] * x[batch][i]
-                    
-            
-                final_output[batch] = torch.sum(outx, 0)
-
-            w_times_x = final_output
+            w_times_x = indexed_product(x, indices, self.param_index, self.sparse) if self.delta is None else self.delta(x, indices, self.weights)
             
         else:
             w_times_x= torch.mm(x, self.weights.t())
@@ -198,20 +987,18 @@ class IndexedLinearLayer(nn.Module):
         
         return torch.add(w_times_x, self.bias)
 
-class EideticIndexedLinearLayer(nn.Module):
+class EideticIndexedLinearLayer(EideticMixin, BankMixin, nn.Module):
     """ Custom Linear layer but mimics a standard linear layer """
-    def __init__(self, size_in, size_out, n_quantile_rate, quantile_cardinality, num_quantiles, table_number):
+    def __init__(self, size_in, size_out, n_quantile_rate, quantile_cardinality, num_quantiles, table_number, sparse=False, store_mode="reservoir", sketch_size=None, store_path=None, index_cache_size=None, store_dtype="float32", bank="full", bank_rank=4):
         super().__init__()
-        self.size_in, self.size_out, self.table_number = size_in, size_out, table_number
-        weights = torch.Tensor(size_out, size_in)
+        if sparse and bank != "full":
+            raise ValueError("Sparse bank gradients need the full bank, got bank=" + repr(bank))
+        self.size_in, self.size_out, self.sparse = size_in, size_out, sparse
+        weights = torch.empty(size_out, size_in)
         self.weights = nn.Parameter(weights)  # nn.Parameter is a Tensor that's a module parameter.
         
         self.use_indices = False
-        self.outputValues = np.zeros([quantile_cardinality + 1, size_out])
-        self.index = 0
-        self.n_quantile_rate = n_quantile_rate
-        self.quantiles = []
-        self.quantile_cardinality = quantile_cardinality
+        self.init_store(size_out, n_quantile_rate, quantile_cardinality, table_number, store_mode, sketch_size, store_path, store_dtype, index_cache_size)
         # initialize weights and biases
         nn.init.kaiming_uniform_(self.weights, a=math.sqrt(5)) # weight init
         fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weights)
@@ -220,138 +1007,331 @@ class EideticIndexedLinearLayer(nn.Module):
         self.use_previous_indices = False
         self.previous_indices = None
 
-        bias = torch.Tensor(size_out)
+        bias = torch.empty(size_out)
         self.bias = nn.Parameter(bias)
         nn.init.uniform_(self.bias, -bound, bound)  # bias init
 
-        self.param_index = nn.ParameterList()
-        self.device_to_use = os.getenv("DEVICE")
-
-        # Intitialzing parameter list of weights to use in indexing
-        for i in range(0, num_quantiles):
-            for j in range(0, self.size_in):
-                weights = torch.Tensor(self.size_out)
-                for k in range(0, self.size_out):
-                    weights[k] = self.weights[k][j]
-            
-                self.param_index.append(nn.Parameter(weights))
-
-    def calculate_n_quantiles(self, num_quantiles, use_db):
-    
-        if use_db == False:
-            #Every val indicies in our list represent a quantile separaiton point
-            val = int(self.quantile_cardinality / num_quantiles)
-
-            #For every column is our stored list of activations
-            for j in range(0, self.size_out):
-                inner_quantile = []
-
-                #Sort our list by the jth column
-                self.outputValues = self.outputValues[self.outputValues[:,j].argsort(kind='mergesort')]
-
-                #Append to our inner quantile which represents the quantiles for column j
-                for i in range(0, num_quantiles-1):
-                    inner_quantile.append(self.outputValues[val*(i+1)][j])
-                
-                
-                self.quantiles.append(inner_quantile)
-        else:
-            distribution = db.database.create_quantile_distribution(num_quantiles, self.table_number)
-
-            for j in range(0, self.size_out):
-                inner_quantile = []
-                
-                #Append to our inner quantile which represents the quantiles for column j
-                for i in range(0, num_quantiles-1):
-                    inner_quantile.append(distribution[j][i+1])
-                
-                    self.quantiles.append(inner_quantile)
-
-    def binarySearchQuantiles(self, activation, index):
+        #Weight bank of shape (num_quantiles, size_in, size_out), every quantile starts as a copy of weights,
+        #or the weights plus a per-quantile DeltaBank registered after bias
+        self.init_bank(bank, num_quantiles, size_in, size_out, bank_rank)
 
-        return self.__bsqHelper(activation, index, 0, len(self.quantiles[index]))
-     
-    def __bsqHelper(self, activation, index, l, r):
-        quantiles = self.quantiles[index]
-        # Integer division, 5 // 2 == 2
-        mid = (r + l) // 2
-        greater = int(activation > quantiles[mid])
-        if mid == 0 or mid >= len(quantiles) - 1:
-            return mid + greater
-    
-        if activation >= quantiles[mid]:
-            # activation is between bounds
-            if activation < quantiles[mid + 1]:
-                return mid + greater
-            # activation is not at its lower bound
-            else:
-                l = mid
-                return self.__bsqHelper(activation, index, l, r)
-        # Activation not at its upper bound
-        else:
-            r = mid
-            return self.__bsqHelper(activation, index, l, r)
-    
-    def build_index(self, num_quantiles):
+    def index_key(self):
+        """ Changes whenever the thresholds, weights or, when indexing, the bank that decide the bucket ids change """
+        key = (id(self.quantiles), self.weights.data_ptr(), self.weights._version, self.use_indices)
+        if self.use_indices == True:
+            key = key + tuple((p.data_ptr(), p._version) for p in self.bank_parameters())
+        return key
 
-        #Copy weights across indices from the trained weight vector
-        for i in range(0, num_quantiles):
-            for j in range(0, self.size_in):
-                for k in range(0, self.size_out):
-                    with torch.no_grad():
-                        self.param_index[i*self.size_in + j][k] = self.weights[k][j]
-        
-        
-        
-    
-    def set_use_indices(self, val):
-        self.use_indices = val
+    def bank_slice(self):
+        """ One quantile's copy of the weights, (size_in, size_out) """
+        return self.weights.detach().t()
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_param_index(state_dict, prefix, self.size_in)
+        load_quantiles(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
-    #TODO: Figure out how to rewrite forward/backward pass without requiring swapping of weights
-    def forward(self, x, indices, store_activations, get_indices, use_db):
+    def forward(self, x, indices, store_activations, get_indices, use_db, sample_ids=None):
         
         
         if self.use_indices == True:
-
-            final_output = torch.empty(len(x), self.size_out).to(self.device_to_use)
-            for batch in range(0, len(x)):
-                indices = indices[batch]
-                
-                outx = torch.empty(len(x[batch]), self.size_out).to(self.device_to_use)
-                
-                for i,p in enumerate(x[batch]):
-                    index = int(indices[i]) * self.size_in + i
-                    outx[i] = self.param_index[index] * x[batch][i]
-                    
-            
-                final_output[batch] = torch.sum(outx, 0)
-
-            w_times_x = final_output
+            w_times_x = indexed_product(x, indices, self.param_index, self.sparse) if self.delta is None else self.delta(x, indices, self.weights)
             
         else:
             w_times_x= torch.mm(x, self.weights.t())
             
         if store_activations == True:
-            all_activations = w_times_x.detach().cpu().numpy()
-            
-            for activation_vector in all_activations:
-                
-                if use_db == True:
-                    
-                    if self.n_quantile_rate >= random.uniform(0, 1):
-                        db.database.insert_record(activation_vector, self.table_number)
+            self.store_rows(w_times_x, use_db)
 
-                self.outputValues[self.index] = activation_vector
-                self.index = self.index + 1
+        if get_indices == True and self.index_cache is not None and sample_ids is not None:
+            indices = cached_bucketize(self.index_cache, self.index_key(), w_times_x.detach(), self.quantiles, self.quantiles_increasing, sample_ids)
+        elif get_indices == True:
+            indices = bucketize(w_times_x.detach(), self.quantiles, self.quantiles_increasing)
+        else:
+            indices = torch.zeros([len(w_times_x), self.size_out], dtype=torch.long, device=w_times_x.device)
 
-        indices = torch.zeros([len(w_times_x), self.size_out])
-        
-        if get_indices == True:
-            for j in range(0, len(w_times_x)):
-                for i in range(0, self.size_out):
-                    indices[j][i] = self.binarySearchQuantiles(w_times_x[j][i].item(), i)
+        if get_indices == True and metrics.recorder.enabled:
+            metrics.recorder.count("bucket_lookups_" + str(self.table_number), indices.numel())
+            metrics.recorder.occupancy("bucket_occupancy_" + str(self.table_number), indices, self.quantiles.shape[1] + 1)
 
  
         
         return [torch.add(w_times_x, self.bias), indices] 
+
+class EideticConv2d(EideticMixin, BankMixin, nn.Module):
+    """ Conv2d counterpart of EideticIndexedLinearLayer
+
+    Activations are stored, and bucketed with the same thresholds, per output channel: every
+    spatial position of a sample is one row of out_channels values. forward returns the bucket id
+    of every output element, and with use_indices every input element picks its kernel slice from
+    the (num_quantiles, out_channels, in_channels, kh, kw) bank by the bucket id the previous
+    EideticConv2d gave it, see indexed_conv2d. That costs num_quantiles convs; bank="scale" keeps
+    a per-bucket input-channel scale and output-channel shift instead (DeltaBank.conv2d), which
+    costs about one.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size, n_quantile_rate, quantile_cardinality, num_quantiles, table_number, stride=1, padding=0, store_mode="reservoir", sketch_size=None, store_path=None, store_dtype="float32", bank="full"):
+        super().__init__()
+        if bank not in ("full", "scale"):
+            raise ValueError("EideticConv2d supports the full and scale banks, got bank=" + repr(bank))
+        self.in_channels, self.out_channels = in_channels, out_channels
+        self.kernel_size = (kernel_size, kernel_size) if isinstance(kernel_size, int) else tuple(kernel_size)
+        self.stride, self.padding = stride, padding
+        self.weights = nn.Parameter(torch.empty(out_channels, in_channels, *self.kernel_size))
+        self.bias = nn.Parameter(torch.empty(out_channels))
+
+        self.use_indices = False
+        self.init_store(out_channels, n_quantile_rate, quantile_cardinality, table_number, store_mode, sketch_size, store_path, store_dtype)
+
+        # initialize weights and biases as nn.Conv2d does
+        nn.init.kaiming_uniform_(self.weights, a=math.sqrt(5))
+        fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weights)
+        bound = 1 / math.sqrt(fan_in)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+        #Kernel bank of shape (num_quantiles, out_channels, in_channels, kh, kw), every quantile starts as a copy of weights
+        self.init_bank(bank, num_quantiles, in_channels, out_channels)
+
+    def bank_slice(self):
+        """ One quantile's copy of the kernels, (out_channels, in_channels, kh, kw) """
+        return self.weights.detach()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        load_quantiles(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, indices, store_activations, get_indices, use_db):
+
+        if self.use_indices == True and self.delta is not None:
+            w_times_x = self.delta.conv2d(x, indices, self.weights, self.stride, self.padding)
+        elif self.use_indices == True:
+            w_times_x = indexed_conv2d(x, indices, self.param_index, self.stride, self.padding)
+        else:
+            w_times_x = F.conv2d(x, self.weights, None, self.stride, self.padding)
+
+        batch, _, height, width = w_times_x.shape
+        if store_activations == True:
+            #One row of out_channels values per sample and position
+            self.store_rows(w_times_x.detach().permute(0, 2, 3, 1).reshape(-1, self.out_channels), use_db)
+
+        if get_indices == True:
+            channels = w_times_x.detach().transpose(0, 1).reshape(self.out_channels, -1)
+            indices = bucketize_channels(channels, self.quantiles, self.quantiles_increasing).reshape(self.out_channels, batch, height, width).transpose(0, 1)
+        else:
+            #Bucket 0 everywhere, as a broadcast view rather than a filled tensor
+            indices = torch.zeros((), dtype=torch.long, device=w_times_x.device).expand(w_times_x.shape)
+
+        if get_indices == True and metrics.recorder.enabled:
+            metrics.recorder.count("bucket_lookups_" + str(self.table_number), indices.numel())
+            metrics.recorder.occupancy("bucket_occupancy_" + str(self.table_number), indices, self.quantiles.shape[1] + 1)
+
+        return [w_times_x + self.bias.view(1, -1, 1, 1), indices]
+
+class TaskBanks():
+    """ Per-task thresholds and weight banks for an EideticIndexedLinearLayer and the IndexedLinearLayer it indexes
+
+    Each task owns the eidetic layer's quantiles and the indexed layer's bank (param_index, or the
+    DeltaBank parameters) and use_indices; activate swaps them into the layers without copying, so
+    the bank stays the same Parameters for the optimizer. With optimizer given, each task also owns
+    the optimizer's state of those Parameters, so one task's running averages never drive another
+    task's updates and a new task starts with none. Tasks are kept in LRU order and, once the resident tasks take more
+    than budget_bytes, the least recently used ones are written to path (only if changed since they
+    were last read) and dropped, so memory follows the working set rather than the number of tasks.
+    The active task is always resident.
+    """
+    def __init__(self, eidetic, indexed, path, budget_bytes=None, optimizer=None):
+        self.eidetic, self.indexed, self.path, self.budget_bytes, self.optimizer = eidetic, indexed, path, budget_bytes, optimizer
+        self.resident = collections.OrderedDict()
+        self.paged = set()
+        self.active = None
+        self.applied_version = None
+        self.page_ins = 0
+        self.page_outs = 0
+        os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, task):
+        return task in self.resident or task in self.paged
+
+    def tasks(self):
+        return list(self.resident) + [task for task in self.paged if task not in self.resident]
+
+    def resident_bytes(self):
+        return sum(sum(t.nbytes for t in entry["bank"]) + (entry["quantiles"].nbytes if entry["quantiles"] is not None else 0)
+                   + sum(value.nbytes for state in entry["optimizer"] for value in state.values() if torch.is_tensor(value)) for entry in self.resident.values())
+
+    def add(self, task):
+        """ Registers task with no thresholds and a bank of copies of the shared weights, and activates it """
+        if task in self:
+            raise ValueError("Task " + str(task) + " is already registered")
+        self.__capture()
+        self.resident[task] = {"quantiles": None, "bank": self.indexed.initial_bank(), "use_indices": False, "optimizer": [{} for _ in self.indexed.bank_parameters()]}
+        self.__apply(task)
+        self.__evict()
+
+    def activate(self, task):
+        """ Makes task's thresholds and bank the layers' own, reading them back from disk if paged out """
+        if task == self.active:
+            return
+        if task not in self:
+            raise KeyError("Unknown task " + str(task))
+        self.__capture()
+        if task not in self.resident:
+            self.__page_in(task)
+        self.resident.move_to_end(task)
+        self.__apply(task)
+        self.__evict()
+
+    def __file(self, task):
+        return os.path.join(self.path, "task_" + str(task) + ".pt")
+
+    def __capture(self):
+        #set_quantiles and set_use_indices replace attributes, the bank is updated in place
+        if self.active is not None:
+            entry = self.resident[self.active]
+            if self.__version() != self.applied_version:
+                entry.pop("saved", None)
+            entry.update(quantiles=self.eidetic.quantiles, bank=[p.data for p in self.indexed.bank_parameters()], use_indices=self.indexed.use_indices)
+            if self.optimizer is not None:
+                entry["optimizer"] = [self.optimizer.state.pop(p, {}) for p in self.indexed.bank_parameters()]
+
+    def __apply(self, task):
+        entry = self.resident[task]
+        if entry["quantiles"] is None:
+            self.eidetic.quantiles = None
+        else:
+            self.eidetic.set_quantiles(entry["quantiles"])
+            entry["quantiles"] = self.eidetic.quantiles
+        for param, tensor, state in zip(self.indexed.bank_parameters(), entry["bank"], entry["optimizer"]):
+            param.data = tensor
+            if self.optimizer is not None and state:
+                self.optimizer.state[param] = state
+            elif self.optimizer is not None:
+                self.optimizer.state.pop(param, None)
+        self.indexed.set_use_indices(entry["use_indices"])
+        self.active = task
+        self.applied_version = self.__version()
+
+    def __version(self):
+        return tuple(p._version for p in self.indexed.bank_parameters())
+
+    def __page_in(self, task):
+        entry = torch.load(self.__file(task), map_location=self.indexed.weights.device, weights_only=True)
+        #Unchanged tasks are not written again when evicted
+        entry["saved"] = (entry["quantiles"], entry["use_indices"])
+        self.resident[task] = entry
+        self.page_ins = self.page_ins + 1
+        metrics.recorder.count("bank_page_ins")
+
+    def __evict(self):
+        while self.budget_bytes is not None and len(self.resident) > 1 and self.resident_bytes() > self.budget_bytes:
+            task, entry = next(iter(self.resident.items()))
+            saved = entry.pop("saved", None)
+            if saved is None or saved[0] is not entry["quantiles"] or saved[1] != entry["use_indices"]:
+                torch.save({"quantiles": entry["quantiles"], "bank": entry["bank"], "use_indices": entry["use_indices"], "optimizer": entry["optimizer"]}, self.__file(task))
+                self.page_outs = self.page_outs + 1
+                metrics.recorder.count("bank_page_outs")
+            del self.resident[task]
+            self.paged.add(task)
+
+#Scale granularities of the int8 frozen layers: one scale per bank row (bucket, input feature) or per bucket
+QUANTIZE_GRANULARITIES = ("row", "bucket")
+
+def quantize_int8(matrix, rows_per_scale=1):
+    """ Symmetric int8 codes of a (rows, cols) matrix and the float32 scale of every row
+
+    Blocks of rows_per_scale consecutive rows share a scale, so a flattened (num_quantiles * size_in,
+    size_out) bank gets per-row scales with 1 and per-bucket scales with size_in.
+    """
+    blocks = matrix.detach().reshape(-1, rows_per_scale * matrix.shape[1])
+    scales = (blocks.abs().amax(1) / 127).clamp(min=1e-12)
+    codes = torch.round(blocks / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+    return codes.reshape(matrix.shape), scales.repeat_interleave(rows_per_scale).to(torch.float32)
+
+def quantize_samples(x):
+    # type: (Tensor) -> Tuple[Tensor, Tensor]
+    """ int8 codes of a (batch, features) input with one dynamic scale per sample, and the (batch, 1) scales """
+    scales = (x.abs().amax(1, keepdim=True) / 127).clamp(min=1e-12)
+    return torch.round(x / scales).to(torch.int8), scales
+
+def int8_matmul(x, codes, scales):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    """ x @ (codes * scales[:, None]) as one int8 x int8 -> int32 torch._int_mm
+
+    The per-row weight scales are folded into x, which is then quantized per sample, so the
+    weights are read as int8 and never widened to float.
+    """
+    x_codes, x_scales = quantize_samples(x * scales)
+    return torch._int_mm(x_codes, codes).to(x.dtype) * x_scales
+
+class FrozenLinearLayer(nn.Module):
+    """ Inference-only copy of an eidetic or indexed layer: plain tensors and flags, no store, numpy or DB
+
+    get_indices freezes the layer's thresholds so forward also returns bucket ids, indexed_input
+    says whether the previous layer produces them. A bank fed by a layer without bucket ids only
+    ever sees bucket 0, so it is folded into plain weights. Delta banks are materialized into the
+    full bank. Banks are applied as one matmul of a (batch, num_quantiles * size_in) scattered
+    input with the flattened bank, a view of the layer's full bank rather than a copy, so a
+    memory-mapped bank stays mapped; freeze again after training the layer further. Works with
+    torch.jit.script and torch.compile.
+
+    quantize, one of QUANTIZE_GRANULARITIES, keeps the weights and bank as int8 codes with a scale
+    per row or per bucket and multiplies them with int8_matmul; thresholds and bias stay float. A
+    layer that reads no bank but whose outputs are bucketed stays float as well: it saves no bank
+    memory, and its rounding would only move activations across the thresholds.
+    """
+    def __init__(self, layer, get_indices, indexed_input, quantize=None):
+        super().__init__()
+        if quantize is not None and quantize not in QUANTIZE_GRANULARITIES:
+            raise ValueError("Unknown quantization " + repr(quantize) + ", expected one of " + ", ".join(QUANTIZE_GRANULARITIES))
+        weights = layer.weights.detach()
+        use_bank = hasattr(layer, "bank_weights") and layer.use_indices == True
+        bank = layer.bank_weights().detach() if use_bank else None
+        if use_bank and not indexed_input:
+            weights, use_bank = bank[0].t(), False
+
+        self.size_in = layer.size_in
+        self.use_bank = use_bank
+        self.get_indices = get_indices
+        bank = bank.reshape(-1, layer.size_out) if use_bank else torch.empty(0, 0)
+        weight_scales = bank_scales = torch.empty(0)
+        self.quantized = quantize is not None and (use_bank or not get_indices)
+        if self.quantized:
+            #The plain weights have no buckets, per bucket means one scale for the whole matrix
+            rows_per_scale = 1 if quantize == "row" else layer.size_in
+            codes, weight_scales = quantize_int8(weights.t(), rows_per_scale)
+            weights = codes.t()
+            if use_bank:
+                bank, bank_scales = quantize_int8(bank, rows_per_scale)
+
+        self.register_buffer("weights", weights.clone().contiguous())
+        self.register_buffer("weight_scales", weight_scales)
+        self.register_buffer("bias", layer.bias.detach().clone())
+        self.register_buffer("bank", bank)
+        self.register_buffer("bank_scales", bank_scales)
+        self.register_buffer("quantiles", layer.quantiles.detach().clone().contiguous() if get_indices else torch.empty(0, 0))
+        n = self.quantiles.shape[1]
+        self.searchsorted = get_indices and layer.quantiles_increasing and n != 2
+        self.steps = n.bit_length() + 1
+
+    def forward(self, x, indices):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        if self.use_bank and self.quantized:
+            #int8_matmul on the scattered input, quantized before scattering so only size_in values per sample are touched
+            slots = indices * self.size_in + torch.arange(self.size_in, device=x.device)
+            x_codes, x_scales = quantize_samples(x * self.bank_scales[slots])
+            scattered = torch.zeros(x.shape[0], self.bank.shape[0], dtype=torch.int8, device=x.device).scatter_(1, slots, x_codes)
+            w_times_x = torch._int_mm(scattered, self.bank).to(x.dtype) * x_scales
+        elif self.use_bank:
+            features = torch.arange(self.size_in, device=x.device)
+            scattered = x.new_zeros(x.shape[0], self.bank.shape[0]).scatter_(1, indices * self.size_in + features, x)
+            w_times_x = torch.mm(scattered, self.bank)
+        elif self.quantized:
+            w_times_x = int8_matmul(x, self.weights.t(), self.weight_scales)
+        else:
+            w_times_x = torch.mm(x, self.weights.t())
+
+        if self.get_indices and self.searchsorted:
+            indices = torch.searchsorted(self.quantiles, w_times_x.t().contiguous()).t()
+        elif self.get_indices:
+            indices = bisect_buckets(w_times_x, self.quantiles, self.steps)
+
+        return w_times_x + self.bias, indices
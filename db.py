@@ -1,33 +1,181 @@
 
-import psycopg2
+import io
+import numpy as np
+import config
+import metrics
 
 import os
-from dotenv import load_dotenv
-load_dotenv()
 
 
+#Activation column type and binary COPY field type for each storage dtype
+COLUMN_TYPES = {"float64": ("double precision", ">f8"), "float32": ("real", ">f4"), "int16": ("smallint", ">i2")}
+#Element type oid and text format of the wide layout's arrays
+ARRAY_ELEMENTS = {">f8": (701, "%.17g"), ">f4": (700, "%.9g")}
+
+def copy_tuple(field_type=">f8"):
+    """ Binary COPY layout of one (node_id int4, activation) tuple """
+    return np.dtype([("fields", ">i2"), ("node_length", ">i4"), ("node_id", ">i4"), ("activation_length", ">i4"), ("activation", field_type)])
+
+COPY_TUPLE = copy_tuple()
+COPY_HEADER = b"PGCOPY\n\377\r\n\0" + np.zeros(2, dtype=">i4").tobytes()
+COPY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+
+def copy_binary(records, field_type=">f8"):
+    """ Encodes a (samples, size_out) block as a binary COPY stream of (node_id, activation) rows """
+    samples, size_out = records.shape
+    tuples = np.empty(samples * size_out, dtype=copy_tuple(field_type))
+    tuples["fields"] = 2
+    tuples["node_length"] = 4
+    tuples["node_id"] = np.tile(np.arange(1, size_out + 1), samples)
+    tuples["activation_length"] = np.dtype(field_type).itemsize
+    tuples["activation"] = records.reshape(-1)
+    return COPY_HEADER + tuples.tobytes() + COPY_TRAILER
+
+def copy_text(records):
+    """ Encodes a (samples, size_out) block as a text COPY stream of (node_id, activation) rows """
+    samples, size_out = records.shape
+    rows = np.column_stack([np.tile(np.arange(1, size_out + 1), samples), records.reshape(-1)])
+    stream = io.StringIO()
+    np.savetxt(stream, rows, fmt=["%d", "%d" if records.dtype.kind == "i" else "%.17g"], delimiter="\t")
+    return stream.getvalue()
+
+def copy_binary_wide(records, field_type=">f4"):
+    """ Encodes a (samples, size_out) block as a binary COPY stream of one real[] (or double precision[]) row per sample """
+    samples, size_out = records.shape
+    element = np.dtype([("length", ">i4"), ("value", field_type)])
+    #Array payload: ndim, has-null flag, element type oid (700 = float4, 701 = float8), length and lower bound, elements
+    array_header = np.dtype([("ndim", ">i4"), ("has_null", ">i4"), ("element_type", ">i4"), ("length", ">i4"), ("lower_bound", ">i4")])
+    wide_tuple = np.dtype([("fields", ">i2"), ("array_length", ">i4"), ("array", array_header), ("elements", element, (size_out,))])
+
+    tuples = np.empty(samples, dtype=wide_tuple)
+    tuples["fields"] = 1
+    tuples["array_length"] = array_header.itemsize + size_out * element.itemsize
+    tuples["array"] = (1, 0, ARRAY_ELEMENTS[field_type][0], size_out, 1)
+    tuples["elements"]["length"] = np.dtype(field_type).itemsize
+    tuples["elements"]["value"] = records
+    return COPY_HEADER + tuples.tobytes() + COPY_TRAILER
+
+def copy_text_wide(records, field_type=">f4"):
+    """ Encodes a (samples, size_out) block as a text COPY stream of one {a,b,...} array per sample """
+    stream = io.StringIO()
+    #Rounded to the element type first, so Postgres parses back exactly the values COPY binary would send
+    np.savetxt(stream, records.astype(field_type), fmt=ARRAY_ELEMENTS[field_type][1], delimiter=",")
+    return "".join("{" + line + "}\n" for line in stream.getvalue().splitlines())
+
 class Database():
-    """ Custom Linear layer but mimics a standard linear layer """
-    def __init__(self):
-        connection = psycopg2.connect(database=os.getenv("DATABASE"), user=os.getenv("USER"), password=os.getenv("PASSWORD"), host=os.getenv("HOST"), port=os.getenv("PORT"))
-        connection.autocommit = True
-        self.connection = connection
+    """ Postgres store for activations and their quantile distributions
+
+    Activations are buffered per table and written with one COPY ... FROM STDIN per flush_size
+    samples (binary format unless copy_format="text"). Call flush or close to write what is left.
+
+    layout (DB_LAYOUT) picks the activation schema: "long" stores one (node_id, activation) row per
+    scalar, "wide" one (sample_id, activations[]) row per sample, size_out times fewer rows.
+
+    dtype (DB_DTYPE) is the activation column, or the wide layout's array element: "float64"
+    (double precision), "float32" (real) or, long layout only, "int16" (smallint codes with a
+    per-node scale and offset kept on this object, widened like ActivationStore's and re-encoded
+    in place with one UPDATE).
+
+    Settings come from config.get(). The connection is opened on first use, each process opens
+    its own, and threads of one process share it.
+    """
+    def __init__(self, flush_size=None, copy_format="binary", layout=None, dtype=None):
+        settings = config.get()
+        self.settings = dict(database=settings.database, user=settings.user, password=settings.password, host=settings.host, port=settings.port)
+        self.__connection = None
+        self.__pid = None
+        self.flush_size = flush_size if flush_size is not None else settings.db_flush_size
+        self.copy_format = copy_format
+        self.layout = layout if layout is not None else settings.db_layout
+        self.sample_percent = settings.db_sample_percent
+        self.row_cap = settings.db_row_cap
+        self.dtype = dtype if dtype is not None else settings.db_dtype
+        if self.layout not in ("long", "wide"):
+            raise ValueError("Unknown activation table layout: " + str(self.layout))
+        if self.dtype not in COLUMN_TYPES or (self.layout == "wide" and self.dtype == "int16"):
+            raise ValueError("Unsupported activation dtype for the " + self.layout + " layout: " + str(self.dtype))
+        self.buffers = {}
+        self.buffered = {}
+        self.ranges = {}
+
+    @property
+    def connection(self):
+        #Connects on first use, and again in a forked worker, which must not share its parent's socket
+        if self.__connection is None or self.__pid != os.getpid():
+            import psycopg2
+            self.__connection = psycopg2.connect(**self.settings)
+            self.__connection.autocommit = True
+            self.__pid = os.getpid()
+        return self.__connection
 
     def insert_record(self, record, table_number):
+        self.insert_records(np.asarray(record)[None, :], table_number)
 
-        record_str = ""
-        i = 1
-        for val in record:
-            if i != len(record):
-                record_str = record_str + "(" + str(i) +", " + str(val) + "),"
-            else: 
-                record_str = record_str + "(" + str(i) +", " + str(val) + ");"
-            i = i + 1
-            
-        
+    def insert_records(self, records, table_number):
+        """ Buffers a (samples, size_out) block of activations for table_number """
+        records = np.asarray(records, dtype=np.float64)
+        if len(records) == 0:
+            return
+
+        self.buffers.setdefault(table_number, []).append(records)
+        self.buffered[table_number] = self.buffered.get(table_number, 0) + len(records)
+        if self.buffered[table_number] >= self.flush_size:
+            self.flush(table_number)
+
+    def flush(self, table_number=None):
+        """ Writes the buffered activations of one table, or of every table, with a single COPY each """
+        table_numbers = list(self.buffers) if table_number is None else [table_number]
         cursor = self.connection.cursor()
 
-        cursor.execute("INSERT INTO percentile_activations_" + str(table_number) + "(node_id, activation) values " + record_str)
+        for number in table_numbers:
+            blocks = self.buffers.pop(number, [])
+            self.buffered.pop(number, None)
+            if len(blocks) == 0:
+                continue
+
+            records = np.concatenate(blocks)
+            table = "percentile_activations_" + str(number)
+            metrics.recorder.count("db_rows_" + str(number), len(records) if self.layout == "wide" else records.size)
+            if self.dtype == "int16":
+                records = self.__encode(cursor, number, records)
+            if self.layout == "wide" and self.copy_format == "binary":
+                cursor.copy_expert("COPY " + table + " (activations) FROM STDIN WITH (FORMAT binary)", io.BytesIO(copy_binary_wide(records, COLUMN_TYPES[self.dtype][1])))
+            elif self.layout == "wide":
+                cursor.copy_expert("COPY " + table + " (activations) FROM STDIN", io.StringIO(copy_text_wide(records, COLUMN_TYPES[self.dtype][1])))
+            elif self.copy_format == "binary":
+                cursor.copy_expert("COPY " + table + " (node_id, activation) FROM STDIN WITH (FORMAT binary)", io.BytesIO(copy_binary(records, COLUMN_TYPES[self.dtype][1])))
+            else:
+                cursor.copy_expert("COPY " + table + " (node_id, activation) FROM STDIN", io.StringIO(copy_text(records)))
+
+    def __encode(self, cursor, table_number, records):
+        #Codes span [-32767, 32767] over [offset, offset + 65534 * scale] per node
+        low, high = records.min(0), records.max(0)
+        if table_number in self.ranges:
+            offset, scale = self.ranges[table_number]
+            top = offset + scale * 65534
+            if np.all(low >= offset) and np.all(high <= top):
+                return np.round((records - offset) / scale - 32767).astype(np.int16)
+            low, high = np.minimum(low, offset), np.maximum(high, top)
+            margin = (high - low) / 4
+            low, high = low - margin, high + margin
+
+        new_scale = np.maximum((high - low) / 65534, 1e-12)
+        if table_number in self.ranges:
+            #code' = code * multiplier + shift maps every stored code onto the widened range
+            multiplier, shift = scale / new_scale, (32767 * scale + offset - low) / new_scale - 32767
+            factors = ", ".join("(" + str(node) + ", " + repr(float(m)) + ", " + repr(float(b)) + ")" for node, (m, b) in enumerate(zip(multiplier, shift), 1))
+            cursor.execute("update percentile_activations_" + str(table_number) + " as activations set activation = round(activation * factors.m + factors.b) from (values " + factors + ") as factors(node_id, m, b) where activations.node_id = factors.node_id")
+            #Lets the following COPYs reuse the space of the rewritten rows
+            cursor.execute("vacuum percentile_activations_" + str(table_number))
+        self.ranges[table_number] = (low, new_scale)
+        return np.round((records - low) / new_scale - 32767).astype(np.int16)
+
+    def close(self):
+        if self.buffers:
+            self.flush()
+        if self.__connection is not None and self.__pid == os.getpid():
+            self.__connection.close()
+        self.__connection = None
 
     def recreate_tables(self, num_quantiles, table_number):
 
@@ -36,10 +184,16 @@ class Database():
             
         cursor = self.connection.cursor()
 
-        sql_1 = '''create table percentile_activations_''' + str(table_number) + '''(
-            node_id		int not null,
-            activation	double precision not null
-        );'''
+        if self.layout == "wide":
+            sql_1 = '''create table percentile_activations_''' + str(table_number) + '''(
+                sample_id	bigint generated by default as identity,
+                activations	''' + COLUMN_TYPES[self.dtype][0] + '''[] not null
+            );'''
+        else:
+            sql_1 = '''create table percentile_activations_''' + str(table_number) + '''(
+                node_id		int not null,
+                activation	''' + COLUMN_TYPES[self.dtype][0] + ''' not null
+            );'''
 
         sql_2 = '''CREATE INDEX node_idx_''' + str(table_number) + ''' ON percentile_activations_'''+ str(table_number) +''' (node_id);'''
         
@@ -66,36 +220,78 @@ class Database():
 
         cursor.execute(sql_5)
         cursor.execute(sql_6)
+        self.ranges.pop(table_number, None)
         cursor.execute(sql_1)
-        cursor.execute(sql_2)
+        if self.layout == "long":
+            cursor.execute(sql_2)
         cursor.execute(sql_3)
         cursor.execute(sql_4)
 
-    def create_quantile_distribution(self, num_quantiles, table_number):
+    def create_quantile_distribution(self, num_quantiles, table_number, sample_percent=None, row_cap=None):
+        """ Replaces the distribution of table_number and returns it as a (size_out, num_quantiles-1) array
+
+        Every node's thresholds come from a single percentile_disc(ARRAY[...]) sort. For approximate
+        thresholds on huge tables, sample_percent (DB_SAMPLE_PERCENT) reads a TABLESAMPLE BERNOULLI
+        sample of the activation table and row_cap (DB_ROW_CAP) stops after that many table rows.
+        """
+        self.flush(table_number)
         cursor = self.connection.cursor()
+        sample_percent = sample_percent if sample_percent is not None else self.sample_percent
+        row_cap = row_cap if row_cap is not None else self.row_cap
 
-        extended_query = ""
+        fractions = "array[" + ", ".join(str(i / float(num_quantiles)) for i in range(1, num_quantiles)) + "]"
+        columns = ", ".join("thresholds[" + str(i) + "]" for i in range(1, num_quantiles))
+        decode = ""
+        if self.dtype == "int16" and table_number in self.ranges:
+            #Thresholds are selected on the codes and stored as activations
+            offset, scale = self.ranges[table_number]
+            columns = ", ".join("(thresholds[" + str(i) + "] + 32767) * codes.scale + codes.shift" for i in range(1, num_quantiles))
+            decode = " join (values " + ", ".join("(" + str(node) + ", " + repr(float(a)) + ", " + repr(float(b)) + ")" for node, (a, b) in enumerate(zip(scale, offset), 1)) + ") as codes(node_id, scale, shift) using (node_id)"
 
-        for i in range(1, num_quantiles):
-            val = i / float((num_quantiles))
-            if i != num_quantiles -1:
-                extended_query = extended_query + "percentile_disc(" + str(val) + ") within group (order by percentile_activations_" + str(table_number) + ".activation),\n"
-            else:
-                extended_query = extended_query + "percentile_disc(" + str(val) + ") within group (order by percentile_activations_" + str(table_number) + ".activation)\n"
+        table = "percentile_activations_" + str(table_number)
+        source = table
+        if sample_percent is not None:
+            source = source + " tablesample bernoulli (" + str(float(sample_percent)) + ")"
+        if row_cap is not None:
+            source = "(select * from " + source + " limit " + str(int(row_cap)) + ") as capped"
+
+        if self.layout == "wide":
+            #One pass over one sample of the compact table, unnesting every row into its nodes
+            distribution = '''select node_id, percentile_disc(''' + fractions + ''') within group (order by activation) as thresholds
+            from ''' + source + ''', unnest(activations) with ordinality as node(activation, node_id)
+            group by node_id'''
+        else:
+            distribution = '''select node_id, percentile_disc(''' + fractions + ''') within group (order by activation) as thresholds
+            from ''' + source + '''
+            group by node_id'''
+
+        #Clearing and refilling in one statement keeps a single distribution per table, and an empty
+        #sample keeps the previous one
+        query = '''with distribution as (''' + distribution + '''),
+        cleared as (delete from percentile_distribution_''' + str(table_number) + ''' where exists (select from distribution))
+        insert into percentile_distribution_''' + str(table_number) + '''
+        select node_id, ''' + columns + '''
+        from distribution''' + decode + '''
+        returning *;'''
 
-        query = '''insert into percentile_distribution_''' + str(table_number) + ''' \n select node_id,
-        ''' + extended_query + '''
-        from percentile_activations_''' + str(table_number) + '''
-            group by node_id
-            order by node_id;'''
-        
         cursor.execute(query)
-        
-        query_2 = "select * from percentile_distribution_" + str(table_number)
-        cursor.execute(query_2)
-        rows = cursor.fetchall()
-        
-        return rows
-        
-if os.getenv("USE_DB") == "True":
-    database = Database()
\ No newline at end of file
+        rows = np.array(sorted(cursor.fetchall()), dtype=np.float64)
+        if len(rows) == 0:
+            raise ValueError("No activations to compute the distribution of " + table + " from (sample_percent=" + str(sample_percent) + ", row_cap=" + str(row_cap) + ")")
+
+        return rows[:, 1:]
+
+_database = None
+
+def get_database():
+    """ The process's shared Database, created on first use """
+    global _database
+    if _database is None:
+        _database = Database()
+    return _database
+
+def __getattr__(name):
+    #db.database stays available without connecting at import
+    if name == "database":
+        return get_database()
+    raise AttributeError("module 'db' has no attribute " + repr(name))
\ No newline at end of file
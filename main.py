@@ -1,36 +1,51 @@
 import argparse
+import copy
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
 from torch.optim.lr_scheduler import StepLR
 import customlayers
 import logging 
 import numpy as np
+import config
 import db
-
-from dotenv import load_dotenv
-load_dotenv()
+import metrics
 
 import os
+import socket
+import sys
 import time
 
-logging.basicConfig(filename='benchmark.log', filemode='a', level=logging.DEBUG)
-logging.info("Started")
+#Phases of main() timed by --metrics, in schedule order
+PHASES = ["eval_untrained", "pretraining", "eval_task_a_pretraining", "eval_task_b_pretraining", "activation_storage", "quantiles", "index_build", "eidetic_training", "eval_task_b", "eval_task_a", "eval_tasks", "eval_quantized"]
 
 class Net(nn.Module):
-    def __init__(self):
+    def __init__(self, sparse_bank=False, sketch_size=None, index_cache_size=None, store_dtype="float32", num_quantiles=None, quantile_cardinality=None, bank="full", bank_rank=4, in_memory_stores=False):
         super(Net, self).__init__()
+        settings = config.get()
+        num_quantiles = num_quantiles or settings.num_quantiles
+        quantile_cardinality = quantile_cardinality or settings.task_b_subset_cardinality
+        #Constructor arguments, saved with checkpoints so load_checkpoint can rebuild the same shapes
+        self.config = dict(sparse_bank=sparse_bank, sketch_size=sketch_size, index_cache_size=index_cache_size, store_dtype=store_dtype,
+                           num_quantiles=num_quantiles, quantile_cardinality=quantile_cardinality, bank=bank, bank_rank=bank_rank)
         self.conv1 = nn.Conv2d(1, 32, 3, 1)
         self.conv2 = nn.Conv2d(32, 64, 3, 1)
         self.dropout1 = nn.Dropout(0.25)
         self.dropout2 = nn.Dropout(0.5)
         self.fc1 = nn.Linear(9216, 128)
         self.fc2 = nn.Linear(128, 36)
-        self.eidetic= customlayers.EideticLinearLayer(36, 36, 1.0, int(os.getenv("TASK_B_SUBSET_CARDINALITY")), 1)
-        self.eideticIndexed= customlayers.EideticIndexedLinearLayer(36, 36, 1.0, int(os.getenv("TASK_B_SUBSET_CARDINALITY")), int(os.getenv("NUM_QUANTILES")), 2)
-        self.indexed= customlayers.IndexedLinearLayer(36, 36, int(os.getenv("NUM_QUANTILES")))
+        #Memory-mapped activation files instead of the in-memory store when ACTIVATION_DIR is set,
+        #one directory per rank as ranks append concurrently; merged_quantiles gathers them all.
+        #in_memory_stores leaves the files alone, opening a MemmapActivationStore resets its file
+        store_path = None if in_memory_stores else settings.activation_dir
+        if store_path is not None and customlayers.distributed():
+            store_path = os.path.join(store_path, "rank_" + str(dist.get_rank()))
+        self.eidetic= customlayers.EideticLinearLayer(36, 36, 1.0, quantile_cardinality, 1, sketch_size=sketch_size, store_path=store_path, index_cache_size=index_cache_size, store_dtype=store_dtype)
+        self.eideticIndexed= customlayers.EideticIndexedLinearLayer(36, 36, 1.0, quantile_cardinality, num_quantiles, 2, sparse_bank, sketch_size=sketch_size, store_path=store_path, index_cache_size=index_cache_size, store_dtype=store_dtype, bank=bank, bank_rank=bank_rank)
+        self.indexed= customlayers.IndexedLinearLayer(36, 36, num_quantiles, sparse_bank, bank, bank_rank)
         self.indexed_layers = {}
         self.indexed_layers["1"] = self.eideticIndexed
         self.indexed_layers["2"] = self.indexed
@@ -39,7 +54,13 @@ class Net(nn.Module):
         self.eidetic_layers["1"] = self.eidetic
         self.eidetic_layers["2"] = self.eideticIndexed
 
-    def forward(self, x, calculate_distribution, get_indices, use_db):
+        #Per-task layer 2 thresholds and banks, see enable_tasks
+        self.tasks = None
+
+    def forward(self, x, calculate_distribution, get_indices, use_db, sample_ids=None, task=None):
+        return self.head(self.backbone(x), calculate_distribution, get_indices, use_db, sample_ids, task)
+
+    def backbone(self, x):
         x = self.conv1(x)
         x = F.relu(x)
         x = self.conv2(x)
@@ -51,40 +72,226 @@ class Net(nn.Module):
         x = F.relu(x)
         x = self.dropout2(x)
         x = self.fc2(x)
-        [x, idxs] = self.eidetic(x, calculate_distribution[0], get_indices[0], use_db[0])
-        [x, idxs] = self.eideticIndexed(x, idxs, calculate_distribution[1], get_indices[1], use_db[1])
+        return x
+
+    def head(self, x, calculate_distribution, get_indices, use_db, sample_ids=None, task=None):
+        if task is not None:
+            self.tasks.activate(task)
+        [x, idxs] = self.eidetic(x, calculate_distribution[0], get_indices[0], use_db[0], sample_ids)
+        [x, idxs] = self.eideticIndexed(x, idxs, calculate_distribution[1], get_indices[1], use_db[1], sample_ids)
         x = self.indexed(x, idxs)
         
         output = F.log_softmax(x, dim=1)
         return output
 
+    def backbone_parameters(self):
+        for layer in [self.conv1, self.conv2, self.fc1, self.fc2]:
+            yield from layer.parameters()
+
     def unfreeze_eidetic_layers(self):
         self.indexed.unfreeze_params()
 
     def use_indices(self, val, table_number):
         self.indexed_layers[table_number].set_use_indices(val)
 
-    def calculate_n_quantiles(self, num_quantiles, use_db, table_number):
-      self.eidetic_layers[table_number].calculate_n_quantiles(num_quantiles, use_db)
+    def calculate_n_quantiles(self, num_quantiles, use_db, table_number, interpolation="index"):
+      self.eidetic_layers[table_number].calculate_n_quantiles(num_quantiles, use_db, interpolation)
 
     def index_layers(self, num_quantiles, table_number):
         # self.eidetic.build_index(num_quantiles)
         self.indexed_layers[table_number].build_index(num_quantiles)
 
+    def enable_tasks(self, path, budget_bytes=None, optimizer=None):
+        """ Gives every task registered with self.tasks.add its own layer 2 thresholds and bank, and optimizer state of the bank, paged to path beyond budget_bytes """
+        self.tasks = customlayers.TaskBanks(self.eideticIndexed, self.indexed, path, budget_bytes, optimizer)
+        return self.tasks
+
+    def close_stores(self):
+        """ Trims the memory-mapped activation files of ACTIVATION_DIR to their rows and closes them """
+        for layer in self.eidetic_layers.values():
+            if isinstance(layer.activations, customlayers.MemmapActivationStore):
+                layer.activations.close()
+
+    def freeze(self, get_indices, quantize=None):
+        """ Inference-only copy of the trained model for the get_indices flags it is evaluated with, int8 indexed layers with quantize """
+        return FrozenNet(self, get_indices, quantize)
+
+class FrozenNet(nn.Module):
+    """ Net in eval mode with its thresholds and weight banks frozen into plain tensors, see Net.freeze
+
+    forward takes only the images, allocates no placeholder bucket ids and can be saved with
+    torch.jit.script(...).save(path) and loaded without this repo. quantize ("row" or "bucket")
+    makes the two indexed layers int8, see customlayers.FrozenLinearLayer.
+    """
+    def __init__(self, net, get_indices, quantize=None):
+        super(FrozenNet, self).__init__()
+        self.conv1 = copy.deepcopy(net.conv1)
+        self.conv2 = copy.deepcopy(net.conv2)
+        self.fc1 = copy.deepcopy(net.fc1)
+        self.fc2 = copy.deepcopy(net.fc2)
+        self.eidetic = customlayers.FrozenLinearLayer(net.eidetic, get_indices[0], False)
+        self.eideticIndexed = customlayers.FrozenLinearLayer(net.eideticIndexed, get_indices[1], get_indices[0], quantize)
+        self.indexed = customlayers.FrozenLinearLayer(net.indexed, False, get_indices[1], quantize)
+        self.requires_grad_(False)
+        self.eval()
+
+    def forward(self, x):
+        return self.head(self.backbone(x))
+
+    def backbone(self, x):
+        x = F.relu(self.conv1(x))
+        x = F.relu(self.conv2(x))
+        x = F.max_pool2d(x, 2)
+        x = torch.flatten(x, 1)
+        x = F.relu(self.fc1(x))
+        return self.fc2(x)
+
+    def head(self, x):
+        idxs = torch.empty(0, dtype=torch.long, device=x.device)
+        x, idxs = self.eidetic(x, idxs)
+        x, idxs = self.eideticIndexed(x, idxs)
+        x, idxs = self.indexed(x, idxs)
+        return F.log_softmax(x, dim=1)
+
         
 
-def train(args, model, device, train_loader, optimizer, epoch, calculate_distribution, use_db, get_indices, val_to_add_to_target):
+#Version of the save_checkpoint format, load_checkpoint reads this and older versions
+CHECKPOINT_VERSION = 1
+
+def save_checkpoint(model, path, include_stores=False):
+    """ Saves the weights, banks, thresholds and use_indices flags of model, and with include_stores
+    its in-memory activation stores or sketches, so load_checkpoint needs no activation pass
+    """
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "config": dict(model.config),
+        "state_dict": model.state_dict(),
+        "use_indices": {number: layer.use_indices for number, layer in model.indexed_layers.items()},
+        "stores": {},
+    }
+    if include_stores:
+        #Memory-mapped stores stay in ACTIVATION_DIR, which load_checkpoint does not open
+        for number, layer in model.eidetic_layers.items():
+            if layer.sketch is not None:
+                checkpoint["stores"][number] = {"sketch": layer.sketch.checkpoint()}
+            elif isinstance(layer.activations, customlayers.ActivationStore):
+                checkpoint["stores"][number] = {"store": layer.activations.checkpoint()}
+    torch.save(checkpoint, path)
+
+def load_checkpoint(path, device="cpu", mmap=True):
+    """ Net ready for indexed inference from a save_checkpoint file, or from a plain --save-model state dict of earlier versions
+
+    With mmap the tensors are memory-mapped from the file and become the model's parameters as they
+    are, so pages of a large bank are only read when used and startup costs no copy. The model is
+    built on the meta device, so its freshly initialized banks are never allocated either. The
+    eidetic layers only get the activation stores the checkpoint holds (--save-stores), in memory:
+    the files of ACTIVATION_DIR may belong to a training run and are never opened.
+    """
+    checkpoint = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    if "version" not in checkpoint:
+        #Bare state dict: thresholds mean the indexed layer ran with indices
+        checkpoint = {"version": 0, "config": {}, "state_dict": checkpoint, "stores": {},
+                      "use_indices": {"2": checkpoint.get("eideticIndexed.quantiles") is not None}}
+    if checkpoint["version"] > CHECKPOINT_VERSION:
+        raise ValueError("Checkpoint " + path + " has format version " + str(checkpoint["version"]) + ", this version reads up to " + str(CHECKPOINT_VERSION))
+
+    with torch.device("meta"):
+        model = Net(**checkpoint["config"], in_memory_stores=True)
+    for number, layer in model.eidetic_layers.items():
+        #Inference collects no activations
+        if "store" not in checkpoint["stores"].get(number, {}):
+            layer.activations = None
+    model.load_state_dict(checkpoint["state_dict"], assign=True)
+    allocate_buffers(model)
+    for number, val in checkpoint["use_indices"].items():
+        model.use_indices(val, number)
+    for number, stores in checkpoint["stores"].items():
+        layer = model.eidetic_layers[number]
+        if "sketch" in stores and layer.sketch is not None:
+            layer.sketch.restore(stores["sketch"])
+        elif "store" in stores and isinstance(layer.activations, customlayers.ActivationStore):
+            layer.activations.restore(stores["store"])
+    return model.to(device).eval()
+
+def allocate_buffers(model, device="cpu"):
+    """ Allocates the buffers that checkpoints do not hold, the activation stores and index caches, of a model built on the meta device """
+    for module in model.modules():
+        for name, buffer in module._buffers.items():
+            if buffer is not None and buffer.is_meta:
+                module._buffers[name] = torch.zeros_like(buffer, device=device)
+        if isinstance(module, customlayers.IndexCache):
+            module.clear()
+
+class FeatureCache():
+    """ fc2 outputs of a frozen backbone for every sample of a dataset, keyed by dataset index
+
+    The backbone runs once, in eval mode, and the eidetic head then trains and evaluates from the
+    cached features. The cache rebuilds itself when any backbone parameter is unfrozen or changed.
+    With path set the features live in a memory-mapped .npy file instead of RAM. Batches also carry
+    sample ids, id_offset + dataset index, for the layers' index caches.
+    """
+    def __init__(self, model, dataset, device, batch_size=1000, path=None, id_offset=0):
+        self.model, self.dataset, self.device, self.batch_size, self.path = model, dataset, device, batch_size, path
+        self.id_offset = id_offset
+        self.fingerprint = None
+        self.features = None
+        self.targets = None
+
+    def backbone_fingerprint(self):
+        #In-place updates bump _version, replaced or unfrozen parameters change the rest
+        return tuple((p.data_ptr(), p._version, p.requires_grad) for p in self.model.backbone_parameters())
+
+    def valid(self):
+        fingerprint = self.backbone_fingerprint()
+        return self.features is not None and fingerprint == self.fingerprint and not any(p.requires_grad for p in self.model.backbone_parameters())
+
+    def build(self):
+        loader = torch.utils.data.DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False)
+        if self.path is not None:
+            features = np.lib.format.open_memmap(self.path, mode="w+", dtype=np.float32, shape=(len(self.dataset), self.model.fc2.out_features))
+        else:
+            features = torch.empty(len(self.dataset), self.model.fc2.out_features)
+        targets = torch.empty(len(self.dataset), dtype=torch.long)
+
+        training = self.model.training
+        self.model.eval()
+        start = 0
+        with torch.no_grad():
+            for data, target in loader:
+                output = self.model.backbone(data.to(self.device)).cpu()
+                features[start:start + len(data)] = output.numpy() if self.path is not None else output
+                targets[start:start + len(data)] = target
+                start = start + len(data)
+        self.model.train(training)
+
+        self.features = torch.from_numpy(features) if self.path is not None else features
+        self.targets = targets
+        self.fingerprint = self.backbone_fingerprint()
+
+    def loader(self, batch_size, shuffle=False):
+        if not self.valid():
+            self.build()
+        sample_ids = torch.arange(len(self.targets)) + self.id_offset
+        return torch.utils.data.DataLoader(torch.utils.data.TensorDataset(self.features, self.targets, sample_ids), batch_size=batch_size, shuffle=shuffle)
+
+def train(args, model, device, train_loader, optimizer, epoch, calculate_distribution, use_db, get_indices, val_to_add_to_target, head_only=False):
     model.train()
-    for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(device), target.to(device)
+    for batch_idx, batch in enumerate(train_loader):
+        data, target = batch[0].to(device), batch[1].to(device)
+        sample_ids = batch[2] if len(batch) > 2 else None
         target = target + val_to_add_to_target
         optimizer.zero_grad()
-        output = model(data, calculate_distribution, get_indices, use_db)
+        if head_only:
+            output = model.head(data, calculate_distribution, get_indices, use_db, sample_ids)
+        else:
+            output = model(data, calculate_distribution, get_indices, use_db, sample_ids)
         loss = F.nll_loss(output, target)
         # loss.requires_grad = True
         loss.backward()
+        if customlayers.distributed():
+            average_gradients(model)
         optimizer.step()
-        if batch_idx % args.log_interval == 0:
+        if batch_idx % args.log_interval == 0 and main_rank():
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(data), len(train_loader.dataset),
                 100. * batch_idx / len(train_loader), loss.item()))
@@ -92,27 +299,160 @@ def train(args, model, device, train_loader, optimizer, epoch, calculate_distrib
                 break
 
 
-def test(model, device, test_loader, calculate_distribution, use_db, get_indices, val_to_add_to_target, test_name):
+def test(model, device, test_loader, calculate_distribution, use_db, get_indices, val_to_add_to_target, test_name, head_only=False):
+    """ Prints and logs the average loss and accuracy over test_loader and returns both, summed over ranks when distributed """
     model.eval()
     test_loss = 0
     correct = 0
     with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
+        for batch in test_loader:
+            data, target = batch[0].to(device), batch[1].to(device)
+            sample_ids = batch[2] if len(batch) > 2 else None
             target = target + val_to_add_to_target
-            output = model(data, calculate_distribution, get_indices, use_db)
+            if head_only:
+                output = model.head(data, calculate_distribution, get_indices, use_db, sample_ids)
+            else:
+                output = model(data, calculate_distribution, get_indices, use_db, sample_ids)
             test_loss += F.nll_loss(output, target, reduction='sum').item()  # sum up batch loss
             pred = output.argmax(dim=1, keepdim=True)  # get the index of the max log-probability
             correct += pred.eq(target.view_as(pred)).sum().item()
 
-    test_loss /= len(test_loader.dataset)
+    total = len(test_loader.dataset)
+    if customlayers.distributed():
+        sums = torch.tensor([test_loss, correct, total], dtype=torch.float64)
+        dist.all_reduce(sums)
+        test_loss, correct, total = sums[0].item(), int(sums[1].item()), int(sums[2].item())
+    test_loss /= total
+    if not main_rank():
+        return test_loss, correct / total
 
     print('\nTest set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
-        test_loss, correct, len(test_loader.dataset),
-        100. * correct / len(test_loader.dataset)))
+        test_loss, correct, total,
+        100. * correct / total))
     logging.info(test_name + 'Test set: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
-        test_loss, correct, len(test_loader.dataset),
-        100. * correct / len(test_loader.dataset)))
+        test_loss, correct, total,
+        100. * correct / total))
+    return test_loss, correct / total
+
+def test_frozen(model, device, test_loader, val_to_add_to_target):
+    """ Summed loss, correct predictions and samples of a FrozenNet over test_loader, summed over ranks when distributed """
+    test_loss = 0
+    correct = 0
+    with torch.no_grad():
+        for batch in test_loader:
+            data, target = batch[0].to(device), batch[1].to(device) + val_to_add_to_target
+            output = model(data)
+            test_loss += F.nll_loss(output, target, reduction='sum').item()
+            correct += output.argmax(dim=1).eq(target).sum().item()
+
+    total = len(test_loader.dataset)
+    if customlayers.distributed():
+        sums = torch.tensor([test_loss, correct, total], dtype=torch.float64)
+        dist.all_reduce(sums)
+        test_loss, correct, total = sums[0].item(), int(sums[1].item()), int(sums[2].item())
+    return test_loss, correct, total
+
+def compare_quantized(model, device, get_indices, quantize, tests):
+    """ Logs the int8 frozen model's loss and accuracy next to the float frozen model's on each (name, loader, target offset) of tests """
+    reference, quantized = model.freeze(get_indices), model.freeze(get_indices, quantize)
+    for name, loader, val_to_add_to_target in tests:
+        (_, reference_correct, total), (test_loss, correct, _) = [test_frozen(frozen, device, loader, val_to_add_to_target) for frozen in (reference, quantized)]
+        message = name + ' int8 ({}): Average loss: {:.4f}, Accuracy: {}/{} ({:.2f}%), float {:.2f}%, delta {:+.2f} points'.format(
+            quantize, test_loss / total, correct, total, 100. * correct / total, 100. * reference_correct / total, 100. * (correct - reference_correct) / total)
+        if main_rank():
+            print(message)
+            logging.info(message)
+
+    if main_rank():
+        sizes = [sum(b.nbytes for layer in (frozen.eideticIndexed, frozen.indexed) for b in layer.buffers()) for frozen in (reference, quantized)]
+        logging.info("Indexed layers: {:.1f} KB float, {:.1f} KB int8 ({})".format(sizes[0] / 1e3, sizes[1] / 1e3, quantize))
+
+def learn_task(args, model, device, optimizer, epoch, task, loader, features, num_quantiles, use_db):
+    """ Registers task and builds its layer 2 thresholds from its own activations, then indexes and trains its bank
+
+    features, a FeatureCache of loader's dataset or None, replaces the loader for training and
+    evaluation as with --cache-features.
+    """
+    model.tasks.add(task)
+    model.eideticIndexed.reset_activations()
+    if use_db:
+        if main_rank():
+            db.database.recreate_tables(num_quantiles, 2)
+        if customlayers.distributed():
+            dist.barrier()
+
+    with metrics.recorder.phase("activation_storage"):
+        test(model, device, loader, [False, True], [False, use_db], [False, False], 0, "Task " + str(task) + " Storing Activations ")
+    with metrics.recorder.phase("quantiles"):
+        model.calculate_n_quantiles(num_quantiles, use_db, "2", args.interpolation)
+    with metrics.recorder.phase("index_build"):
+        model.index_layers(num_quantiles, "2")
+    model.use_indices(True, "2")
+
+    with metrics.recorder.phase("eidetic_training"):
+        if features is not None:
+            train(args, model, device, features.loader(args.head_batch_size, shuffle=True), optimizer, epoch, [False, False], [False, False], [False, True], 0, True)
+        else:
+            train(args, model, device, loader, optimizer, epoch, [False, False], [False, False], [False, True], 0)
+
+def test_task(args, model, device, task, loader, features):
+    model.tasks.activate(task)
+    with metrics.recorder.phase("eval_tasks"):
+        if features is not None:
+            test(model, device, features.loader(args.test_batch_size), [False, False], [False, False], [False, True], 0, "Task " + str(task), True)
+        else:
+            test(model, device, loader, [False, False], [False, False], [False, True], 0, "Task " + str(task))
+
+def load_datasets():
+    """ MNIST train and test sets and EMNIST letters, normalized; torchvision is imported here as it doubles import time """
+    from torchvision import datasets, transforms
+    transform=transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize((0.1307,), (0.3081,))
+        ])
+    dataset1 = datasets.MNIST('../data', train=True, download=True,
+                       transform=transform)
+    dataset2 = datasets.MNIST('../data', train=False,
+                       transform=transform)
+    dataset3 = datasets.EMNIST('../data', train=True,
+                       transform=transform, split="letters", download=True)
+    return dataset1, dataset2, dataset3
+
+def main_rank():
+    """ True in single-process runs and on rank 0, the process that prints and writes files """
+    return not customlayers.distributed() or dist.get_rank() == 0
+
+def shard(dataset, rank, world_size):
+    """ Every world_size-th sample from rank on, wrapped around so every rank gets as many batches, like DistributedSampler """
+    per_rank = -(-len(dataset) // world_size)
+    return torch.utils.data.Subset(dataset, [i % len(dataset) for i in range(rank, per_rank * world_size, world_size)])
+
+def average_gradients(model):
+    """ Averages every gradient over the ranks so each replica takes the same optimizer step """
+    world_size = dist.get_world_size()
+    grads = [p.grad for p in model.parameters() if p.grad is not None and not p.grad.is_sparse]
+    if grads:
+        #One all_reduce for all dense gradients
+        flat = torch._utils._flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat.div_(world_size)
+        for grad, averaged in zip(grads, torch._utils._unflatten_dense_tensors(flat, grads)):
+            grad.copy_(averaged)
+    for p in model.parameters():
+        if p.grad is not None and p.grad.is_sparse:
+            grad = p.grad.coalesce()
+            dist.all_reduce(grad)
+            p.grad = grad / world_size
+
+def broadcast_state(model):
+    """ Copies rank 0's parameters and buffers to every rank """
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, 0)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
 
 def freeze_layers(model):
     for param in model.parameters():
@@ -138,7 +478,7 @@ def unfreeze_eidetic_layers(model, num_quantiles, layer_number):
 
     
         
-def main():
+def parse_args(argv=None):
     # Training settings
     parser = argparse.ArgumentParser(description='PyTorch MNIST Example')
     parser.add_argument('--batch-size', type=int, default=1, metavar='N',
@@ -163,7 +503,83 @@ def main():
                         help='how many batches to wait before logging training status')
     parser.add_argument('--save-model', action='store_true', default=False,
                         help='For Saving the current Model')
-    args = parser.parse_args()
+    parser.add_argument('--save-stores', action='store_true', default=False,
+                        help='also save the activation stores or sketches with --save-model')
+    parser.add_argument('--sparse-bank', action='store_true', default=False,
+                        help='sparse weight bank gradients, only touched buckets are updated')
+    parser.add_argument('--bank', default='full', choices=list(customlayers.BANK_KINDS),
+                        help='weight bank: a full copy per bucket, or the shared weights plus a per-bucket low-rank or scale/shift delta (default: full)')
+    parser.add_argument('--bank-rank', type=int, default=4, metavar='R',
+                        help='rank of the per-bucket delta with --bank lowrank (default: 4)')
+    parser.add_argument('--interpolation', default='index', choices=['index', 'disc', 'linear'],
+                        help='how exact quantile thresholds pick between stored rows (default: index)')
+    parser.add_argument('--cache-features', action='store_true', default=False,
+                        help='run the frozen backbone once and train the eidetic head from cached fc2 features')
+    parser.add_argument('--head-batch-size', type=int, default=64, metavar='N',
+                        help='training batch size on cached features (default: 64)')
+    parser.add_argument('--sketch-size', type=int, default=None, metavar='K',
+                        help='stream activations into per-neuron quantile sketches of size K instead of storing them')
+    parser.add_argument('--index-cache', type=int, default=None, metavar='N',
+                        help='cache the bucket ids of up to N samples per eidetic layer, used with --cache-features')
+    parser.add_argument('--reuse-activations', action='store_true', default=False,
+                        help='with ACTIVATION_DIR, build the Task B thresholds from the rows already in its files and skip the storage pass')
+    parser.add_argument('--store-dtype', default='float32', choices=list(customlayers.STORE_DTYPES),
+                        help='storage dtype of the in-memory activation stores (default: float32)')
+    parser.add_argument('--export-frozen', default=None, metavar='PATH',
+                        help='save a TorchScript inference-only copy of the trained model to PATH')
+    parser.add_argument('--quantize', default=None, choices=list(customlayers.QUANTIZE_GRANULARITIES),
+                        help='after training, compare Task A and B accuracy of an int8 frozen copy with per row or per bucket scales; also applies to --export-frozen')
+    parser.add_argument('--metrics', default=None, metavar='PATH',
+                        help='record phase timers and counters and write them to PATH (.csv or .json)')
+    parser.add_argument('--profile-phase', default=None, choices=PHASES,
+                        help='run this phase under torch.profiler, needs --metrics')
+    parser.add_argument('--profile-trace', default=None, metavar='PATH',
+                        help='Chrome trace file of --profile-phase (default: trace_<phase>.json)')
+    parser.add_argument('--tasks', type=int, default=1, metavar='N',
+                        help='learn N sequential EMNIST tasks after Task A, each with its own thresholds and bank (default: 1)')
+    parser.add_argument('--bank-budget', type=float, default=None, metavar='MB',
+                        help='memory for resident task banks, the least recently used are paged to --bank-dir (default: unlimited)')
+    parser.add_argument('--bank-dir', default='banks', metavar='DIR',
+                        help='where --tasks pages out task banks (default: banks)')
+    parser.add_argument('--processes', type=int, default=1, metavar='N',
+                        help='data-parallel training in N local processes over gloo (default: 1)')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.processes > 1:
+        mp.spawn(run, args=(args.processes, args, "tcp://127.0.0.1:" + str(free_port())), nprocs=args.processes)
+    elif int(os.getenv("WORLD_SIZE", "1")) > 1:
+        #Started by torchrun
+        run(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), args, "env://")
+    else:
+        run(0, 1, args)
+
+
+def run(rank, world_size, args, init_method=None, datasets=None):
+    """ The training schedule of main(); with world_size > 1 this is one data-parallel rank
+
+    Every rank trains on its shard of both subsets with gradients averaged after each backward
+    pass, and the eidetic thresholds are merged over all ranks' activations (see
+    customlayers.merged_quantiles), so all ranks keep identical thresholds, banks and weights.
+    Only rank 0 prints results and writes files, and each rank logs to its own
+    benchmark_rank_<n>.log. datasets, the three of load_datasets, saves
+    loading them again when run is called repeatedly as by sweep.py.
+    """
+    #One log per rank, so concurrent ranks do not interleave their lines
+    logging.basicConfig(filename='benchmark.log' if world_size == 1 else 'benchmark_rank_' + str(rank) + '.log', filemode='a', level=logging.DEBUG)
+    logging.info("Started")
+    np.set_printoptions(threshold=sys.maxsize)
+    settings = config.get()
+
+    if world_size > 1:
+        dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+        #Ranks share the cores rather than each starting a thread per core
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    if args.metrics:
+        metrics.recorder = metrics.Metrics(True, args.profile_phase, args.profile_trace)
 
 
     use_cuda = not args.no_cuda and torch.cuda.is_available()
@@ -172,7 +588,7 @@ def main():
     torch.manual_seed(args.seed)
 
     #cpu or cuda
-    device = os.getenv("DEVICE")
+    device = settings.device
 
     train_kwargs = {'batch_size': args.batch_size}
     test_kwargs = {'batch_size': args.test_batch_size}
@@ -184,51 +600,64 @@ def main():
         train_kwargs.update(cuda_kwargs)
         test_kwargs.update(cuda_kwargs)
 
-    transform=transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,))
-        ])
-    dataset1 = datasets.MNIST('../data', train=True, download=True,
-                       transform=transform)
-    dataset2 = datasets.MNIST('../data', train=False,
-                       transform=transform)
-    dataset3 = datasets.EMNIST('../data', train=True,
-                       transform=transform, split="letters", download=True)
+    dataset1, dataset2, dataset3 = datasets or load_datasets()
     train_loader = torch.utils.data.DataLoader(dataset1,**train_kwargs)
     test_loader = torch.utils.data.DataLoader(dataset2, **test_kwargs)
     extension_train_loader = torch.utils.data.DataLoader(dataset3,**train_kwargs)
 
-    subset_indices = np.arange(1,int(os.getenv("TASK_B_SUBSET_CARDINALITY"))) # select your indices here as a list
+    subset_indices = np.arange(1,settings.task_b_subset_cardinality) # select your indices here as a list
 
     subset = torch.utils.data.Subset(extension_train_loader.dataset, subset_indices)
-    degradation_subset = torch.utils.data.DataLoader(subset, batch_size=1, num_workers=0, shuffle=True)
+    if world_size > 1:
+        subset = shard(subset, rank, world_size)
+    degradation_subset = torch.utils.data.DataLoader(subset, batch_size=args.batch_size, num_workers=0, shuffle=True)
     #test_subset_a
     #test_subset_b
 
     
-    subset_indices = np.arange(1,int(os.getenv("TASK_A_SUBSET_CARDINALITY"))) # select your indices here as a list
+    subset_indices = np.arange(1,settings.task_a_subset_cardinality) # select your indices here as a list
 
     subset = torch.utils.data.Subset(train_loader.dataset, subset_indices)
-    train_subset = torch.utils.data.DataLoader(subset, batch_size=1, num_workers=0, shuffle=True)
-
-    model = Net().to(device)
-    optimizer = optim.Adadelta(model.parameters(), lr=args.lr)
+    if world_size > 1:
+        subset = shard(subset, rank, world_size)
+    train_subset = torch.utils.data.DataLoader(subset, batch_size=args.batch_size, num_workers=0, shuffle=True)
+
+    model = Net(args.sparse_bank, args.sketch_size, args.index_cache, args.store_dtype, bank=args.bank, bank_rank=args.bank_rank).to(device)
+    if world_size > 1:
+        broadcast_state(model)
+        #Same weights everywhere, but each rank draws its own dropout masks, shuffles and samples
+        torch.manual_seed(args.seed + rank)
+    if args.sparse_bank:
+        optimizer = customlayers.SparseAdadelta(model.parameters(), lr=args.lr)
+    else:
+        optimizer = optim.Adadelta(model.parameters(), lr=args.lr)
 
     round_ = 1
-    num_quantiles = int(os.getenv("NUM_QUANTILES"))
+    num_quantiles = settings.num_quantiles
 
     use_indices = True
 
     if num_quantiles == 1:
         use_indices = False
+    if args.tasks > 1 and not use_indices:
+        raise ValueError("--tasks needs NUM_QUANTILES > 1, tasks differ only in their thresholds and banks")
+    if args.tasks * settings.task_b_subset_cardinality > len(dataset3):
+        raise ValueError("EMNIST letters has room for " + str(len(dataset3) // settings.task_b_subset_cardinality) + " tasks of TASK_B_SUBSET_CARDINALITY samples")
 
     use_db = False
     
+    if args.reuse_activations and (settings.activation_dir is None or settings.use_db or args.sketch_size is not None):
+        raise ValueError("--reuse-activations reads the files of ACTIVATION_DIR, set it and unset USE_DB and --sketch-size")
 
-    if os.getenv("USE_DB") == "True":
+    if settings.use_db:
         use_db = True
-        db.database.recreate_tables(num_quantiles, 1)
-        db.database.recreate_tables(num_quantiles, 2)
+        if world_size > 1 and db.database.dtype == "int16":
+            raise ValueError("DB_DTYPE=int16 keeps its code ranges per process and cannot be shared by several ranks")
+        if rank == 0:
+            db.database.recreate_tables(num_quantiles, 1)
+            db.database.recreate_tables(num_quantiles, 2)
+        if world_size > 1:
+            dist.barrier()
         
     scheduler = StepLR(optimizer, step_size=1, gamma=args.gamma)
         
@@ -238,36 +667,112 @@ def main():
 
         if round_ == 1:
 
+            if metrics.recorder.enabled:
+                #Baseline of forward transfer; the loaders' shuffles must not move the seeded training that follows
+                with metrics.recorder.phase("eval_untrained"), torch.random.fork_rng(devices=[]):
+                    metrics.recorder.evaluation(metrics.UNTRAINED, "task_a", *test(model, device, train_subset, [False, False], [False, False], [False, False], 26, "Layer 2, Task A Untrained "))
+                    metrics.recorder.evaluation(metrics.UNTRAINED, "task_b", *test(model, device, degradation_subset, [False, False], [False, False], [False, False], 0, "Layer 2, Task B Untrained "))
+
             logging.info("\n\n\nLayer 1")
-            train(args, model, device, train_subset, optimizer, epoch, [False, False], [False, False], [False, False], 26)
+            with metrics.recorder.phase("pretraining"):
+                train(args, model, device, train_subset, optimizer, epoch, [False, False], [False, False], [False, False], 26)
   
             logging.info("\n\n\nLayer 2")
-            test(model, device, train_subset, [False, False], [False, False], [False, False], 26, "Layer 2, Task A Pre-Training ")
-            test(model, device, degradation_subset, [False, False], [False, False], [False, False], 0, "Layer 2, Task B Pre-Training ")
-            #Storing Activations
-            test(model, device, degradation_subset, [False, use_indices], [False, use_db], [False, False], 0, "Layer 2, Task B Storing Activations ")
+            with metrics.recorder.phase("eval_task_a_pretraining"):
+                metrics.recorder.evaluation("task_a", "task_a", *test(model, device, train_subset, [False, False], [False, False], [False, False], 26, "Layer 2, Task A Pre-Training "))
+            with metrics.recorder.phase("eval_task_b_pretraining"):
+                metrics.recorder.evaluation("task_a", "task_b", *test(model, device, degradation_subset, [False, False], [False, False], [False, False], 0, "Layer 2, Task B Pre-Training "))
+            if args.tasks > 1:
+                #Task B is task 1, its state so far becomes the task's own
+                model.enable_tasks(args.bank_dir if world_size == 1 else os.path.join(args.bank_dir, "rank_" + str(rank)),
+                                   args.bank_budget * 1e6 if args.bank_budget is not None else None, optimizer).add(1)
+            #Storing Activations, the rows of earlier runs are dropped unless they are reused as they are
+            store = model.eideticIndexed.activations
+            if args.reuse_activations and store.count > 0:
+                logging.info("Layer 2, reusing " + str(store.count) + " stored activations of " + store.path)
+            else:
+                model.eideticIndexed.reset_activations()
+                with metrics.recorder.phase("activation_storage"):
+                    test(model, device, degradation_subset, [False, use_indices], [False, use_db], [False, False], 0, "Layer 2, Task B Storing Activations ")
 
             if use_indices == True:
                 print("Layer 2, Calculating Quantiles...")
-                model.calculate_n_quantiles(num_quantiles, use_db, "2")
+                with metrics.recorder.phase("quantiles"):
+                    model.calculate_n_quantiles(num_quantiles, use_db, "2", args.interpolation)
                 print("Layer 2, Indexing Layers...")
-                model.index_layers(num_quantiles, "2")
+                with metrics.recorder.phase("index_build"):
+                    model.index_layers(num_quantiles, "2")
                 model.use_indices(True, "2")
             print("Layer 2, Freezing non eidetic layers...")
             freeze_layers(model)
             unfreeze_eidetic_layers(model, num_quantiles, "2")
             print("Layer 2, Training model with eidetic parameters...")
-            
-            train(args, model, device, degradation_subset, optimizer, epoch, [False, False], [False, False], [False, use_indices], 0)
-            
-            test(model, device, degradation_subset, [False, False], [False, False], [False, use_indices], 0, "Layer 2, Task B")
-            test(model, device, train_subset, [False, False], [False, False], [False, use_indices], 26, "Layer 2, Task A")
+
+            if args.cache_features:
+                #The backbone is frozen from here on, so its fc2 outputs are computed once per subset
+                #Task A ids start after Task B's so both subsets can share the layers' index caches
+                degradation_features = FeatureCache(model, degradation_subset.dataset, device, args.test_batch_size)
+                train_features = FeatureCache(model, train_subset.dataset, device, args.test_batch_size, id_offset=len(degradation_subset.dataset))
+
+                with metrics.recorder.phase("eidetic_training"):
+                    train(args, model, device, degradation_features.loader(args.head_batch_size, shuffle=True), optimizer, epoch, [False, False], [False, False], [False, use_indices], 0, True)
+
+                with metrics.recorder.phase("eval_task_b"):
+                    metrics.recorder.evaluation("task_b", "task_b", *test(model, device, degradation_features.loader(args.test_batch_size), [False, False], [False, False], [False, use_indices], 0, "Layer 2, Task B", True))
+                with metrics.recorder.phase("eval_task_a"):
+                    metrics.recorder.evaluation("task_b", "task_a", *test(model, device, train_features.loader(args.test_batch_size), [False, False], [False, False], [False, use_indices], 26, "Layer 2, Task A", True))
+            else:
+                with metrics.recorder.phase("eidetic_training"):
+                    train(args, model, device, degradation_subset, optimizer, epoch, [False, False], [False, False], [False, use_indices], 0)
+
+                with metrics.recorder.phase("eval_task_b"):
+                    metrics.recorder.evaluation("task_b", "task_b", *test(model, device, degradation_subset, [False, False], [False, False], [False, use_indices], 0, "Layer 2, Task B"))
+                with metrics.recorder.phase("eval_task_a"):
+                    metrics.recorder.evaluation("task_b", "task_a", *test(model, device, train_subset, [False, False], [False, False], [False, use_indices], 26, "Layer 2, Task A"))
+
+            if args.tasks > 1:
+                #Tasks 2..N are the following disjoint slices of EMNIST letters, afterwards every task is evaluated with its own bank
+                cardinality = settings.task_b_subset_cardinality
+                task_data = {1: (degradation_subset, degradation_features if args.cache_features else None)}
+                next_id = len(degradation_subset.dataset) + len(train_subset.dataset)
+                for task in range(2, args.tasks + 1):
+                    subset = torch.utils.data.Subset(dataset3, np.arange((task - 1) * cardinality, task * cardinality))
+                    if world_size > 1:
+                        subset = shard(subset, rank, world_size)
+                    loader = torch.utils.data.DataLoader(subset, batch_size=args.batch_size, num_workers=0, shuffle=True)
+                    features = FeatureCache(model, subset, device, args.test_batch_size, id_offset=next_id) if args.cache_features else None
+                    next_id = next_id + len(subset)
+                    task_data[task] = (loader, features)
+                    learn_task(args, model, device, optimizer, epoch, task, loader, features, num_quantiles, use_db)
+                for task, (loader, features) in task_data.items():
+                    test_task(args, model, device, task, loader, features)
             print("Epoch finished...")
         round_ = round_ + 1
         scheduler.step()
     logging.info("--- %s seconds ---" % (time.time() - start_time))
+    if args.quantize:
+        if model.tasks is not None:
+            model.tasks.activate(1)
+        with metrics.recorder.phase("eval_quantized"):
+            compare_quantized(model, device, [False, use_indices], args.quantize,
+                              [("Layer 2, Task B", degradation_subset, 0), ("Layer 2, Task A", train_subset, 26)])
+    model.close_stores()
+    if use_db:
+        db.database.close()
+    if world_size > 1:
+        dist.destroy_process_group()
+    if rank != 0:
+        return model
+    if args.metrics:
+        metrics.recorder.export(args.metrics)
+        logging.info("Metrics written to " + args.metrics)
+    if metrics.recorder.profile_summary is not None:
+        logging.info("Profile of " + args.profile_phase + "\n" + metrics.recorder.profile_summary)
     if args.save_model:
-        torch.save(model.state_dict(), "mnist_cnn.pt")
+        save_checkpoint(model, "mnist_cnn.pt", args.save_stores)
+    if args.export_frozen:
+        torch.jit.script(model.freeze([False, use_indices], args.quantize)).save(args.export_frozen)
+    return model
 
 
 if __name__ == '__main__':
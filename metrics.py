@@ -0,0 +1,146 @@
+import contextlib
+import csv
+import json
+import time
+import torch
+
+
+#Stage name of evaluations before any training, the baseline of forward transfer
+UNTRAINED = "untrained"
+
+
+class Metrics():
+    """ Named phase timers, counters and bucket occupancy histograms for a run
+
+    Disabled (the default) every method returns straight away; hot loops additionally check
+    recorder.enabled before building counter names or histograms, so instrumentation costs one
+    attribute read per call site. With profile_phase set, that phase also runs under
+    torch.profiler and its Chrome trace is written to profile_path. Test results recorded with
+    evaluation give the continual-learning metrics of transfer.
+    """
+    def __init__(self, enabled=False, profile_phase=None, profile_path=None):
+        self.enabled, self.profile_phase, self.profile_path = enabled, profile_phase, profile_path
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        #(stage, task) -> (loss, accuracy), in the order the stages were recorded
+        self.evaluations = {}
+        self.profile_summary = None
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def occupancy(self, name, indices, num_buckets):
+        """ Adds a batch of bucket ids to the name histogram """
+        if not self.enabled:
+            return
+        counts = torch.bincount(indices.reshape(-1), minlength=num_buckets)
+        if name in self.histograms and self.histograms[name].shape == counts.shape:
+            self.histograms[name].add_(counts)
+        else:
+            self.histograms[name] = counts
+
+    def evaluation(self, stage, task, loss, accuracy):
+        """ Test loss and accuracy on task after training stage, the task of that name or UNTRAINED """
+        if not self.enabled:
+            return
+        self.evaluations[(stage, task)] = (float(loss), float(accuracy))
+
+    def transfer(self):
+        """ Continual-learning metrics of the recorded evaluations, tasks taken in the order their stages were recorded
+
+        With R[i][j] the accuracy on task j after training task i, T tasks and b[j] the untrained
+        accuracy on task j: accuracy is the mean of R[T-1][j]; bwt the mean over j < T-1 of
+        R[T-1][j] - R[j][j]; fwt the mean over j > 0 of R[j-1][j] - b[j]; forgetting the mean over
+        j < T-1 of max over j <= l < T-1 of R[l][j], minus R[T-1][j]; average_transfer the mean of
+        bwt and fwt. A metric is left out when an evaluation it needs is missing.
+        """
+        tasks = list(dict.fromkeys(stage for stage, _ in self.evaluations if stage != UNTRAINED))
+        if len(tasks) == 0:
+            return {}
+        R = lambda stage, task: self.evaluations.get((stage, task), (None, None))[1]
+        mean = lambda values: sum(values) / len(values) if len(values) and None not in values else None
+
+        values = {"accuracy": mean([R(tasks[-1], task) for task in tasks])}
+        if len(tasks) > 1:
+            earlier = tasks[:-1]
+            values["bwt"] = mean([None if R(task, task) is None or R(tasks[-1], task) is None else R(tasks[-1], task) - R(task, task) for task in earlier])
+            values["forgetting"] = mean([None if None in [R(stage, task) for stage in earlier[i:]] + [R(tasks[-1], task)] else
+                                         max(R(stage, task) for stage in earlier[i:]) - R(tasks[-1], task) for i, task in enumerate(earlier)])
+            values["fwt"] = mean([None if R(before, task) is None or R(UNTRAINED, task) is None else R(before, task) - R(UNTRAINED, task) for before, task in zip(tasks, tasks[1:])])
+            if values["bwt"] is not None and values["fwt"] is not None:
+                values["average_transfer"] = (values["bwt"] + values["fwt"]) / 2
+        return {name: value for name, value in values.items() if value is not None}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Times the with block as one call of phase name, under torch.profiler when it is profile_phase """
+        if not self.enabled:
+            yield
+            return
+
+        profiler = None
+        if name == self.profile_phase:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            profiler.__enter__()
+
+        self.__synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__synchronize()
+            elapsed = time.perf_counter() - start
+            calls, total = self.phases.get(name, (0, 0.0))
+            self.phases[name] = (calls + 1, total + elapsed)
+            if profiler is not None:
+                profiler.__exit__(None, None, None)
+                profiler.export_chrome_trace(self.profile_path or "trace_" + name + ".json")
+                self.profile_summary = profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=20)
+
+    def __synchronize(self):
+        #Queued GPU work would otherwise be charged to whichever phase waits on it next
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def as_dict(self):
+        return {
+            "phases": {name: {"calls": calls, "total_s": total, "mean_s": total / calls} for name, (calls, total) in self.phases.items()},
+            "counters": dict(self.counters),
+            "histograms": {name: counts.cpu().tolist() for name, counts in self.histograms.items()},
+            "evaluations": [{"stage": stage, "task": task, "loss": loss, "accuracy": accuracy} for (stage, task), (loss, accuracy) in self.evaluations.items()],
+            "transfer": self.transfer(),
+        }
+
+    def export(self, path):
+        """ Writes everything recorded to path, as CSV (kind, name, key, value) rows if it ends in .csv, else JSON """
+        values = self.as_dict()
+        if not path.endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(values, f, indent=1)
+            return
+
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "name", "key", "value"])
+            for name, phase in values["phases"].items():
+                for key, value in phase.items():
+                    writer.writerow(["phase", name, key, value])
+            for name, value in values["counters"].items():
+                writer.writerow(["counter", name, "value", value])
+            for name, counts in values["histograms"].items():
+                for bucket, value in enumerate(counts):
+                    writer.writerow(["histogram", name, bucket, value])
+            for row in values["evaluations"]:
+                for key in ["loss", "accuracy"]:
+                    writer.writerow(["evaluation", row["stage"] + "/" + row["task"], key, row[key]])
+            for name, value in values["transfer"].items():
+                writer.writerow(["transfer", name, "value", value])
+
+
+recorder = Metrics()
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import config
+import json
+import sys
+import time
+import torch
+import numpy as np
+
+#MNIST normalisation applied by main.py, requests carry raw [0, 1] pixels
+MEAN, STD = 0.1307, 0.3081
+
+
+def load_model(path, device="cpu", use_indices=None, quantize=None):
+    """ Frozen inference copy of a model saved with main.py --save-model, see main.load_checkpoint
+
+    use_indices overrides whether the indexed layer routes through the weight bank, which the
+    checkpoint otherwise records. quantize ("row" or "bucket") serves int8 indexed layers.
+    """
+    import main as eidetic_main
+    net = eidetic_main.load_checkpoint(path)
+    if use_indices is not None:
+        net.use_indices(use_indices, "2")
+    return net.freeze([net.eideticIndexed.use_indices, net.indexed.use_indices], quantize).to(device)
+
+
+class LatencyStats():
+    """ Request latencies of the last window requests, and the throughput since start """
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.start = time.perf_counter()
+
+    def add_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.requests = self.requests + len(latencies)
+        self.batches = self.batches + 1
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        latencies = np.asarray(self.latencies) * 1000
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0.0, 0.0)
+        return {"requests": self.requests, "batches": self.batches, "mean_batch": self.requests / max(self.batches, 1),
+                "p50_ms": float(p50), "p99_ms": float(p99), "requests_per_s": self.requests / elapsed}
+
+
+class MicroBatcher():
+    """ Gathers concurrent requests into batches of up to max_batch_size, waiting at most max_wait_ms for a batch to fill
+
+    Batches run one at a time on a worker thread so the event loop keeps accepting requests
+    while the model is busy; each caller's future gets its own row of the output.
+    """
+    def __init__(self, model, device="cpu", max_batch_size=64, max_wait_ms=2.0):
+        self.model, self.device = model, device
+        self.max_batch_size, self.max_wait = max_batch_size, max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.worker = concurrent.futures.ThreadPoolExecutor(1)
+        self.stats = LatencyStats()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.worker.shutdown()
+
+    async def submit(self, image):
+        """ Log-probabilities of one (28, 28) image """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                #Whatever is already queued joins without waiting
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _, _ in batch]
+            try:
+                output = await loop.run_in_executor(self.worker, self.forward, images)
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            finished = time.perf_counter()
+            for row, (_, future, started) in zip(output, batch):
+                if not future.done():
+                    future.set_result(row)
+            self.stats.add_batch([finished - started for _, _, started in batch])
+
+    def forward(self, images):
+        x = torch.from_numpy(np.stack(images)).to(self.device).unsqueeze(1)
+        with torch.no_grad():
+            return self.model((x - MEAN) / STD).cpu().numpy()
+
+
+def parse_image(values):
+    """ (28, 28) float32 array from a flat or nested list of 784 pixels """
+    image = np.asarray(values, dtype=np.float32)
+    if image.size != 28 * 28:
+        raise ValueError("image must have 784 pixels, got " + str(image.size))
+    return image.reshape(28, 28)
+
+
+async def handle_line(batcher, line):
+    """ Response to one line of the protocol, see README """
+    request = {}
+    try:
+        request = json.loads(line)
+        if request.get("cmd") == "stats":
+            return dict(batcher.stats.snapshot(), id=request.get("id"))
+        output = await batcher.submit(parse_image(request["image"]))
+        return {"id": request.get("id"), "prediction": int(output.argmax()), "log_probs": output.tolist()}
+    except Exception as error:
+        return {"id": request.get("id") if isinstance(request, dict) else None, "error": str(error)}
+
+
+async def serve_stream(batcher, reader, writer):
+    """ Answers newline-delimited JSON requests from one connection, several may be in flight at once """
+    lock = asyncio.Lock()
+    pending = set()
+
+    async def answer(line):
+        response = await handle_line(batcher, line)
+        async with lock:
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+    finally:
+        writer.close()
+
+
+async def stdin_streams():
+    """ asyncio reader and writer over this process' stdin and stdout """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def serve(args):
+    model = load_model(args.model, args.device, args.use_indices, args.quantize)
+    batcher = MicroBatcher(model, args.device, args.max_batch_size, args.max_wait_ms)
+    batcher.start()
+    try:
+        if args.stdin:
+            await serve_stream(batcher, *await stdin_streams())
+            return
+        if args.unix:
+            server = await asyncio.start_unix_server(lambda r, w: serve_stream(batcher, r, w), args.unix)
+        else:
+            server = await asyncio.start_server(lambda r, w: serve_stream(batcher, r, w), args.host, args.port)
+        print("Serving " + (args.unix or "{}:{}".format(args.host, args.port)), file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        print(json.dumps(batcher.stats.snapshot()), file=sys.stderr)
+
+
+async def load_test(args):
+    """ Sends args.requests random images over args.concurrency connections and prints client-side latency and throughput """
+    rng = np.random.default_rng(0)
+    images = rng.random((min(args.requests, 256), 28 * 28), dtype=np.float32).round(3).tolist()
+    latencies = []
+    counter = iter(range(args.requests))
+
+    async def client():
+        if args.unix:
+            reader, writer = await asyncio.open_unix_connection(args.unix)
+        else:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+        for i in counter:
+            started = time.perf_counter()
+            writer.write((json.dumps({"id": i, "image": images[i % len(images)]}) + "\n").encode())
+            response = json.loads(await reader.readline())
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            latencies.append(time.perf_counter() - started)
+        writer.write(b'{"cmd": "stats"}\n')
+        server_stats = json.loads(await reader.readline())
+        writer.close()
+        return server_stats
+
+    start = time.perf_counter()
+    server_stats = (await asyncio.gather(*[client() for _ in range(args.concurrency)]))[-1]
+    elapsed = time.perf_counter() - start
+    p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+    print(json.dumps({"requests": len(latencies), "concurrency": args.concurrency, "p50_ms": float(p50), "p99_ms": float(p99),
+                      "requests_per_s": len(latencies) / elapsed, "server": server_stats}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-batching inference server for a saved eidetic Net')
+    parser.add_argument('--model', default='mnist_cnn.pt', metavar='PATH',
+                        help='state dict written by main.py --save-model (default: mnist_cnn.pt)')
+    parser.add_argument('--device', default=config.get().device,
+                        help='device to run the model on (default: DEVICE from .env, else cpu)')
+    parser.add_argument('--use-indices', type=lambda v: v.lower() in ["1", "true", "yes"], default=None, metavar='BOOL',
+                        help='route through the bucketed weight bank (default: as saved in the checkpoint)')
+    parser.add_argument('--quantize', default=None, choices=['row', 'bucket'],
+                        help='serve int8 indexed layers with per row or per bucket scales (default: float)')
+    parser.add_argument('--max-batch-size', type=int, default=64, metavar='N',
+                        help='largest micro-batch handed to the model (default: 64)')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, metavar='MS',
+                        help='how long the first request of a batch waits for others (default: 2)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='TCP address to listen on or connect to (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='TCP port (default: 8765)')
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help='listen on or connect to a unix socket instead of TCP')
+    parser.add_argument('--stdin', action='store_true', default=False,
+                        help='read requests from stdin and write responses to stdout')
+    parser.add_argument('--load-test', type=int, default=None, metavar='N', dest='requests',
+                        help='act as a client: send N requests to a running server and report latency')
+    parser.add_argument('--concurrency', type=int, default=16, metavar='C',
+                        help='connections used by --load-test (default: 16)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(load_test(args) if args.requests else serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import logging
+import os
+import shlex
+import time
+import torch
+import torch.multiprocessing as mp
+
+#Grid axes set through the environment, read by config.get
+ENV_AXES = ["num_quantiles", "task_a_subset_cardinality", "task_b_subset_cardinality"]
+#Grid axes passed to main.parse_args
+ARG_AXES = ["batch_size", "lr"]
+COLUMNS = ENV_AXES + ARG_AXES + ["task_a_accuracy", "task_b_accuracy", "task_a_loss", "task_b_loss",
+                                 "accuracy", "bwt", "fwt", "forgetting", "average_transfer", "seconds", "error"]
+
+#Set in each worker by init_worker
+_datasets = None
+_directory = None
+_activation_dir = False
+
+
+def share_datasets(datasets):
+    """ Moves the tensors held by each dataset to shared memory, so workers map them instead of receiving copies """
+    for dataset in datasets:
+        for value in vars(dataset).values():
+            if isinstance(value, torch.Tensor):
+                value.share_memory_()
+    return datasets
+
+
+def init_worker(threads, datasets, directory, activation_dir):
+    global _datasets, _directory, _activation_dir
+    #One intra-op pool of threads per worker, workers * threads stays within the cores
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _datasets, _directory, _activation_dir = datasets, directory, activation_dir
+    #main.run logs to benchmark.log unless logging is already configured
+    logging.basicConfig(filename=os.path.join(directory, "worker_" + str(os.getpid()) + ".log"), filemode='a', level=logging.DEBUG)
+
+
+def run_config(job):
+    """ Results row of one grid point, trained by main.run in this worker """
+    index, params, main_args = job
+    import config
+    import main
+    import metrics
+    row = dict(params)
+    for name in ENV_AXES:
+        os.environ[name.upper()] = str(params[name])
+    #Activation files and paged task banks of this run only, so concurrent runs never share them
+    run_directory = os.path.join(_directory, "config_" + str(index))
+    if _activation_dir:
+        os.environ["ACTIVATION_DIR"] = os.path.join(run_directory, "activations")
+    config.reload()
+    path = os.path.join(_directory, "config_" + str(index) + ".json")
+    args = main.parse_args(main_args + ["--batch-size", str(params["batch_size"]), "--lr", str(params["lr"]), "--metrics", path,
+                                        "--bank-dir", os.path.join(run_directory, "banks")])
+
+    #The run's prints go to its own stdout.log, so concurrent runs do not interleave them with the table
+    os.makedirs(run_directory, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(run_directory, "stdout.log"), "a") as output, contextlib.redirect_stdout(output):
+            main.run(0, 1, args, datasets=_datasets)
+    except Exception as error:
+        logging.exception("Config " + str(index) + " failed")
+        row["error"] = type(error).__name__ + ": " + str(error)
+        return index, row
+    row["seconds"] = time.perf_counter() - start
+
+    values = metrics.recorder.as_dict()
+    #Both tasks after the last stage, training on Task B
+    for evaluation in values["evaluations"]:
+        if evaluation["stage"] == "task_b":
+            row[evaluation["task"] + "_accuracy"] = evaluation["accuracy"]
+            row[evaluation["task"] + "_loss"] = evaluation["loss"]
+    row.update(values["transfer"])
+    return index, row
+
+
+def grid(axes):
+    """ Every combination of the values of axes, a dict of name to list """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[name] for name in names])]
+
+
+def sweep(axes, main_args=(), workers=None, threads=None, directory="sweep", datasets=None):
+    """ Results rows of main.run over the grid of axes, in grid order, run by a pool of workers processes
+
+    datasets, the three of main.load_datasets, are loaded once here and shared read-only with
+    the workers. threads defaults to the cores divided among the workers. With ACTIVATION_DIR set,
+    each run keeps its activation files in directory/config_<n>/activations, and its paged task
+    banks and printed output always go to directory/config_<n>/banks and stdout.log.
+    """
+    import config
+    import main
+    if config.get().use_db:
+        raise ValueError("the sweep's runs would share the database tables, unset USE_DB")
+    points = grid(axes)
+    workers = workers or min(len(points), os.cpu_count() or 1)
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    os.makedirs(directory, exist_ok=True)
+    datasets = share_datasets(datasets or main.load_datasets())
+
+    #Workers inherit the environment, so their OpenMP and MKL pools start at the pinned size too
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[name] = str(threads)
+    rows = [None] * len(points)
+    with mp.get_context("spawn").Pool(workers, init_worker, (threads, datasets, directory, config.get().activation_dir is not None)) as pool:
+        for index, row in pool.imap_unordered(run_config, [(i, params, list(main_args)) for i, params in enumerate(points)]):
+            rows[index] = row
+            print("Finished {}/{}: {}".format(sum(r is not None for r in rows), len(rows), format_row(row)), flush=True)
+    return rows
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:.4f}".format(value)
+    return str(value)
+
+
+def format_row(row):
+    return " ".join(name + "=" + format_value(row.get(name)) for name in COLUMNS if name in row)
+
+
+def format_table(rows):
+    """ rows as aligned text columns, one line per row """
+    cells = [COLUMNS] + [[format_value(row.get(name)) for name in COLUMNS] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(COLUMNS))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(line, widths)).rstrip() for line in cells)
+
+
+def write_results(rows, path):
+    """ rows as CSV when path ends in .csv, else JSON """
+    with open(path, "w", newline="") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep of main.py with continual-learning metrics')
+    parser.add_argument('--num-quantiles', type=int, nargs='+', default=[8], metavar='N',
+                        help='NUM_QUANTILES values (default: 8)')
+    parser.add_argument('--task-a-subset-cardinality', type=int, nargs='+', default=[5000], metavar='N',
+                        help='TASK_A_SUBSET_CARDINALITY values (default: 5000)')
+    parser.add_argument('--task-b-subset-cardinality', type=int, nargs='+', default=[1500], metavar='N',
+                        help='TASK_B_SUBSET_CARDINALITY values (default: 1500)')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[64], metavar='N',
+                        help='training batch sizes (default: 64)')
+    parser.add_argument('--lr', type=float, nargs='+', default=[1.0], metavar='LR',
+                        help='learning rates (default: 1.0)')
+    parser.add_argument('--workers', type=int, default=None, metavar='W',
+                        help='concurrent runs (default: one per core, at most one per configuration)')
+    parser.add_argument('--threads', type=int, default=None, metavar='T',
+                        help='torch threads per run (default: cores divided by workers)')
+    parser.add_argument('--main-args', default='', metavar='ARGS',
+                        help='further main.py arguments for every run, e.g. "--cache-features --bank lowrank"')
+    parser.add_argument('--dir', default='sweep', metavar='DIR',
+                        help='directory for the metrics, activation files and paged banks of each run and the worker logs (default: sweep)')
+    parser.add_argument('--output', default='sweep.csv', metavar='PATH',
+                        help='results table, CSV if PATH ends in .csv else JSON (default: sweep.csv)')
+    args = parser.parse_args()
+
+    axes = {name: getattr(args, name) for name in ENV_AXES + ARG_AXES}
+    rows = sweep(axes, shlex.split(args.main_args), args.workers, args.threads, args.dir)
+    print(format_table(rows))
+    write_results(rows, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+import benchmark
+
+
+def write_results(path, rows):
+    with open(path, "w") as f:
+        json.dump({"results": [{"benchmark": name, "params": params, "metrics": metrics} for name, params, metrics in rows]}, f)
+
+
+def test_compare_counts_regressions_in_both_directions(tmp_path):
+    base, new = str(tmp_path / "base.json"), str(tmp_path / "new.json")
+    write_results(base, [("layers", {"size": 8}, {"forward_ms": 1.0, "backward_ms": 1.0}), ("main", {}, {"samples_per_s": 100.0, "accuracy": 0.5}),
+                         ("removed", {}, {"forward_ms": 1.0})])
+    #A slower forward and fewer samples/s regress, a faster backward and a worse accuracy (not a timing) do not
+    write_results(new, [("layers", {"size": 8}, {"forward_ms": 1.5, "backward_ms": 0.5}), ("main", {}, {"samples_per_s": 80.0, "accuracy": 0.1}),
+                        ("added", {}, {"forward_ms": 1.0})])
+    assert benchmark.compare(base, new, 0.1) == 2
+    assert benchmark.compare(base, new, 0.6) == 0
+
+
+def test_layers_benchmark_writes_json(tmp_path):
+    path = str(tmp_path / "results.json")
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-m", "benchmark", "layers", "--sizes", "8", "--quantiles", "2", "--batch-sizes", "4", "--repeat", "1", "--json", path],
+                   cwd=tmp_path, env=environment, check=True, stdout=subprocess.DEVNULL)
+    with open(path) as f:
+        results = json.load(f)
+    rows = results["results"]
+    #Three layers, with and without indices
+    assert len(rows) == 6 and {row["params"]["layer"] for row in rows} == {"eidetic", "eidetic_indexed", "indexed"}
+    assert all(row["metrics"]["forward_ms"] > 0 and row["metrics"]["backward_ms"] > 0 for row in rows)
+    assert "environment" in results
+    #A run compared with itself has no regressions
+    assert benchmark.compare(path, path, 0.0) == 0
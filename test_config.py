@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import pytest
+import config
+
+
+def test_from_env_parses_each_field_type():
+    settings = config.Config.from_env({"USE_DB": "Yes", "PORT": "5433", "DB_SAMPLE_PERCENT": "2.5", "NUM_QUANTILES": "16", "ACTIVATION_DIR": "acts"})
+    assert settings.use_db is True and settings.port == 5433 and settings.db_sample_percent == 2.5
+    assert settings.num_quantiles == 16 and settings.activation_dir == "acts"
+    assert config.Config.from_env({"USE_DB": "false"}).use_db is False
+
+
+def test_from_env_keeps_defaults_for_unset_and_empty_values():
+    assert config.Config.from_env({"PORT": "", "DATABASE": ""}) == config.Config()
+
+
+def test_from_env_names_the_invalid_variable():
+    with pytest.raises(ValueError, match="NUM_QUANTILES"):
+        config.Config.from_env({"NUM_QUANTILES": "eight"})
+
+
+def test_get_resolves_once_until_reload(monkeypatch):
+    monkeypatch.setenv("NUM_QUANTILES", "5")
+    assert config.reload().num_quantiles == 5
+    monkeypatch.setenv("NUM_QUANTILES", "6")
+    assert config.get().num_quantiles == 5
+    assert config.reload().num_quantiles == 6
+
+
+def test_imports_have_no_side_effects(tmp_path):
+    #Nothing is logged, read or connected until main() runs, even with USE_DB set
+    environment = dict(os.environ, USE_DB="True", HOST="unreachable.invalid", PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", "import customlayers, db, main, serve; main.Net()"], cwd=tmp_path, env=environment, check=True)
+    assert list(tmp_path.iterdir()) == []
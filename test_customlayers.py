@@ -0,0 +1,396 @@
+import os
+import numpy as np
+import pytest
+import torch
+import customlayers
+import main
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+
+def make_eidetic_layer(size, num_quantiles, samples=2000):
+    """ EideticLinearLayer with thresholds taken from random activations """
+    layer = customlayers.EideticLinearLayer(size, size, 1.0, samples, 1)
+    activations = torch.randn(samples, size).numpy()
+    layer.set_quantiles(np.quantile(activations, np.arange(1, num_quantiles) / num_quantiles, axis=0).T)
+    return layer
+
+
+@pytest.mark.parametrize("num_quantiles", [2, 8, 64])
+def test_bucketize_matches_binary_search(num_quantiles):
+    size, batch_size = 16, 32
+    layer = make_eidetic_layer(size, num_quantiles)
+    activations = torch.randn(batch_size, size)
+    expected = torch.tensor([[layer.binarySearchQuantiles(activations[j][i].item(), i) for i in range(size)] for j in range(batch_size)])
+    assert torch.equal(customlayers.bucketize(activations, layer.quantiles, layer.quantiles_increasing), expected)
+
+
+@pytest.mark.parametrize("num_quantiles", [2, 8])
+def test_indexed_product_matches_loop(num_quantiles):
+    size, batch_size = 16, 8
+    layer = customlayers.IndexedLinearLayer(size, size, num_quantiles)
+    x = torch.randn(batch_size, size)
+    indices = torch.randint(0, num_quantiles, (batch_size, size))
+    with torch.no_grad():
+        #Sum over inputs of input i's weights in its bucket, scaled by input i
+        expected = torch.stack([sum(layer.param_index[indices[b][i], i] * x[b][i] for i in range(size)) for b in range(batch_size)])
+        assert torch.allclose(customlayers.indexed_product(x, indices, layer.param_index), expected, atol=1e-5)
+
+
+def test_indexed_product_gradient_of_strided_bank():
+    size_in, size_out, num_quantiles, batch_size = 6, 4, 3, 8
+    #A transposed view, as the delta banks' materialize returns
+    bank = torch.randn(num_quantiles, size_out, size_in).transpose(1, 2).requires_grad_()
+    contiguous = bank.detach().contiguous().requires_grad_()
+    x = torch.randn(batch_size, size_in)
+    indices = torch.randint(0, num_quantiles, (batch_size, size_in))
+    customlayers.indexed_product(x, indices, bank).sum().backward()
+    customlayers.indexed_product(x, indices, contiguous).sum().backward()
+    assert torch.allclose(bank.grad, contiguous.grad)
+
+
+def test_sparse_bank_gradient_matches_dense():
+    size_in, size_out, num_quantiles, batch_size = 6, 4, 8, 5
+    bank = torch.randn(num_quantiles, size_in, size_out, requires_grad=True)
+    x = torch.randn(batch_size, size_in, requires_grad=True)
+    indices = torch.randint(0, num_quantiles, (batch_size, size_in))
+    dense = torch.autograd.grad(customlayers.indexed_product(x, indices, bank).square().sum(), [x, bank])
+    sparse = torch.autograd.grad(customlayers.indexed_product(x, indices, bank, True).square().sum(), [x, bank])
+    assert sparse[1].is_sparse and torch.equal(sparse[0], dense[0])
+    assert torch.allclose(sparse[1].to_dense(), dense[1])
+    #Only the hit (bucket, input) rows are stored
+    assert sparse[1]._nnz() == len(set(zip(indices.reshape(-1).tolist(), list(range(size_in)) * batch_size)))
+
+
+def test_sparse_adadelta_matches_adadelta():
+    size_in, size_out, num_quantiles = 6, 4, 8
+    start = torch.randn(num_quantiles, size_in, size_out)
+    banks = {name: start.clone().requires_grad_() for name in ["reference", "dense", "sparse"]}
+    optimizers = {"reference": torch.optim.Adadelta([banks["reference"]], lr=1.0), "dense": customlayers.SparseAdadelta([banks["dense"]], lr=1.0),
+                  "sparse": customlayers.SparseAdadelta([banks["sparse"]], lr=1.0)}
+    #The same buckets every step, so the untouched rows' running averages never matter
+    x, indices = torch.randn(3, size_in), torch.randint(0, num_quantiles // 2, (3, size_in))
+    for _ in range(3):
+        for name, bank in banks.items():
+            customlayers.indexed_product(x, indices, bank, name == "sparse").square().sum().backward()
+            optimizers[name].step()
+            optimizers[name].zero_grad()
+    assert torch.allclose(banks["dense"], banks["reference"], atol=1e-6)
+    assert torch.allclose(banks["sparse"], banks["reference"], atol=1e-6)
+    assert torch.equal(banks["sparse"][num_quantiles // 2:], start[num_quantiles // 2:])
+
+
+@pytest.mark.parametrize("kind", ["lowrank", "scale"])
+def test_delta_bank_matches_materialized_bank(kind):
+    size_in, size_out, num_quantiles, batch_size = 12, 5, 8, 16
+    layer = customlayers.IndexedLinearLayer(size_in, size_out, num_quantiles, bank=kind, bank_rank=3)
+    assert layer.param_index is None
+    #Every bucket starts as a copy of the shared weights
+    bank = layer.delta.materialize(layer.weights)
+    assert torch.allclose(bank, layer.weights.t().expand(num_quantiles, -1, -1), atol=1e-6)
+
+    with torch.no_grad():
+        for param in layer.bank_parameters():
+            param.add_(torch.randn_like(param))
+    layer.use_indices = True
+    x = torch.randn(batch_size, size_in)
+    indices = torch.randint(0, num_quantiles, (batch_size, size_in))
+    output = layer(x, indices)
+    expected = customlayers.indexed_product(x, indices, layer.delta.materialize(layer.weights)) + layer.bias
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    #Same gradients for the shared weights and the deltas as through the full bank
+    params = [layer.weights] + list(layer.delta.parameters())
+    gradients = torch.autograd.grad(output.square().sum(), params)
+    expected_gradients = torch.autograd.grad(expected.square().sum(), params)
+    for gradient, expected_gradient in zip(gradients, expected_gradients):
+        assert torch.allclose(gradient, expected_gradient, atol=1e-4)
+
+    layer.delta.reset()
+    assert torch.allclose(layer.delta.materialize(layer.weights), layer.weights.t().expand(num_quantiles, -1, -1), atol=1e-6)
+
+
+@pytest.mark.parametrize("indexed", [customlayers.IndexedLinearLayer, customlayers.EideticIndexedLinearLayer])
+def test_legacy_param_index_state_dict(indexed):
+    size_in, size_out, num_quantiles = 6, 4, 3
+    if indexed is customlayers.IndexedLinearLayer:
+        make = lambda: indexed(size_in, size_out, num_quantiles)
+    else:
+        make = lambda: indexed(size_in, size_out, 1.0, 100, num_quantiles, 2)
+    layer = make()
+    with torch.no_grad():
+        layer.param_index.normal_()
+    state = layer.state_dict()
+
+    #The ParameterList layout: vector i*size_in + j held the weights of input j for quantile i
+    bank = state.pop("param_index")
+    for key in range(num_quantiles * size_in):
+        state["param_index." + str(key)] = bank.reshape(-1, size_out)[key].clone()
+    loaded = make()
+    loaded.load_state_dict(state)
+    assert torch.equal(loaded.param_index, bank)
+
+    x = torch.randn(5, size_in)
+    indices = torch.randint(0, num_quantiles, (5, size_in))
+    with torch.no_grad():
+        assert torch.equal(customlayers.indexed_product(x, indices, loaded.param_index), customlayers.indexed_product(x, indices, layer.param_index))
+
+
+@pytest.mark.parametrize("num_quantiles", [2, 8, 16])
+def test_exact_quantiles_matches_sorting_loop(num_quantiles):
+    samples, size = 1000, 8
+    values = np.random.randn(samples, size).astype(np.float32)
+    step = int(samples / num_quantiles)
+    expected = np.array([np.sort(values[:, j], kind="mergesort")[[step * (i + 1) for i in range(num_quantiles - 1)]] for j in range(size)])
+    assert np.array_equal(customlayers.exact_quantiles(values, num_quantiles), expected)
+
+
+@pytest.mark.parametrize("distribution", ["normal", "lognormal"])
+@pytest.mark.parametrize("dtype", customlayers.STORE_DTYPES)
+def test_store_dtype_thresholds_within_tolerance(dtype, distribution):
+    samples, size, num_quantiles, batch_size = 20000, 16, 16, 1024
+    #Per-neuron shifted and scaled activations, streamed in batches so the integer ranges widen
+    shift, spread = torch.rand(size) * 10 - 5, torch.rand(size) * 10
+    activations = torch.randn(samples, size)
+    activations = (activations.exp() if distribution == "lognormal" else activations) * spread + shift
+    exact = customlayers.exact_quantiles(activations.numpy(), num_quantiles)
+
+    store = customlayers.ActivationStore(samples, size, dtype=dtype)
+    for offset in range(0, samples, batch_size):
+        store.add(activations[offset:offset + batch_size])
+    error = np.abs(customlayers.exact_quantiles(store.numpy(), num_quantiles) - exact)
+    if dtype == "float16":
+        bound = np.abs(exact) * 2.0 ** -11
+    elif dtype == "bfloat16":
+        bound = np.abs(exact) * 2.0 ** -8
+    elif store.quantized:
+        bound = 1.5 * store.scale.numpy()[:, None]
+    else:
+        bound = np.zeros_like(exact)
+    assert np.all(error <= bound + 1e-6 * np.abs(exact))
+
+
+@pytest.mark.parametrize("dtype", [dtype for dtype in customlayers.STORE_DTYPES if dtype != "float32"])
+def test_memmap_store_rejects_other_dtypes(tmp_path, dtype):
+    with pytest.raises(ValueError, match="store_dtype"):
+        customlayers.EideticLinearLayer(8, 8, 1.0, 100, 1, store_path=str(tmp_path), store_dtype=dtype)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_index_cache_stores_repeated_ids_once():
+    cache = customlayers.IndexCache(4, 3)
+    cache.lookup(torch.tensor([5]), "key")
+    cache.insert(torch.tensor([5, 5, 5, 7]), torch.tensor([[1, 2, 3]] * 3 + [[4, 5, 6]]), 8)
+    cache.insert(torch.tensor([7, 8]), torch.tensor([[4, 5, 6], [7, 7, 7]]), 8)
+    assert sorted(cache.owner[cache.owner >= 0].tolist()) == [5, 7, 8]
+    hit, found = cache.lookup(torch.tensor([5, 7, 8, 9]), "key")
+    assert hit.tolist() == [True, True, True, False]
+    assert found.tolist() == [[1, 2, 3], [4, 5, 6], [7, 7, 7]]
+
+
+def test_index_cache_evicts_least_recently_used():
+    cache = customlayers.IndexCache(2, 1)
+    cache.lookup(torch.tensor([0, 1]), "key")
+    cache.insert(torch.tensor([0, 1]), torch.tensor([[0], [1]]), 8)
+    #Sample 0 is used again, so sample 1 is evicted for sample 2
+    cache.lookup(torch.tensor([0]), "key")
+    cache.lookup(torch.tensor([2]), "key")
+    cache.insert(torch.tensor([2]), torch.tensor([[2]]), 8)
+    hit, found = cache.lookup(torch.tensor([0, 1, 2]), "key")
+    assert hit.tolist() == [True, False, True]
+    assert found.tolist() == [[0], [2]]
+
+
+def test_index_cache_memory_is_bounded_by_capacity():
+    cache = customlayers.IndexCache(8, 2)
+    sizes = [buffer.numel() for buffer in cache.buffers()]
+    for start in range(0, 1 << 40, 1 << 36):
+        ids = torch.tensor([start, start, start + 1])
+        hit, _ = cache.lookup(ids, "key")
+        cache.insert(ids[~hit], torch.zeros(int((~hit).sum()), 2, dtype=torch.long), 8)
+    assert [buffer.numel() for buffer in cache.buffers()] == sizes
+    assert len(set(cache.owner.tolist())) == 8
+
+
+def test_index_cache_clears_when_weights_or_thresholds_change():
+    layer = make_eidetic_layer(8, 8)
+    layer.index_cache = customlayers.IndexCache(64, 8)
+    x, ids = torch.randn(16, 8), torch.arange(16)
+
+    def cached():
+        with torch.no_grad():
+            return layer(x, False, True, False, ids)[1]
+
+    def expected():
+        return customlayers.bucketize(torch.mm(x, layer.weights.detach().t()), layer.quantiles, layer.quantiles_increasing)
+
+    assert torch.equal(cached(), expected())
+    assert torch.equal(cached(), expected()) and layer.index_cache.hits == 16
+    with torch.no_grad():
+        layer.weights.mul_(-1)
+    assert torch.equal(cached(), expected())
+    layer.set_quantiles(layer.quantiles * 2)
+    assert torch.equal(cached(), expected())
+
+
+def numbered_rows(start, stop):
+    """ (stop - start, 1) rows holding their own row numbers """
+    return torch.arange(start, stop, dtype=torch.float32)[:, None]
+
+
+def test_ring_store_keeps_newest_rows():
+    store = customlayers.ActivationStore(10, 1, mode="ring")
+    for start in range(0, 47, 7):
+        store.add(numbered_rows(start, min(start + 7, 47)))
+    assert store.count == 10 and store.seen == 47
+    assert sorted(store.numpy()[:, 0].tolist()) == list(range(37, 47))
+    #A batch larger than the store keeps its newest rows
+    store.add(numbered_rows(100, 125))
+    assert sorted(store.numpy()[:, 0].tolist()) == list(range(115, 125))
+
+
+def test_reservoir_store_samples_uniformly():
+    capacity, rows, trials = 10, 100, 2000
+    kept = torch.zeros(rows)
+    for _ in range(trials):
+        store = customlayers.ActivationStore(capacity, 1, mode="reservoir")
+        for start in range(0, rows, 7):
+            store.add(numbered_rows(start, min(start + 7, rows)))
+        values = store.numpy()[:, 0]
+        assert len(set(values.tolist())) == capacity
+        kept[torch.from_numpy(values).long()] += 1
+    #Every row is kept with probability capacity / rows, whatever batch it arrived in
+    assert (kept / trials - capacity / rows).abs().max() < 0.035
+
+
+def test_store_sample_rate_and_checkpoint():
+    store = customlayers.ActivationStore(5000, 3, sample_rate=0.5)
+    sampled = store.add(torch.randn(4000, 3))
+    assert store.count == len(sampled) and 1800 < len(sampled) < 2200
+    restored = customlayers.ActivationStore(5000, 3)
+    restored.restore(store.checkpoint())
+    assert (restored.numpy() == store.numpy()).all() and restored.seen == store.seen
+
+
+def assert_within_rank_error(sketch, values, num_quantiles):
+    """ Every threshold's rank among values is within the sketch's worst-case rank error of its target """
+    thresholds = sketch.quantiles(num_quantiles)
+    ranks = (values.t()[:, :, None] <= thresholds[:, None, :]).sum(1).double()
+    targets = torch.arange(1, num_quantiles, dtype=torch.float64) / num_quantiles * len(values)
+    assert ((ranks - targets).abs() <= sketch.rank_error + 1).all()
+    #The random offsets keep the observed error near 2 / k, well inside the worst case
+    assert ((ranks - targets).abs() / len(values)).max() < 4 / sketch.k
+
+
+def test_sketch_rank_error_and_memory():
+    values = torch.randn(20000, 4) * torch.tensor([1.0, 10.0, 0.1, 3.0])
+    sketch = customlayers.QuantileSketch(4, k=64)
+    for start in range(0, len(values), 1000):
+        sketch.update(values[start:start + 1000])
+    assert sketch.count == len(values) and 0 < sketch.error_bound() < 1
+    assert sum(items.shape[1] for items in sketch.levels) < 64 / (1 - sketch.c) + 2 * len(sketch.levels)
+    assert_within_rank_error(sketch, values, 8)
+
+
+def test_sketch_merge():
+    values = torch.rand(12000, 3)
+    merged = customlayers.QuantileSketch(3, k=64)
+    for part in values.split(4000):
+        sketch = customlayers.QuantileSketch(3, k=64)
+        sketch.update(part)
+        merged.merge(sketch)
+    assert merged.count == len(values)
+    assert_within_rank_error(merged, values, 4)
+    with pytest.raises(ValueError):
+        merged.merge(customlayers.QuantileSketch(2))
+
+
+def merge_on_rank(rank, world_size, init_method, values, sketched, path):
+    """ Thresholds of merged_quantiles over this rank's shard of values, saved to path_<rank>.pt """
+    customlayers.dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    shard = values.chunk(world_size)[rank]
+    sketch = store = None
+    if sketched:
+        sketch = customlayers.QuantileSketch(values.shape[1], 64)
+        sketch.update(shard)
+    else:
+        store = customlayers.ActivationStore(len(shard), values.shape[1])
+        store.add(shard)
+    torch.save(torch.as_tensor(customlayers.merged_quantiles(sketch, store, 4, False, 1)), path + "_" + str(rank) + ".pt")
+    customlayers.dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("sketched", [False, True])
+def test_merged_quantiles_match_across_ranks(tmp_path, sketched):
+    values = torch.randn(900, 3)
+    path = str(tmp_path / "quantiles")
+    torch.multiprocessing.spawn(merge_on_rank, args=(2, "tcp://127.0.0.1:" + str(main.free_port()), values, sketched, path), nprocs=2)
+    first, second = torch.load(path + "_0.pt"), torch.load(path + "_1.pt")
+    assert torch.equal(first, second)
+    if sketched:
+        #The merged sketch keeps the normalized rank error of one sketch over every row
+        ranks = (values.t()[:, :, None] <= first[:, None, :]).sum(1).double()
+        targets = torch.arange(1, 4, dtype=torch.float64) / 4 * len(values)
+        assert ((ranks - targets).abs() / len(values)).max() < 4 / 64
+    else:
+        #Both shards together, as one process storing every row would compute them
+        assert np.array_equal(first.numpy(), customlayers.exact_quantiles(values.numpy(), 4))
+
+
+def test_memmap_store_grows_reopens_and_closes(tmp_path):
+    path = str(tmp_path / "activations_1.npy")
+    rows = torch.randn(10, 3)
+    store = customlayers.MemmapActivationStore(path, 3, chunk_rows=4)
+    for block in rows.split(3):
+        store.add(block)
+    assert store.count == 10 and store.capacity == 12
+    assert np.array_equal(np.load(path, mmap_mode="r"), rows.numpy())
+
+    #Reopened by a later run, which appends to the stored rows
+    store.close()
+    store.close()
+    assert os.path.getsize(path) == customlayers.MemmapActivationStore.HEADER_SIZE + 10 * 3 * 4
+    store = customlayers.MemmapActivationStore(path, 3, chunk_rows=4)
+    store.add(rows[:2])
+    assert np.array_equal(store.numpy(), torch.cat([rows, rows[:2]]).numpy())
+
+    store.reset()
+    assert store.count == 0 and np.load(path).shape == (0, 3)
+    store.close()
+    with pytest.raises(ValueError):
+        customlayers.MemmapActivationStore(path, 4)
+
+
+@pytest.mark.parametrize("bank", ["full", "scale"])
+def test_eidetic_conv2d_matches_reference_convs(bank):
+    in_channels, out_channels, num_quantiles = 3, 4, 4
+    layer = customlayers.EideticConv2d(in_channels, out_channels, 3, 1.0, 100, num_quantiles, 1, stride=2, padding=1, bank=bank)
+    layer.set_quantiles(torch.tensor([[-0.5, 0.0, 0.5]] * out_channels))
+    x = torch.randn(5, in_channels, 9, 9)
+
+    output, indices = layer(x, None, False, True, False)
+    plain = torch.nn.functional.conv2d(x, layer.weights, None, 2, 1)
+    assert torch.allclose(output, plain + layer.bias.view(1, -1, 1, 1), atol=1e-6)
+    #Buckets per output channel, with every sample and position a row
+    rows = customlayers.bucketize(plain.detach().permute(0, 2, 3, 1).reshape(-1, out_channels), layer.quantiles, layer.quantiles_increasing)
+    assert torch.equal(indices, rows.reshape(5, 5, 5, out_channels).permute(0, 3, 1, 2))
+
+    with torch.no_grad():
+        for param in layer.bank_parameters():
+            param.add_(torch.randn_like(param) * 0.1)
+    layer.use_indices = True
+    input_indices = torch.randint(0, num_quantiles, x.shape)
+    output = layer(x, input_indices, False, False, False)[0]
+    kernels = layer.param_index if bank == "full" else layer.delta.materialize(layer.weights)
+    #Each bucket's elements convolved with that bucket's kernels
+    expected = sum(torch.nn.functional.conv2d(x * (input_indices == q), kernels[q], None, 2, 1) for q in range(num_quantiles)) + layer.bias.view(1, -1, 1, 1)
+    assert torch.allclose(output, expected, atol=1e-5)
+    params = [layer.weights] + layer.bank_parameters() if bank == "scale" else layer.bank_parameters()
+    gradients = torch.autograd.grad(output.square().sum(), params)
+    expected_gradients = torch.autograd.grad(expected.square().sum(), params)
+    for gradient, expected_gradient in zip(gradients, expected_gradients):
+        assert torch.allclose(gradient, expected_gradient, atol=1e-4)
@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+import config
+import customlayers
+import db
+
+#Tables of the tests, recreated by each one
+TABLE = 90
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    np.random.seed(0)
+
+
+@pytest.fixture
+def database_factory():
+    """ Database(**kwargs) on the Postgres of the environment (DATABASE, USER, HOST, ...), skipping the test without one """
+    pytest.importorskip("psycopg2")
+    config.reload()
+    opened = []
+
+    def make(**kwargs):
+        database = db.Database(**kwargs)
+        opened.append(database)
+        try:
+            database.connection
+        except Exception as error:
+            pytest.skip("no Postgres: " + str(error))
+        return database
+
+    yield make
+    for database in opened:
+        database.close()
+
+
+@pytest.mark.parametrize("layout", ["long", "wide"])
+def test_empty_distribution_keeps_previous(database_factory, layout):
+    database = database_factory(layout=layout)
+    database.recreate_tables(4, TABLE)
+    with pytest.raises(ValueError, match="percentile_activations_" + str(TABLE)):
+        database.create_quantile_distribution(4, TABLE)
+
+    database.insert_records(np.random.randn(50, 6), TABLE)
+    database.create_quantile_distribution(4, TABLE)
+    with pytest.raises(ValueError, match="sample_percent=0.0001"):
+        database.create_quantile_distribution(4, TABLE, sample_percent=0.0001)
+    cursor = database.connection.cursor()
+    cursor.execute("select count(*) from percentile_distribution_" + str(TABLE))
+    assert cursor.fetchone()[0] == 6
+
+
+def read_copy_binary(stream):
+    """ The tuples of a binary COPY stream, each a list of raw field bytes, parsed field by field """
+    assert stream[:11] == b"PGCOPY\n\377\r\n\0" and stream[-2:] == b"\xff\xff"
+    position, tuples = 19, []
+    while position < len(stream) - 2:
+        fields = int(np.frombuffer(stream, ">i2", 1, position)[0])
+        position, values = position + 2, []
+        for _ in range(fields):
+            length = int(np.frombuffer(stream, ">i4", 1, position)[0])
+            values.append(stream[position + 4:position + 4 + length])
+            position = position + 4 + length
+        tuples.append(values)
+    return tuples
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32", "int16"])
+def test_copy_binary_round_trip(dtype):
+    field_type = db.COLUMN_TYPES[dtype][1]
+    records = (np.random.randn(5, 3) * 1000).astype(field_type)
+    tuples = read_copy_binary(db.copy_binary(records, field_type))
+    assert [int(np.frombuffer(node, ">i4")[0]) for node, _ in tuples] == [1, 2, 3] * 5
+    assert np.array_equal(np.concatenate([np.frombuffer(value, field_type) for _, value in tuples]), records.reshape(-1))
+
+
+def test_copy_text_round_trip():
+    records = np.random.randn(5, 3)
+    rows = np.loadtxt(db.copy_text(records).splitlines(), delimiter="\t")
+    assert np.array_equal(rows[:, 0], np.tile([1, 2, 3], 5))
+    assert np.array_equal(rows[:, 1], records.reshape(-1))
+
+
+@pytest.mark.parametrize("copy_format", ["binary", "text"])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_long_layout_round_trip(database_factory, copy_format, dtype):
+    database = database_factory(flush_size=40, copy_format=copy_format, layout="long", dtype=dtype)
+    database.recreate_tables(4, TABLE)
+    records = np.random.randn(100, 3)
+    #Two full flushes and the rest on the explicit flush
+    for block in np.array_split(records, 5):
+        database.insert_records(block, TABLE)
+    database.flush()
+    cursor = database.connection.cursor()
+    cursor.execute("select node_id, activation from percentile_activations_" + str(TABLE))
+    rows = np.array(cursor.fetchall())
+    #Compared in the column's precision, psycopg2 reads real through its shortest decimal text
+    column = np.dtype(db.COLUMN_TYPES[dtype][1])
+    for node in range(3):
+        assert np.array_equal(np.sort(rows[rows[:, 0] == node + 1, 1].astype(column)), np.sort(records[:, node].astype(column)))
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_copy_binary_wide_round_trip(dtype):
+    field_type = db.COLUMN_TYPES[dtype][1]
+    records = np.random.randn(4, 3)
+    tuples = read_copy_binary(db.copy_binary_wide(records, field_type))
+    assert len(tuples) == 4 and all(len(fields) == 1 for fields in tuples)
+    for (array,), row in zip(tuples, records):
+        #ndim, has-null flag, element type oid, length, lower bound, then (length, value) per element
+        assert np.frombuffer(array, ">i4", 5).tolist() == [1, 0, db.ARRAY_ELEMENTS[field_type][0], 3, 1]
+        elements = np.frombuffer(array, [("length", ">i4"), ("value", field_type)], offset=20)
+        assert (elements["length"] == np.dtype(field_type).itemsize).all()
+        assert np.array_equal(elements["value"], row.astype(field_type))
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_copy_text_wide_round_trip(dtype):
+    field_type = db.COLUMN_TYPES[dtype][1]
+    records = np.random.randn(4, 3)
+    rows = [np.array(line.strip("{}").split(","), dtype=field_type) for line in db.copy_text_wide(records, field_type).splitlines()]
+    assert np.array_equal(np.stack(rows), records.astype(field_type))
+
+
+def test_wide_layout_rejects_int16():
+    with pytest.raises(ValueError, match="wide"):
+        db.Database(layout="wide", dtype="int16")
+
+
+@pytest.mark.parametrize("copy_format", ["binary", "text"])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_wide_layout_round_trip(database_factory, copy_format, dtype):
+    database = database_factory(flush_size=40, copy_format=copy_format, layout="wide", dtype=dtype)
+    database.recreate_tables(4, TABLE)
+    records = np.random.randn(100, 3)
+    for block in np.array_split(records, 5):
+        database.insert_records(block, TABLE)
+    database.flush()
+    cursor = database.connection.cursor()
+    cursor.execute("select pg_typeof(activations)::text, activations from percentile_activations_" + str(TABLE) + " order by sample_id")
+    rows = cursor.fetchall()
+    assert rows[0][0] == db.COLUMN_TYPES[dtype][0] + "[]"
+    column = np.dtype(db.COLUMN_TYPES[dtype][1])
+    assert np.array_equal(np.array([row[1] for row in rows]).astype(column), records.astype(column))
+
+
+@pytest.mark.parametrize("layout", ["long", "wide"])
+def test_distribution_matches_exact_quantiles(database_factory, layout):
+    database = database_factory(layout=layout)
+    database.recreate_tables(4, TABLE)
+    records = np.random.randn(500, 6)
+    database.insert_records(records, TABLE)
+    assert np.array_equal(database.create_quantile_distribution(4, TABLE), customlayers.exact_quantiles(records, 4, "disc"))
+    #A refresh replaces the stored distribution, here with the first 100 samples only: the row cap
+    #counts table rows, one per sample and node in the long layout
+    capped = database.create_quantile_distribution(4, TABLE, row_cap=100 * 6 if layout == "long" else 100)
+    assert np.array_equal(capped, customlayers.exact_quantiles(records[:100], 4, "disc"))
+    cursor = database.connection.cursor()
+    cursor.execute("select count(*) from percentile_distribution_" + str(TABLE))
+    assert cursor.fetchone()[0] == 6
+
+
+def test_int16_distribution_within_a_code_step(database_factory):
+    database = database_factory(layout="long", dtype="int16")
+    database.recreate_tables(4, TABLE)
+    records = np.random.randn(2000, 6) * 3 + 1
+    #The code range widens on the second block
+    database.insert_records(records[:1000] / 4, TABLE)
+    database.insert_records(records[1000:], TABLE)
+    expected = customlayers.exact_quantiles(np.concatenate([records[:1000] / 4, records[1000:]]), 4, "disc")
+    assert np.abs(database.create_quantile_distribution(4, TABLE) - expected).max() <= 1.5 * (records.max() - records.min()) * 2 / 65534
@@ -0,0 +1,173 @@
+import pytest
+import torch
+import config
+import main
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    for name in ["USE_DB", "ACTIVATION_DIR", "NUM_QUANTILES"]:
+        monkeypatch.delenv(name, raising=False)
+    config.reload()
+    torch.manual_seed(0)
+
+
+def indexed_net(num_quantiles=4, **kwargs):
+    """ Net with layer 2 thresholds from random images, indexed with a perturbed bank """
+    net = main.Net(num_quantiles=num_quantiles, quantile_cardinality=300, **kwargs).eval()
+    images = torch.randn(300, 1, 28, 28)
+    with torch.no_grad():
+        net(images, [False, True], [False, False], [False, False])
+        net.calculate_n_quantiles(num_quantiles, False, "2")
+        net.index_layers(num_quantiles, "2")
+        net.use_indices(True, "2")
+        for param in net.indexed.bank_parameters():
+            param.add_(torch.randn_like(param))
+    return net, images
+
+
+def indexed_forward(net, images):
+    with torch.no_grad():
+        return net(images, [False, False], [False, True], [False, False])
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+def test_feature_cache_runs_the_backbone_once(tmp_path, monkeypatch, memmap):
+    net, images = indexed_net()
+    main.freeze_layers(net)
+    dataset = torch.utils.data.TensorDataset(images, torch.randint(0, 10, (len(images),)))
+    cache = main.FeatureCache(net, dataset, "cpu", 128, str(tmp_path / "features.npy") if memmap else None, id_offset=1000)
+    reference = indexed_forward(net, images)
+    calls = []
+    backbone = net.backbone
+    monkeypatch.setattr(net, "backbone", lambda x: calls.append(len(x)) or backbone(x))
+
+    for _ in range(2):
+        features, targets, sample_ids = next(iter(cache.loader(len(images))))
+    assert calls == [128, 128, 44]
+    assert torch.equal(targets, dataset.tensors[1]) and torch.equal(sample_ids, torch.arange(1000, 1300))
+    with torch.no_grad():
+        assert torch.allclose(net.head(features, [False, False], [False, True], [False, False]), reference, atol=1e-6)
+
+    #An in-place update of a backbone weight, then unfreezing it, each rebuild the cache
+    with torch.no_grad():
+        net.fc2.weight.mul_(2)
+    cache.loader(len(images))
+    assert len(calls) == 6
+    with torch.no_grad():
+        assert torch.allclose(cache.features, backbone(images), atol=1e-6)
+    net.fc2.weight.requires_grad = True
+    cache.loader(len(images))
+    assert len(calls) == 9
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"sketch_size": 64}, {"store_dtype": "int8"}, {"bank": "lowrank"}])
+def test_checkpoint_round_trip(tmp_path, kwargs):
+    net, images = indexed_net(**kwargs)
+    path = str(tmp_path / "model.pt")
+    main.save_checkpoint(net, path)
+    loaded = main.load_checkpoint(path)
+    assert loaded.indexed.use_indices
+    assert torch.equal(loaded.eideticIndexed.quantiles, net.eideticIndexed.quantiles)
+    assert torch.equal(indexed_forward(loaded, images), indexed_forward(net, images))
+
+
+def test_checkpoint_keeps_saved_stores(tmp_path):
+    net, images = indexed_net()
+    path = str(tmp_path / "model.pt")
+    main.save_checkpoint(net, path, include_stores=True)
+    loaded = main.load_checkpoint(path)
+    assert (loaded.eideticIndexed.activations.numpy() == net.eideticIndexed.activations.numpy()).all()
+    loaded.eideticIndexed.calculate_n_quantiles(4, False)
+    assert torch.equal(loaded.eideticIndexed.quantiles, net.eideticIndexed.quantiles)
+
+
+def test_load_checkpoint_leaves_activation_dir_alone(tmp_path, monkeypatch):
+    monkeypatch.setenv("ACTIVATION_DIR", str(tmp_path / "activations"))
+    config.reload()
+    #A training run that is still appending to its activation files
+    net, images = indexed_net()
+    files = sorted((tmp_path / "activations").iterdir())
+    before = [f.read_bytes() for f in files]
+    path = str(tmp_path / "model.pt")
+    main.save_checkpoint(net, path, include_stores=True)
+
+    loaded = main.load_checkpoint(path)
+    assert [f.read_bytes() for f in files] == before
+    assert loaded.eideticIndexed.activations is None
+    assert torch.equal(indexed_forward(loaded, images), indexed_forward(net, images))
+    net.close_stores()
+
+
+def test_load_bare_state_dict(tmp_path):
+    net, images = indexed_net(num_quantiles=8)
+    path = str(tmp_path / "model.pt")
+    torch.save(net.state_dict(), path)
+    loaded = main.load_checkpoint(path)
+    assert loaded.indexed.use_indices
+    assert torch.equal(indexed_forward(loaded, images), indexed_forward(net, images))
+
+
+@pytest.mark.parametrize("bank", ["full", "lowrank"])
+def test_frozen_net_matches_forward(tmp_path, bank):
+    net, images = indexed_net(bank=bank)
+    frozen = net.freeze([False, True])
+    with torch.no_grad():
+        assert torch.allclose(frozen(images), indexed_forward(net, images), atol=1e-5)
+        path = str(tmp_path / "frozen.pt")
+        torch.jit.script(frozen).save(path)
+        assert torch.allclose(torch.jit.load(path)(images), frozen(images), atol=1e-6)
+
+
+def test_frozen_net_with_repeated_thresholds():
+    net, images = indexed_net()
+    net.eideticIndexed.set_quantiles(torch.zeros(36, 3))
+    with torch.no_grad():
+        assert torch.allclose(net.freeze([False, True])(images), indexed_forward(net, images), atol=1e-5)
+
+
+@pytest.mark.parametrize("quantize", ["row", "bucket"])
+def test_int8_frozen_net_stays_close(quantize):
+    net, images = indexed_net(num_quantiles=8)
+    quantized = net.freeze([False, True], quantize)
+    assert quantized.indexed.bank.dtype == torch.int8
+    assert quantized.indexed.bank.nbytes * 4 == net.indexed.param_index.nbytes
+    with torch.no_grad():
+        reference, output = indexed_forward(net, images), quantized(images)
+        assert (output - reference).abs().max() < 0.02 * reference.abs().max()
+        assert (output.argmax(1) == reference.argmax(1)).float().mean() > 0.95
+        assert torch.equal(torch.jit.script(quantized)(images), output)
+
+
+@pytest.mark.parametrize("budget_bytes", [None, 1])
+def test_task_banks_keep_thresholds_banks_and_optimizer_state(tmp_path, budget_bytes):
+    net = main.Net(num_quantiles=4, quantile_cardinality=300).eval()
+    optimizer = torch.optim.Adadelta(net.parameters(), lr=1.0)
+    tasks = net.enable_tasks(str(tmp_path / "banks"), budget_bytes, optimizer)
+    images = torch.randn(64, 1, 28, 28)
+    saved = {}
+    for task in [1, 2]:
+        tasks.add(task)
+        #A new task starts without the previous task's running averages
+        assert optimizer.state.get(net.indexed.param_index, {}) == {}
+        with torch.no_grad():
+            net(images * task, [False, True], [False, False], [False, False])
+        net.calculate_n_quantiles(4, False, "2")
+        net.index_layers(4, "2")
+        net.use_indices(True, "2")
+        for _ in range(task):
+            net(images, [False, False], [False, True], [False, False]).sum().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        state = optimizer.state[net.indexed.param_index]
+        saved[task] = (net.eideticIndexed.quantiles.clone(), net.indexed.param_index.detach().clone(), int(state["step"]), state["square_avg"].clone())
+
+    for task in [1, 2, 1]:
+        tasks.activate(task)
+        quantiles, bank, step, square_avg = saved[task]
+        state = optimizer.state[net.indexed.param_index]
+        assert torch.equal(net.eideticIndexed.quantiles, quantiles) and torch.equal(net.indexed.param_index, bank)
+        assert int(state["step"]) == step and torch.equal(state["square_avg"], square_avg)
+    if budget_bytes is not None:
+        assert len(tasks.resident) == 1 and tasks.page_outs >= 2 and tasks.page_ins >= 2
+        assert sorted(path.name for path in (tmp_path / "banks").iterdir()) == ["task_1.pt", "task_2.pt"]
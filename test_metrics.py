@@ -0,0 +1,96 @@
+import csv
+import json
+import time
+import pytest
+import torch
+import customlayers
+import metrics
+
+
+def recorder_of(accuracies):
+    """ Enabled Metrics with the (stage, task) -> accuracy evaluations, recorded in order """
+    recorder = metrics.Metrics(enabled=True)
+    for (stage, task), accuracy in accuracies.items():
+        recorder.evaluation(stage, task, 1.0, accuracy)
+    return recorder
+
+
+def test_transfer_of_three_tasks():
+    #R[i][j], the accuracy on task j after training task i, and b[j] before any training
+    R = [[0.9, 0.2, 0.1],
+         [0.6, 0.8, 0.3],
+         [0.5, 0.7, 0.9]]
+    b = [0.1, 0.1, 0.2]
+    tasks = ["a", "b", "c"]
+    accuracies = {(metrics.UNTRAINED, task): b[j] for j, task in enumerate(tasks)}
+    for i, stage in enumerate(tasks):
+        accuracies.update({(stage, task): R[i][j] for j, task in enumerate(tasks)})
+    values = recorder_of(accuracies).transfer()
+
+    assert values["accuracy"] == pytest.approx((0.5 + 0.7 + 0.9) / 3)
+    assert values["bwt"] == pytest.approx(((0.5 - 0.9) + (0.7 - 0.8)) / 2)
+    assert values["fwt"] == pytest.approx(((0.2 - 0.1) + (0.3 - 0.2)) / 2)
+    #Task a peaked after its own stage, task b after its own stage too
+    assert values["forgetting"] == pytest.approx(((0.9 - 0.5) + (0.8 - 0.7)) / 2)
+    assert values["average_transfer"] == pytest.approx((values["bwt"] + values["fwt"]) / 2)
+
+
+def test_transfer_leaves_out_metrics_with_missing_evaluations():
+    #No untrained baseline, so no forward transfer and no average
+    values = recorder_of({("a", "a"): 0.9, ("b", "a"): 0.6, ("b", "b"): 0.8}).transfer()
+    assert values == pytest.approx({"accuracy": 0.7, "bwt": -0.3, "forgetting": 0.3})
+    assert recorder_of({("a", "a"): 0.9}).transfer() == {"accuracy": 0.9}
+    assert recorder_of({}).transfer() == {}
+
+
+def test_disabled_recorder_keeps_nothing():
+    recorder = metrics.Metrics()
+    recorder.evaluation("a", "a", 1.0, 0.9)
+    recorder.count("rows")
+    assert recorder.evaluations == {} and recorder.counters == {} and recorder.transfer() == {}
+
+
+def test_phases_counters_and_histograms(tmp_path):
+    recorder = metrics.Metrics(enabled=True, profile_phase="quantiles", profile_path=str(tmp_path / "trace.json"))
+    for _ in range(2):
+        with recorder.phase("pretraining"):
+            time.sleep(0.01)
+    with recorder.phase("quantiles"):
+        torch.randn(64, 64).sort(0)
+    recorder.count("rows", 3)
+    recorder.count("rows")
+    recorder.occupancy("buckets", torch.tensor([[0, 2], [2, 2]]), 4)
+    recorder.occupancy("buckets", torch.tensor([1]), 4)
+
+    values = recorder.as_dict()
+    assert values["phases"]["pretraining"]["calls"] == 2 and values["phases"]["pretraining"]["total_s"] >= 0.02
+    assert values["counters"] == {"rows": 4} and values["histograms"] == {"buckets": [1, 1, 3, 0]}
+    assert (tmp_path / "trace.json").exists() and recorder.profile_summary is not None
+
+
+def test_export_json_and_csv(tmp_path):
+    recorder = recorder_of({("a", "a"): 0.9})
+    recorder.count("rows", 5)
+    recorder.occupancy("buckets", torch.tensor([0, 1, 1]), 2)
+    recorder.export(str(tmp_path / "run.json"))
+    with open(tmp_path / "run.json") as f:
+        assert json.load(f)["counters"] == {"rows": 5}
+    recorder.export(str(tmp_path / "run.csv"))
+    with open(tmp_path / "run.csv") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["kind", "name", "key", "value"]
+    assert ["counter", "rows", "value", "5"] in rows and ["histogram", "buckets", "1", "2"] in rows
+    assert ["evaluation", "a/a", "accuracy", "0.9"] in rows and ["transfer", "accuracy", "value", "0.9"] in rows
+
+
+def test_layers_count_lookups_only_when_enabled(monkeypatch):
+    layer = customlayers.EideticLinearLayer(8, 8, 1.0, 100, 1)
+    layer.set_quantiles(torch.tensor([[-0.5, 0.0, 0.5]] * 8))
+    x = torch.randn(4, 8)
+    for enabled in [False, True]:
+        monkeypatch.setattr(metrics, "recorder", metrics.Metrics(enabled=enabled))
+        with torch.no_grad():
+            layer(x, True, True, False)
+        lookups = 32 if enabled else None
+        assert metrics.recorder.counters.get("bucket_lookups_1") == lookups
+        assert sum(metrics.recorder.histograms.get("bucket_occupancy_1", torch.zeros(1)).tolist()) == (lookups or 0)
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import numpy as np
+import torch
+import config
+import main
+import serve
+
+
+class FirstPixels(torch.nn.Module):
+    """ The first two pixels of every image, recording the size of each batch """
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(len(x))
+        return x.flatten(1)[:, :2]
+
+
+def test_micro_batcher_batches_concurrent_requests():
+    model = FirstPixels()
+    images = [np.full((28, 28), i / 100, dtype=np.float32) for i in range(40)]
+
+    async def submit_all():
+        batcher = serve.MicroBatcher(model, max_batch_size=16, max_wait_ms=50)
+        batcher.start()
+        try:
+            return await asyncio.gather(*[batcher.submit(image) for image in images]), batcher.stats.snapshot()
+        finally:
+            await batcher.stop()
+
+    outputs, stats = asyncio.run(submit_all())
+    #Every caller gets its own row, normalised as main.py does
+    for image, output in zip(images, outputs):
+        assert np.allclose(output, (image[0, :2] - serve.MEAN) / serve.STD)
+    assert model.batch_sizes == [16, 16, 8]
+    assert stats["requests"] == 40 and stats["batches"] == 3 and stats["p99_ms"] >= stats["p50_ms"] > 0
+
+
+def test_serve_stream_answers_each_line(tmp_path, monkeypatch):
+    monkeypatch.delenv("ACTIVATION_DIR", raising=False)
+    config.reload()
+    torch.manual_seed(0)
+    net = main.Net(num_quantiles=4, quantile_cardinality=100).eval()
+    path = str(tmp_path / "mnist_cnn.pt")
+    main.save_checkpoint(net, path)
+    model = serve.load_model(path)
+    image = np.random.default_rng(0).random((28, 28), dtype=np.float32)
+    with torch.no_grad():
+        expected = net((torch.from_numpy(image)[None, None] - serve.MEAN) / serve.STD, [False, False], [False, False], [False, False])[0]
+
+    async def exchange(lines):
+        batcher = serve.MicroBatcher(model, max_batch_size=4, max_wait_ms=1)
+        batcher.start()
+        server = await asyncio.start_unix_server(lambda r, w: serve.serve_stream(batcher, r, w), str(tmp_path / "socket"))
+        try:
+            reader, writer = await asyncio.open_unix_connection(str(tmp_path / "socket"))
+            responses = []
+            for line in lines:
+                writer.write((line + "\n").encode())
+                responses.append(json.loads(await reader.readline()))
+            writer.close()
+            return responses
+        finally:
+            server.close()
+            await batcher.stop()
+
+    answer, short, broken, stats = asyncio.run(exchange([json.dumps({"id": 1, "image": image.tolist()}), json.dumps({"id": 2, "image": [0.5] * 10}),
+                                                         "not json", json.dumps({"cmd": "stats", "id": 3})]))
+    assert answer["id"] == 1 and answer["prediction"] == int(expected.argmax())
+    assert np.allclose(answer["log_probs"], expected.numpy(), atol=1e-5)
+    assert short == {"id": 2, "error": "image must have 784 pixels, got 10"}
+    assert broken["id"] is None and "error" in broken
+    assert stats["id"] == 3 and stats["requests"] == 1
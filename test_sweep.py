@@ -0,0 +1,67 @@
+import csv
+import json
+import pytest
+import torch
+import config
+import sweep
+
+
+class FakeImages(torch.utils.data.Dataset):
+    """ Random 28x28 images with labels of the given number of classes """
+    def __init__(self, classes, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.data = torch.randn(400, 1, 28, 28, generator=generator)
+        self.targets = torch.randint(0, classes, (400,), generator=generator)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index], self.targets[index]
+
+
+def test_grid_covers_every_combination():
+    points = sweep.grid({"num_quantiles": [4, 8], "lr": [0.5, 1.0, 2.0]})
+    assert len(points) == 6 and points[0] == {"num_quantiles": 4, "lr": 0.5} and points[-1] == {"num_quantiles": 8, "lr": 2.0}
+
+
+def test_write_results_as_csv_or_json(tmp_path):
+    rows = [{"num_quantiles": 4, "accuracy": 0.5}, {"num_quantiles": 8, "error": "ValueError: x"}]
+    sweep.write_results(rows, str(tmp_path / "results.csv"))
+    with open(tmp_path / "results.csv") as f:
+        written = list(csv.DictReader(f))
+    assert list(written[0]) == sweep.COLUMNS and written[0]["accuracy"] == "0.5" and written[1]["error"] == "ValueError: x"
+    sweep.write_results(rows, str(tmp_path / "results.json"))
+    with open(tmp_path / "results.json") as f:
+        assert json.load(f) == rows
+    table = sweep.format_table(rows).splitlines()
+    assert len(table) == 3 and table[1].endswith("-") and table[2].endswith("ValueError: x")
+
+
+@pytest.fixture
+def activation_dir(tmp_path, monkeypatch):
+    """ ACTIVATION_DIR set for the sweep, and the settings of the environment again afterwards """
+    for name in ["USE_DB", "OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("ACTIVATION_DIR", str(tmp_path / "shared"))
+    config.reload()
+    yield
+    monkeypatch.undo()
+    config.reload()
+
+
+def test_sweep_keeps_each_run_in_its_directory(tmp_path, activation_dir, capfd):
+    datasets = (FakeImages(10, 0), FakeImages(10, 0), FakeImages(26, 1))
+    axes = {"num_quantiles": [4, 8], "task_a_subset_cardinality": [200], "task_b_subset_cardinality": [150], "batch_size": [16], "lr": [1.0]}
+    rows = sweep.sweep(axes, ["--epochs", "1"], workers=2, threads=1, directory=str(tmp_path / "sweep"), datasets=datasets)
+
+    assert [row["num_quantiles"] for row in rows] == [4, 8]
+    for index, row in enumerate(rows):
+        assert "error" not in row and 0 <= row["task_a_accuracy"] <= 1 and "bwt" in row
+        run_directory = tmp_path / "sweep" / ("config_" + str(index))
+        assert (tmp_path / "sweep" / ("config_" + str(index) + ".json")).exists()
+        assert list((run_directory / "activations").iterdir()) != []
+        assert "Test set" in (run_directory / "stdout.log").read_text()
+    #Only the progress lines reach the sweep's own stdout
+    assert [line.split(":")[0] for line in capfd.readouterr().out.splitlines()] == ["Finished 1/2", "Finished 2/2"]
+    assert not (tmp_path / "shared").exists()